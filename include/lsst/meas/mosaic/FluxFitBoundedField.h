@@ -40,11 +40,17 @@ class FluxFitBoundedField : public afw::table::io::PersistableFacade<FluxFitBoun
                               public afw::math::BoundedField {
 public:
 
+    /**
+     *  The Jacobian correction comes from the jacobian field when given, such
+     *  as fitJacobian(*wcs, bbox) over the same bbox, and from calculateJacobian
+     *  on the wcs otherwise.  The jacobian field is persisted with the rest.
+     */
     FluxFitBoundedField(afw::geom::Box2I const & bbox,
                         std::shared_ptr<FluxFitParams> const & ffp,
                         std::shared_ptr<afw::geom::SkyWcs> const & wcs,
                         double zeroPoint=1.0,
-                        int nQuarter=0);
+                        int nQuarter=0,
+                        std::shared_ptr<afw::math::BoundedField> const & jacobian=nullptr);
 
     FluxFitBoundedField(FluxFitBoundedField const &) = delete;
 
@@ -57,8 +63,33 @@ public:
     /// @copydoc BoundedField::evaluate
     double evaluate(afw::geom::Point2D const & position) const override;
 
+    /// @copydoc BoundedField::evaluate
+    ndarray::Array<double, 1, 1> evaluate(ndarray::Array<double const, 1> const & x,
+                                          ndarray::Array<double const, 1> const & y) const override;
+
     using afw::math::BoundedField::evaluate;
 
+    /**
+     *  Versions of the BoundedField image methods that evaluate the field at
+     *  once on a grid of nodes every xStep and yStep pixels (and on the last
+     *  column and row), and interpolate it bilinearly in between.
+     *
+     *  The BoundedField methods are not virtual: these are only used when the
+     *  field is known to be a FluxFitBoundedField, as it is in Python.
+     */
+    template <typename T>
+    void fillImage(afw::image::Image<T> & image, bool overlapOnly=false, int xStep=1, int yStep=1) const;
+
+    template <typename T>
+    void addToImage(afw::image::Image<T> & image, double scaleBy=1.0, bool overlapOnly=false,
+                    int xStep=1, int yStep=1) const;
+
+    template <typename T>
+    void multiplyImage(afw::image::Image<T> & image, bool overlapOnly=false, int xStep=1, int yStep=1) const;
+
+    template <typename T>
+    void divideImage(afw::image::Image<T> & image, bool overlapOnly=false, int xStep=1, int yStep=1) const;
+
     /// FluxFitBoundedField is always persistable.
     bool isPersistable() const noexcept override { return true; }
 
@@ -70,6 +101,8 @@ public:
 
     std::shared_ptr<afw::geom::SkyWcs> getWcs() const { return _wcs; }
 
+    std::shared_ptr<afw::math::BoundedField> getJacobian() const { return _jacobian; }
+
 protected:
 
     std::string getPersistenceName() const override;
@@ -87,6 +120,7 @@ private:
     double _zeroPoint;
     int _nQuarter;
     afw::geom::AffineTransform _transform;
+    std::shared_ptr<afw::math::BoundedField> _jacobian;
 };
 
 }}}  // namespace lsst::afw::math
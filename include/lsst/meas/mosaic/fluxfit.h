@@ -31,9 +31,19 @@ namespace lsst {
 		~FluxFitParams();
 		FluxFitParams(const FluxFitParams &p);
 		double eval(double u, double v) const;
+		// T_i, or powers, of (u + x0)/u_max and (v + y0)/v_max for
+		// i = 0..order, into bu and bv
+		void evalBasis(double u, double v, double *bu, double *bv) const;
+		// eval from the output of evalBasis; not an overload of eval, so
+		// that eval(0, 0) stays unambiguous
+		double evalFromBasis(double const *bu, double const *bv) const;
+        // Evaluate at many points, in blocks and on nThreads threads (0
+        // means one per hardware thread) for large arrays; the values are
+        // the same as those of the scalar eval
         ndarray::Array<double, 1> eval(
             ndarray::Array<double const, 1> const& x,
-            ndarray::Array<double const, 1> const& y
+            ndarray::Array<double const, 1> const& y,
+            int nThreads=1
         ) const;
 		int getXorder(int i) const { return xorder[i]; }
 		int getYorder(int i) const { return yorder[i]; }
@@ -43,6 +53,27 @@ namespace lsst {
 
 	    typedef std::map<int, FluxFitParams::Ptr> FfpSet;
 
+	    // When fluxFit stops solving and rejecting: after maxIter solutions,
+	    // once chi2 changes by at most chi2Tol times chi2 and the zero points
+	    // and coefficients by at most magTol (mag), or once at most maxReject
+	    // observations are newly rejected.  fluxFit sets nIter and reason
+	    // ("maxIter", "converged" or "rejection").
+	    struct FluxFitIteration {
+		FluxFitIteration()
+		    : maxIter(3), chi2Tol(0.0), magTol(0.0), maxReject(0), nIter(0),
+		      nUpdate(0), nLowRank(0) {}
+		int maxIter;
+		double chi2Tol;
+		double magTol;
+		int maxReject;
+		int nIter;
+		std::string reason;
+		// Iterations solved by updating the equations kept with maxChurn,
+		// and of those, the ones not needing a new factorization
+		int nUpdate;
+		int nLowRank;
+	    };
+
 	    void fluxFit(bool absolute,
 			 bool common,
 			 ObsVec& matchVec,
@@ -54,7 +85,9 @@ namespace lsst {
 			 std::map<int, float>& fexp,
 			 std::map<int, float>& fchip,
 			 FfpSet &ffpSet,
-			 bool solveCcd);
+			 bool solveCcd,
+			 double maxChurn=0.0,
+			 FluxFitIteration *iteration=NULL);
 
 	    FluxFitParams::Ptr
 	      convertFluxFitParams(FluxFitParams::Ptr& ffp,
@@ -64,17 +97,22 @@ namespace lsst {
 	    lsst::daf::base::PropertySet::Ptr
 	      metadataFromFluxFitParams(FluxFitParams::Ptr& ffp);
 
+	    // The flux correction images are evaluated every 100 pixels in x and
+	    // y and interpolated bilinearly in magnitude, with the rows split
+	    // across nThreads threads (0 for one per CPU)
         std::shared_ptr<lsst::afw::image::Image<float>>
 	      getFCorImg(FluxFitParams::Ptr& p,
 			 PTR(lsst::afw::cameraGeom::Detector)& ccd,
-			 Coeff::Ptr& coeff);
+			 Coeff::Ptr& coeff,
+			 int nThreads=1);
 
         std::shared_ptr<lsst::afw::image::Image<float>>
-	      getFCorImg(FluxFitParams::Ptr& p, int width, int height);
+	      getFCorImg(FluxFitParams::Ptr& p, int width, int height, int nThreads=1);
 
         std::shared_ptr<lsst::afw::image::Image<float>>
 	      getFCorImg(FluxFitParams::Ptr& p,
-			 PTR(lsst::afw::cameraGeom::Detector)& ccd);
+			 PTR(lsst::afw::cameraGeom::Detector)& ccd,
+			 int nThreads=1);
 
 #include "chebyshev.h"
     }
@@ -2,14 +2,19 @@
 #if !defined(HSC_MEAS_MOSAIC_H)
 #define HSC_MEAS_MOSAIC_H
 
+#include <algorithm>
 #include <cmath>
+#include <cstdint>
 #include <memory>
+#include <string>
+#include <unordered_set>
 #include <vector>
 #include "lsst/pex/exceptions.h"
 #include "lsst/afw/image.h"
 #include "lsst/afw/geom.h"
 #include "lsst/afw/cameraGeom.h"
 #include "lsst/afw/table.h"
+#include "lsst/afw/math/ChebyshevBoundedField.h"
 
 namespace lsst {
     namespace meas {
@@ -224,6 +229,12 @@ namespace lsst {
 		void setFitVal2(Coeff::Ptr& c, Poly::Ptr p);
 	    };
 
+	    /*
+	     * Pointer-based kd-tree on (RA, Dec), grown by insertion.
+	     *
+	     * kdtreeMat and kdtreeSource use FlatKDTree/SourceGroupTree instead;
+	     * this is kept for existing scripts.
+	     */
 	    class KDTree
 #if !defined(SWIG)
 	      : public std::enable_shared_from_this<KDTree>
@@ -270,23 +281,285 @@ namespace lsst {
                 void _initializeMatches(SourceMatchSet& m, int depth);
             };
 
+	    /*
+	     * Array-backed kd-tree on unit vectors, built once.
+	     *
+	     * Points are kept in tree order in one contiguous array; the node for
+	     * a range [lo, hi) is its median element, split along the axis of
+	     * largest extent.  Distances are squared chord lengths between unit
+	     * vectors, which are monotonic in angular separation and have no
+	     * trouble with the RA wrap or the poles.
+	     */
+	    class FlatKDTree {
+	    public:
+		typedef std::shared_ptr<FlatKDTree> Ptr;
+
+		FlatKDTree() {}
+		// xyz holds 3 components per point; points [begin, end) are indexed
+		FlatKDTree(std::vector<double> const& xyz, int begin = 0, int end = -1);
+		// ra, dec in degrees
+		FlatKDTree(ndarray::Array<double const, 1> const& ra,
+			   ndarray::Array<double const, 1> const& dec);
+
+		int size() const { return _points.size(); }
+		int getBegin() const { return _begin; }
+		int getEnd() const { return _begin + size(); }
+
+		// Index of the point nearest to v closer than maxChord2, or -1
+		int findNearest(double const v[3], double maxChord2, double *chord2 = NULL) const;
+		int findNearest(lsst::afw::geom::SpherePoint const& sky, lsst::afw::geom::Angle radius) const;
+		// Indices of all points closer than maxChord2 to v
+		void findWithin(double const v[3], double maxChord2, std::vector<int> & result) const;
+		std::vector<int> findWithin(lsst::afw::geom::SpherePoint const& sky,
+					    lsst::afw::geom::Angle radius) const;
+
+		static void toVector(double ra, double dec, double v[3]);
+		static void toVector(Source const& s, double v[3]) {
+		    toVector(s.getRa().asRadians(), s.getDec().asRadians(), v);
+		}
+		static double chord2(lsst::afw::geom::Angle d) {
+		    double c = 2.0 * sin(0.5 * std::min(d.asRadians(), M_PI));
+		    return c * c;
+		}
+
+	    private:
+		struct Point {
+		    double v[3];
+		    int index;
+		    int axis;
+		};
+
+		void _build();
+
+		int _begin;
+		std::vector<Point> _points;
+	    };
+
+	    /*
+	     * Groups of sources with a flat kd-tree on their first member.
+	     *
+	     * This is what kdtreeMat and kdtreeSource return: for matches
+	     * groups[i][0] is the reference object and the rest are the
+	     * detections of it; for sources all members are detections.
+	     */
+	    class SourceGroupTree {
+	    public:
+		typedef std::shared_ptr<SourceGroupTree> Ptr;
+
+		SourceGroup groups;
+
+		// With indexMembers, the (exp, chip, id) of every member is hashed
+		// for contains().  Empty groups are dropped.
+		explicit SourceGroupTree(SourceGroup g, bool indexMembers = false);
+
+		int count(void) const { return groups.size(); }
+		// Is there a member within 0.01 arcsec of s?
+		bool findSource(Source const& s) const;
+		// Is s (by exposure, chip and id) a member?  Falls back to
+		// findSource if the members were not indexed.
+		bool contains(Source const& s) const;
+		int findNearest(Source const& s, lsst::afw::geom::Angle d_lim) const;
+		SourceGroup mergeMat() const;
+		SourceGroup mergeSource(unsigned int minNumMatch = 2) const;
+
+	    private:
+		struct SourceKey {
+		    Source::IdType id;
+		    Source::ChipType chip;
+		    Source::ExpType exp;
+		    explicit SourceKey(Source const& s) : id(s.getId()), chip(s.getChip()), exp(s.getExp()) {}
+		    bool operator==(SourceKey const& other) const {
+			return id == other.id && chip == other.chip && exp == other.exp;
+		    }
+		};
+		struct SourceKeyHash {
+		    size_t operator()(SourceKey const& key) const {
+			size_t h = std::hash<Source::IdType>()(key.id);
+			h ^= std::hash<int>()(key.chip) + 0x9e3779b97f4a7c15ULL + (h << 6) + (h >> 2);
+			h ^= std::hash<int>()(key.exp) + 0x9e3779b97f4a7c15ULL + (h << 6) + (h >> 2);
+			return h;
+		    }
+		};
+
+		FlatKDTree _tree;
+		double _maxChord2;	// largest squared chord from a member to groups[i][0]
+		bool _indexed;
+		std::unordered_set<SourceKey, SourceKeyHash> _members;
+	    };
+
 	    typedef std::map<int, PTR(lsst::afw::cameraGeom::Detector)> CcdSet;
 	    typedef std::map<int, Coeff::Ptr> CoeffSet;
 	    typedef std::vector<Obs::Ptr> ObsVec;
 
+	    // nThreads (0 for one per CPU) does not change the result
 	    int flagSuspect(SourceGroup &allMat,
 			    SourceGroup &allSource,
-			    WcsDic &wcsDic);
+			    WcsDic &wcsDic,
+			    int nThreads = 1);
+
+	    SourceGroupTree::Ptr kdtreeMat(SourceMatchGroup &matchList);
+	    // nThreads (0 for one per CPU) does not change the result
+	    SourceGroupTree::Ptr kdtreeSource(SourceGroup const &sourceSet,
+					      SourceGroupTree::Ptr rootMat,
+					      CcdSet &ccdSet,
+					      lsst::afw::geom::Angle d_lim,
+					      int nThreads = 1);
+	    // Friends-of-friends grouping of the sources not in rootMat: sources
+	    // closer than d_lim are linked, independent of their order.  The
+	    // sky is split into nThreads stripes of Dec bands.
+	    SourceGroupTree::Ptr fofSource(SourceGroup const &sourceSet,
+					   SourceGroupTree::Ptr rootMat,
+					   lsst::afw::geom::Angle d_lim,
+					   int nThreads = 1);
+
+	    /*
+	     * Groups from matchArrays: groupId[i] is the group of detection i,
+	     * and the detections of group k are members[offsets[k]:offsets[k+1]],
+	     * in input order.  refIndex[k] is the reference of group k, or -1.
+	     */
+	    struct ArrayMatch {
+		ndarray::Array<int, 1, 1> groupId;
+		ndarray::Array<int, 1, 1> members;
+		ndarray::Array<int, 1, 1> offsets;
+		ndarray::Array<int, 1, 1> refIndex;
+	    };
 
-	    KDTree::Ptr kdtreeMat(SourceMatchGroup &matchList);
-	    KDTree::Ptr kdtreeSource(SourceGroup const &sourceSet,
-				     KDTree::Ptr rootMat,
-				     CcdSet &ccdSet,
-				     lsst::afw::geom::Angle d_lim);
+	    // Cross-match detections given as arrays (ra, dec in degrees),
+	    // without Source objects.  Detections within d_lim of a reference
+	    // join the group of the nearest one, and the rest are grouped as by
+	    // kdtreeSource (mode "nearest") or fofSource (mode "fof").  The
+	    // reference groups come first, in order of reference.
+	    ArrayMatch matchArrays(ndarray::Array<double const, 1> const& ra,
+				   ndarray::Array<double const, 1> const& dec,
+				   ndarray::Array<std::int64_t const, 1> const& visit,
+				   ndarray::Array<double const, 1> const& refRa,
+				   ndarray::Array<double const, 1> const& refDec,
+				   lsst::afw::geom::Angle d_lim,
+				   std::string const& mode = "nearest",
+				   int nThreads = 1);
+
+	    /*
+	     * Groups sources visit by visit, as they are read, with the same
+	     * result as kdtreeMat and kdtreeSource (mode "nearest") or fofSource
+	     * (mode "fof") on all the visits in the same order.  Only the
+	     * unmatched sources and the matches are kept, and in "nearest" mode
+	     * each visit is grouped as it is added.
+	     */
+	    class SourceGroupBuilder {
+	    public:
+		typedef std::shared_ptr<SourceGroupBuilder> Ptr;
+
+		SourceGroupBuilder(lsst::afw::geom::Angle d_lim,
+				   std::string const& mode = "nearest",
+				   int nThreads = 1);
+
+		// All the sources and matches of a visit, in one call
+		void addVisit(SourceSet const& sources, SourceMatchSet const& matches);
+		int getNumVisits() const { return _matchList.size(); }
+
+		SourceGroupTree::Ptr getMatchTree();
+		SourceGroupTree::Ptr getSourceTree() const;
+
+	    private:
+		lsst::afw::geom::Angle _d_lim;
+		double _maxChord2;
+		bool _fof;
+		int _nThreads;
+		SourceMatchGroup _matchList;
+		SourceSet _sources;		// unmatched sources, in order of visit
+		std::vector<int> _group;	// group of each of _sources ("nearest")
+		std::vector<double> _first;	// unit vector of the first source of each group
+		std::vector<FlatKDTree> _forest;
+	    };
+
+	    /*
+	     * The members of a SourceGroup as columns: those of group i are
+	     * [offsets[i], offsets[i+1]), with the reference or mean position
+	     * first.  ra and dec are in degrees.
+	     */
+	    struct SourceGroupArrays {
+		ndarray::Array<std::int64_t, 1, 1> offsets;
+		ndarray::Array<std::int64_t, 1, 1> id;
+		ndarray::Array<int, 1, 1> chip;
+		ndarray::Array<int, 1, 1> exp;
+		ndarray::Array<double, 1, 1> ra;
+		ndarray::Array<double, 1, 1> dec;
+		ndarray::Array<double, 1, 1> x;
+		ndarray::Array<double, 1, 1> xErr;
+		ndarray::Array<double, 1, 1> y;
+		ndarray::Array<double, 1, 1> yErr;
+		ndarray::Array<double, 1, 1> flux;
+		ndarray::Array<double, 1, 1> fluxErr;
+		ndarray::Array<bool, 1, 1> astromBad;
+	    };
 
+	    /*
+	     * Sources as columns, one row per source, to keep and ship many
+	     * of them without a Source object each.  ra and dec are in
+	     * degrees.
+	     */
+	    struct SourceArrays {
+		ndarray::Array<std::int64_t, 1, 1> id;
+		ndarray::Array<int, 1, 1> chip;
+		ndarray::Array<int, 1, 1> exp;
+		ndarray::Array<double, 1, 1> ra;
+		ndarray::Array<double, 1, 1> dec;
+		ndarray::Array<double, 1, 1> x;
+		ndarray::Array<double, 1, 1> xErr;
+		ndarray::Array<double, 1, 1> y;
+		ndarray::Array<double, 1, 1> yErr;
+		ndarray::Array<double, 1, 1> flux;
+		ndarray::Array<double, 1, 1> fluxErr;
+		ndarray::Array<bool, 1, 1> astromBad;
+	    };
+
+	    SourceArrays sourceSetToArrays(SourceSet const &ss);
+	    // New Sources with the values in arrays
+	    SourceSet sourceSetFromArrays(SourceArrays const &arrays);
+	    // The groups of kdtreeMat(...)->mergeMat() for the matches
+	    // (ref[i], src[i]), without Source objects
+	    SourceGroupArrays mergeMatArrays(SourceArrays const &ref, SourceArrays const &src);
+	    // The groups of kdtreeSource (mode "nearest") or fofSource (mode
+	    // "fof") followed by mergeSource(minNumMatch), without Source
+	    // objects.  The sources of a visit (exp) must be contiguous, and
+	    // those that are members of allMat are left out.
+	    SourceGroupArrays mergeSourceArrays(SourceArrays const &sources,
+						SourceGroupArrays const &allMat,
+						lsst::afw::geom::Angle d_lim,
+						std::string const &mode = "nearest",
+						unsigned int minNumMatch = 2,
+						int nThreads = 1);
+
+	    SourceGroupArrays sourceGroupToArrays(SourceGroup const &sg);
+	    // New Sources with the values in arrays
+	    SourceGroup sourceGroupFromArrays(SourceGroupArrays const &arrays);
+	    // The groups (not copies) for which keep is true
+	    SourceGroup selectSourceGroups(SourceGroup const &sg,
+					   ndarray::Array<bool const, 1> const &keep);
+	    // Is the first member of each group inside bbox?
+	    ndarray::Array<bool, 1, 1> getGroupsInBox(SourceGroupArrays const &arrays,
+						      lsst::afw::geom::SkyWcs const &wcs,
+						      lsst::afw::geom::Box2D const &bbox);
+
+	    // Seconds spent by obsVecFromSourceGroup
+	    struct ObsVecTiming {
+		double prepare;		// looking up exposures and CCDs
+		double build;		// making the Obs
+		double total;
+	    };
+
+	    // Throws NotFoundError if a source has no WCS or CCD.  The Obs
+	    // are the same, and in the same order, for any nThreads.
 	    ObsVec obsVecFromSourceGroup(SourceGroup const &all,
 					 WcsDic &wcsDic,
-					 CcdSet &ccdSet);
+					 CcdSet &ccdSet,
+					 int nThreads = 1,
+					 ObsVecTiming *timing = NULL);
+	    ObsVec obsVecFromSourceGroup(SourceGroupArrays const &all,
+					 WcsDic &wcsDic,
+					 CcdSet &ccdSet,
+					 int nThreads = 1,
+					 ObsVecTiming *timing = NULL);
 
 	    CoeffSet solveMosaic_CCD_shot(int order,
 					  int nmatch,
@@ -323,6 +596,7 @@ namespace lsst {
 	      getJImg(Coeff::Ptr& coeff,
 		      PTR(lsst::afw::cameraGeom::Detector)& ccd);
 
+	    // Evaluated on the whole image from fitJacobian(*wcs, ...)
 	    std::shared_ptr<lsst::afw::image::Image<float>>
 	      getJImg(std::shared_ptr<lsst::afw::geom::SkyWcs>& wcs,
 		      int width, int height);
@@ -351,6 +625,29 @@ namespace lsst {
                 ndarray::Array<double const, 1> const& x, ///< x positions for correction
                 ndarray::Array<double const, 1> const& y  ///< y positions for correction
                 );
+
+            // The same correction for the Wcs wcsFromCoeff(coeff), from the
+            // derivatives of the Coeff polynomial and of the gnomonic
+            // projection instead of the Wcs.  Points are pixels of that Wcs.
+            double calculateJacobian(
+                Coeff::Ptr& coeff, ///< Astrometric solution
+                afw::geom::Point2D const& point ///< Position for correction
+                );
+            ndarray::Array<double, 1> calculateJacobian(
+                Coeff::Ptr& coeff, ///< Astrometric solution
+                ndarray::Array<double const, 1> const& x, ///< x positions for correction
+                ndarray::Array<double const, 1> const& y  ///< y positions for correction
+                );
+
+            // A Chebyshev surface of the given order fitted to the correction
+            // of an arbitrary Wcs, sampled every step pixels over bbox (and on
+            // its last row and column).  It only costs the Wcs the samples.
+            std::shared_ptr<afw::math::ChebyshevBoundedField> fitJacobian(
+                afw::geom::SkyWcs const& wcs, ///< Astrometric solution
+                afw::geom::Box2I const& bbox, ///< Region of the fit
+                int order=6, ///< Order of the Chebyshev surface
+                int step=128 ///< Pixels between samples
+                );
             //}
     }
   }
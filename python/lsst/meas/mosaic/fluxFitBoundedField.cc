@@ -34,7 +34,20 @@ namespace {
 using PyClass = py::class_<FluxFitBoundedField, std::shared_ptr<FluxFitBoundedField>,
                            afw::math::BoundedField>;
 
+template <typename T>
+void declareImageMethods(PyClass & cls) {
+    cls.def("fillImage", &FluxFitBoundedField::fillImage<T>,
+            "image"_a, "overlapOnly"_a=false, "xStep"_a=1, "yStep"_a=1);
+    cls.def("addToImage", &FluxFitBoundedField::addToImage<T>,
+            "image"_a, "scaleBy"_a=1.0, "overlapOnly"_a=false, "xStep"_a=1, "yStep"_a=1);
+    cls.def("multiplyImage", &FluxFitBoundedField::multiplyImage<T>,
+            "image"_a, "overlapOnly"_a=false, "xStep"_a=1, "yStep"_a=1);
+    cls.def("divideImage", &FluxFitBoundedField::divideImage<T>,
+            "image"_a, "overlapOnly"_a=false, "xStep"_a=1, "yStep"_a=1);
+}
+
 PYBIND11_MODULE(fluxFitBoundedField, mod) {
+    py::module::import("lsst.afw.image");
     py::module::import("lsst.afw.math");
     py::module::import("lsst.meas.mosaic.fluxfit");
 
@@ -47,13 +60,18 @@ PYBIND11_MODULE(fluxFitBoundedField, mod) {
             afw::geom::Box2I const &,
             std::shared_ptr<FluxFitParams> const &,
             std::shared_ptr<afw::geom::SkyWcs> const &,
-            double, int>(),
-        "bbox"_a, "ffp"_a=nullptr, "wcs"_a=nullptr, "zeroPoint"_a=1.0, "nQuarter"_a=0
+            double, int,
+            std::shared_ptr<afw::math::BoundedField> const &>(),
+        "bbox"_a, "ffp"_a=nullptr, "wcs"_a=nullptr, "zeroPoint"_a=1.0, "nQuarter"_a=0,
+        "jacobian"_a=nullptr
     );
     cls.def("getWcs", &FluxFitBoundedField::getWcs);
+    cls.def("getJacobian", &FluxFitBoundedField::getJacobian);
 
-    // all public methods are overrides of methods in BoundedField, and can be
-    // accessed in Python through that class's wrappers.
+    // The image methods hide the non-virtual ones of BoundedField; the other
+    // public methods are overrides, accessed through that class's wrappers.
+    declareImageMethods<float>(cls);
+    declareImageMethods<double>(cls);
 }
 
 }}}}  // namespace lsst::meas::mosaic::<anonymous>
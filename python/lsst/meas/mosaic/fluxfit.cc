@@ -59,32 +59,56 @@ PYBIND11_MODULE(fluxfit, mod) {
         "eval",
         (ndarray::Array<double, 1> (FluxFitParams::*)(
             ndarray::Array<double const, 1> const &,
-            ndarray::Array<double const, 1> const &
+            ndarray::Array<double const, 1> const &,
+            int
         ) const) & FluxFitParams::eval,
-        "u"_a, "v"_a
+        "u"_a, "v"_a, "nThreads"_a = 1
     );
     clsFluxFitParams.def("getXorder", &FluxFitParams::getXorder);
     clsFluxFitParams.def("getYorder", &FluxFitParams::getYorder);
     clsFluxFitParams.def("getCoeff", &FluxFitParams::getCoeff);
     clsFluxFitParams.def("getIndex", &FluxFitParams::getIndex);
 
+    py::class_<FluxFitIteration, std::shared_ptr<FluxFitIteration>> clsFluxFitIteration(
+            mod, "FluxFitIteration");
+
+    clsFluxFitIteration.def(py::init<>());
+
+    clsFluxFitIteration.def_readwrite("maxIter", &FluxFitIteration::maxIter);
+    clsFluxFitIteration.def_readwrite("chi2Tol", &FluxFitIteration::chi2Tol);
+    clsFluxFitIteration.def_readwrite("magTol", &FluxFitIteration::magTol);
+    clsFluxFitIteration.def_readwrite("maxReject", &FluxFitIteration::maxReject);
+    clsFluxFitIteration.def_readwrite("nIter", &FluxFitIteration::nIter);
+    clsFluxFitIteration.def_readwrite("reason", &FluxFitIteration::reason);
+    clsFluxFitIteration.def_readwrite("nUpdate", &FluxFitIteration::nUpdate);
+    clsFluxFitIteration.def_readwrite("nLowRank", &FluxFitIteration::nLowRank);
+
     // Workaround because fluxFit uses in/out arguments of STL container types
     mod.def("fluxFit", [](bool absolute, bool common, ObsVec matchVec, int nmatch, ObsVec sourceVec,
                           int nsource, WcsDic wcsDic, CcdSet ccdSet, std::map<int, float> fexp,
-                          std::map<int, float> fchip, FfpSet ffpSet, bool solveCcd) {
+                          std::map<int, float> fchip, FfpSet ffpSet, bool solveCcd, double maxChurn,
+                          FluxFitIteration *iteration) {
         fluxFit(absolute, common, matchVec, nmatch, sourceVec, nsource, wcsDic, ccdSet, fexp, fchip, ffpSet,
-                solveCcd);
+                solveCcd, maxChurn, iteration);
 
         return std::make_tuple(matchVec, sourceVec, wcsDic, ccdSet, fexp, fchip, ffpSet);
-    });
+    }, "absolute"_a, "common"_a, "matchVec"_a, "nmatch"_a, "sourceVec"_a, "nsource"_a, "wcsDic"_a, "ccdSet"_a,
+            "fexp"_a, "fchip"_a, "ffpSet"_a, "solveCcd"_a, "maxChurn"_a = 0.0, "iteration"_a = nullptr,
+            // The fit only uses the converted arguments, so fits of disjoint
+            // observations may run in several Python threads at once
+            py::call_guard<py::gil_scoped_release>());
     mod.def("convertFluxFitParams", convertFluxFitParams, "ffp"_a, "ccd"_a, "x0"_a = 0.0, "y0"_a = 0.0);
     mod.def("metadataFromFluxFitParams", metadataFromFluxFitParams);
     mod.def("getFCorImg",
             (std::shared_ptr<lsst::afw::image::Image<float>>(*)(
-                    FluxFitParams::Ptr&, PTR(lsst::afw::cameraGeom::Detector)&, Coeff::Ptr&))getFCorImg);
-    mod.def("getFCorImg", (std::shared_ptr<lsst::afw::image::Image<float>>(*)(FluxFitParams::Ptr&, int, int))getFCorImg);
+                    FluxFitParams::Ptr&, PTR(lsst::afw::cameraGeom::Detector)&, Coeff::Ptr&, int))getFCorImg,
+            "p"_a, "ccd"_a, "coeff"_a, "nThreads"_a = 1);
+    mod.def("getFCorImg",
+            (std::shared_ptr<lsst::afw::image::Image<float>>(*)(FluxFitParams::Ptr&, int, int, int))getFCorImg,
+            "p"_a, "width"_a, "height"_a, "nThreads"_a = 1);
     mod.def("getFCorImg", (std::shared_ptr<lsst::afw::image::Image<float>>(*)(
-                                  FluxFitParams::Ptr&, PTR(lsst::afw::cameraGeom::Detector)&))getFCorImg);
+                                  FluxFitParams::Ptr&, PTR(lsst::afw::cameraGeom::Detector)&, int))getFCorImg,
+            "p"_a, "ccd"_a, "nThreads"_a = 1);
 }
 }
 }
@@ -23,10 +23,15 @@
 from __future__ import print_function
 import os
 import math
+import pickle
+import resource
+import time
+import collections
 import numpy
 import astropy.units
 
 import multiprocessing
+import multiprocessing.pool
 
 import lsst.afw.geom                    as afwGeom
 import lsst.afw.image                   as afwImage
@@ -135,6 +140,32 @@ class MosaicConfig(pexConfig.Config):
         doc="Solve for per CCD flux scale?",
         dtype=bool,
         default=False)
+    fluxFitMaxChurn = pexConfig.RangeField(
+        doc="Largest fraction of the observations of a flux fit iteration that may be rejected or "
+            "reinstated for the next iteration to update its factorized equations rather than build "
+            "and solve them again (0 to always rebuild); the result is the same to rounding",
+        dtype=float,
+        default=0.0, min=0.0, max=1.0)
+    fluxFitMaxIter = pexConfig.RangeField(
+        doc="Maximum number of solutions of the flux fit; each but the last is followed by rejecting "
+            "outliers",
+        dtype=int,
+        default=3, min=1)
+    fluxFitChi2Tol = pexConfig.RangeField(
+        doc="Stop the flux fit once chi2 changes by at most this fraction between solutions, and the "
+            "zero points and coefficients by at most fluxFitMagTol",
+        dtype=float,
+        default=0.0, min=0.0)
+    fluxFitMagTol = pexConfig.RangeField(
+        doc="Largest change of a zero point or coefficient (mag) between solutions for the flux fit to "
+            "have converged; see fluxFitChi2Tol",
+        dtype=float,
+        default=0.0, min=0.0)
+    fluxFitMaxReject = pexConfig.RangeField(
+        doc="Stop the flux fit once at most this many observations are newly rejected; with 0, a "
+            "solution that rejects nothing is final, as the next would be the same",
+        dtype=int,
+        default=0, min=0)
     minNumMatch = pexConfig.RangeField(
         doc="Minimum number of matches in CCD to be used.",
         dtype=int,
@@ -143,6 +174,31 @@ class MosaicConfig(pexConfig.Config):
         doc="Minimum number of sources to be merged.",
         dtype=int,
         default=2, min=0)
+    sourceMergeMode = pexConfig.ChoiceField(
+        doc="How to group unmatched sources from different visits",
+        dtype=str,
+        default="nearest",
+        allowed={
+            "nearest": "Join the group whose first source is nearest, visit by visit",
+            "fof": "Friends-of-friends: link all sources closer than radXMatch, independent of order",
+        })
+    streamCatalogs = pexConfig.Field(
+        doc="Group the sources of each visit as soon as all its catalogs are read, rather than after "
+            "reading all visits?  The result is the same.  Not used in incremental mode.",
+        dtype=bool,
+        default=False)
+    columnarCatalogs = pexConfig.Field(
+        doc="Keep the sources and matches read as columns (SourceArrays) and group them without Source "
+            "objects, which are only made for the merged groups?  The result is the same.  Not used "
+            "with streamCatalogs.",
+        dtype=bool,
+        default=False)
+    numMatchThreads = pexConfig.RangeField(
+        doc="Number of threads for grouping sources, flagging suspect matches and making obsVec "
+            "(0 for one per CPU); "
+            "does not change the result",
+        dtype=int,
+        default=1, min=0)
     requireTractOverlap = pexConfig.Field(
         doc="If True, ignore CCDs that don't overlap the current tract",
         dtype=bool,
@@ -217,6 +273,24 @@ class MosaicConfig(pexConfig.Config):
         default=None,
         optional=True)
     allowMixedFilters = pexConfig.Field(dtype=bool, default=False, doc="Allow multiple filters in input?")
+    multiBand = pexConfig.Field(
+        doc="Read the visits of all filters and solve the astrometry once, but flag suspect objects and "
+            "solve the flux correction for each filter separately?  Catalogs are not streamed in this mode.",
+        dtype=bool,
+        default=False)
+    numFluxFitThreads = pexConfig.RangeField(
+        doc="Number of filters whose flux corrections are solved at the same time in multiBand mode "
+            "(0 for all of them)",
+        dtype=int,
+        default=1, min=0)
+    incremental = pexConfig.Field(
+        doc="Reuse the catalogs saved by a previous run on the same tract and read only new visits?",
+        dtype=bool,
+        default=False)
+    incrementalStateFile = pexConfig.Field(
+        doc="Name of the file in the tract diagnostic directory holding the catalogs for incremental runs",
+        dtype=str,
+        default="mosaicState.pickle")
     flagsToAlias = pexConfig.DictField(
         doc="List of flags to alias to old, pre-RFC-498, names for backwards compatibility",
         keytype=str,
@@ -304,7 +378,8 @@ class SourceReader(object):
               expected by meas_mosaic).
 
         If color transformation information is given, it will be applied to the reference flux
-        of the matched list.  The source catalog and matched list will be converted to measMosaic's
+        of the matched list; with a dict of color terms by filter, that of the filter of dataRef
+        is used.  The source catalog and matched list will be converted to measMosaic's
         Source and SourceMatch and returned.
 
         The number of 'Source's in each cell defined by config.cellSize will be limited to brightest
@@ -314,6 +389,7 @@ class SourceReader(object):
         self.log = Log.getDefaultLogger()
 
         dataId = dataRef.dataId
+        cterm = self.cterm.get(dataId["filter"]) if isinstance(self.cterm, dict) else self.cterm
 
         try:
             if not dataRef.datasetExists("src"):
@@ -378,7 +454,7 @@ class SourceReader(object):
             matches = [m for m in matches if m[0] is not None]
             refSchema = matches[0][0].schema if matches else None
 
-            if self.cterm is not None and len(matches) != 0:
+            if cterm is not None and len(matches) != 0:
                 # Add a "flux" field to the input schema of the first element
                 # of the match and populate it with a colorterm correct flux.
                 mapper = afwTable.SchemaMapper(refSchema)
@@ -401,8 +477,8 @@ class SourceReader(object):
                     record = refCat.addNew()
                     record.assign(x.first)
 
-                refMag, refMagErr = self.cterm.getCorrectedMagnitudes(refCat,
-                                                                      afwImage.Filter(calexp_md).getName())
+                refMag, refMagErr = cterm.getCorrectedMagnitudes(refCat,
+                                                                 afwImage.Filter(calexp_md).getName())
                 # NOTE: mosaic assumes fluxes are in Jy
                 refFlux = (refMag*astropy.units.ABmag).to_value(astropy.units.Jy)
                 refFluxErr = afwImage.fluxErrFromABMagErr(refMagErr, refMag)
@@ -473,7 +549,121 @@ class Worker(object):
     def __call__(self, payload):
         sourceReader, dataRef = payload
 
-        return sourceReader.readSrc(dataRef)
+        return packReadResult(sourceReader.readSrc(dataRef))
+
+def packReadResult(readResult):
+    """Convert the sources and matches from SourceReader.readSrc to SourceArrays
+
+    Columns are much cheaper to send from a worker process than a pickled
+    Source each.  unpackReadResult converts them back.
+    """
+    dataId, (sources, matches, wcs) = readResult
+    if sources is not None:
+        sources = measMosaic.sourceSetToArrays(sources)
+        matches = (measMosaic.sourceSetToArrays([m[0] for m in matches]),
+                   measMosaic.sourceSetToArrays([m[1] for m in matches]))
+    return dataId, [sources, matches, wcs]
+
+def unpackReadResult(readResult):
+    """Inverse of packReadResult"""
+    dataId, (sources, matches, wcs) = readResult
+    if sources is not None:
+        sources = measMosaic.sourceSetFromArrays(sources)
+        matches = list(zip(measMosaic.sourceSetFromArrays(matches[0]),
+                           measMosaic.sourceSetFromArrays(matches[1])))
+    return dataId, [sources, matches, wcs]
+
+class MosaicState(object):
+    """ Per-visit catalogs saved between runs for the incremental mode
+
+    Reading the src and srcMatch catalogs dominates a rerun on a tract to which
+    only a few visits have been added.  This keeps the Source and SourceMatch
+    lists made by SourceReader for each visit, together with the dataIds that
+    were read and a signature of their catalog files, so that the next run
+    reads only the visits with new, changed or previously unreadable CCDs.
+    The state is only reused with the same tract and reader configuration.
+    """
+
+    def __init__(self, tract, readerConfig):
+        self.tract = tract
+        self.readerConfig = readerConfig
+        self.sources = dict()
+        self.matches = dict()
+        self.dataIds = dict()
+        self.signatures = dict()
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+
+    def write(self, filename):
+        tmpName = filename + ".tmp"
+        with open(tmpName, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpName, filename)
+
+    def isCompatible(self, tract, readerConfig):
+        return self.tract == tract and self.readerConfig == readerConfig
+
+    def getVisitsToRead(self, dataRefList, signatures):
+        """Return the visits in dataRefList that must be (re-)read
+
+        A visit is read again if any of its dataRefs was not read before, or
+        if the signature of its catalogs (signatures are in the order of
+        dataRefList) changed or is None.
+        """
+        visits = set()
+        for dataRef, signature in zip(dataRefList, signatures):
+            visit = dataRef.dataId["visit"]
+            dataIds = self.dataIds.get(visit, [])
+            if (signature is None or dataRef.dataId not in dataIds or
+                    self.signatures[visit][dataIds.index(dataRef.dataId)] != signature):
+                visits.add(visit)
+        return visits
+
+    def select(self, visits):
+        """Drop the visits that are not in visits"""
+        for visit in list(self.dataIds.keys()):
+            if visit not in visits:
+                for d in (self.sources, self.matches, self.dataIds, self.signatures):
+                    d.pop(visit, None)
+
+    def update(self, dataRefList, signatures, ssVisit, mlVisit, dataRefListUsed):
+        """Replace the visits of dataRefList with newly read catalogs
+
+        Only the dataRefs in dataRefListUsed were read; the others are tried
+        again by the next run.
+        """
+        for dataRef in dataRefList:
+            for d in (self.sources, self.matches, self.dataIds, self.signatures):
+                d.pop(dataRef.dataId["visit"], None)
+        for visit in ssVisit:
+            self.sources[visit] = ssVisit[visit]
+            self.matches[visit] = mlVisit[visit]
+            self.dataIds[visit] = list()
+            self.signatures[visit] = list()
+        for dataRef in dataRefListUsed:
+            visit = dataRef.dataId["visit"]
+            self.dataIds[visit].append(dataRef.dataId)
+            self.signatures[visit].append(signatures[dataRefList.index(dataRef)])
+
+    def getCatalogs(self, dataRefList):
+        """Return the sourceSet, matchList and dataRefListUsed of dataRefList
+
+        The visits are in the order of dataRefList, as readCatalog gives them.
+        """
+        visits = list()
+        for dataRef in dataRefList:
+            visit = dataRef.dataId["visit"]
+            if visit in self.sources and visit not in visits:
+                visits.append(visit)
+        sourceSet = [self.sources[visit] for visit in visits]
+        matchList = [self.matches[visit] for visit in visits]
+        dataRefListUsed = [dataRef for dataRef in dataRefList
+                           if dataRef.dataId in self.dataIds.get(dataRef.dataId["visit"], [])]
+        return sourceSet, matchList, dataRefListUsed
+
 
 class MosaicTask(pipeBase.CmdLineTask):
 
@@ -548,29 +738,43 @@ class MosaicTask(pipeBase.CmdLineTask):
                 ccdSet.erase(ichip)
 
     def readCatalog(self, dataRefList, ct=None, numCoresForReadSource=1, readTimeout=9999, verbose=False):
+        ssVisit, mlVisit, dataRefListUsed = self.readCatalogByVisit(dataRefList, ct, numCoresForReadSource,
+                                                                    readTimeout, verbose)
+        sourceSet = [ssVisit[visit] for visit in ssVisit]
+        matchList = [mlVisit[visit] for visit in ssVisit]
+
+        return sourceSet, matchList, dataRefListUsed
+
+    def readCatalogByVisit(self, dataRefList, ct=None, numCoresForReadSource=1, readTimeout=9999,
+                           verbose=False):
         self.log.info("Reading catalogs ...")
         self.log.info("Use %d cores for reading source catalog" % (numCoresForReadSource))
 
-        sourceSet = []
-        matchList = []
-
         sourceReader = SourceReader(ct, self.config)
 
         params = list()
         for dataRef in dataRefList:
             params.append((sourceReader, dataRef))
 
+        # With columnarCatalogs the results stay as packed by the workers
+        columnar = self.config.columnarCatalogs
         if numCoresForReadSource > 1:
             pool = multiprocessing.Pool(processes=numCoresForReadSource, maxtasksperchild=1)
-            worker = Worker()
-            resultList = pool.map_async(worker, params).get(readTimeout)
-            pool.close()
-            pool.join()
+            try:
+                worker = Worker()
+                resultList = pool.map_async(worker, params).get(readTimeout)
+                if not columnar:
+                    resultList = [unpackReadResult(r) for r in resultList]
+                pool.close()
+                pool.join()
+            finally:
+                pool.terminate()
         else:
             resultList = list()
             for p in params:
                 sourceReader, dataRef = p
-                resultList.append(sourceReader.readSrc(dataRef))
+                result = sourceReader.readSrc(dataRef)
+                resultList.append(packReadResult(result) if columnar else result)
 
         ssVisit = dict()
         mlVisit = dict()
@@ -582,21 +786,187 @@ class MosaicTask(pipeBase.CmdLineTask):
                     ssVisit[dataId["visit"]] = list()
                     mlVisit[dataId["visit"]] = list()
 
-                for s in sources:
-                    ssVisit[dataId["visit"]].append(s)
+                if columnar:
+                    ssVisit[dataId["visit"]].append(sources)
+                    mlVisit[dataId["visit"]].append(matches)
+                else:
+                    for s in sources:
+                        ssVisit[dataId["visit"]].append(s)
 
-                for m in matches:
-                    mlVisit[dataId["visit"]].append(m)
+                    for m in matches:
+                        mlVisit[dataId["visit"]].append(m)
 
                 for dataRef in dataRefList:
                     if dataRef.dataId == dataId:
                         dataRefListUsed.append(dataRef)
 
-        for visit in ssVisit:
-            sourceSet.append(ssVisit[visit])
-            matchList.append(mlVisit[visit])
+        if columnar:
+            # One SourceArrays of the sources, and one pair of the matches, per visit
+            concatenate = measMosaic.SourceArrays.concatenate
+            for visit in ssVisit:
+                ssVisit[visit] = concatenate(ssVisit[visit])
+                mlVisit[visit] = (concatenate([ref for ref, src in mlVisit[visit]]),
+                                  concatenate([src for ref, src in mlVisit[visit]]))
 
-        return sourceSet, matchList, dataRefListUsed
+        return ssVisit, mlVisit, dataRefListUsed
+
+    def readAndMergeCatalog(self, dataRefList, d_lim, ct=None, numCoresForReadSource=1, readTimeout=9999,
+                            verbose=False):
+        """Read catalogs, grouping the sources of each visit as soon as it is read
+
+        The result is the same as from readCatalog followed by mergeCatalog, but
+        matching overlaps with reading, and the catalogs of a visit are not kept
+        once they have been added to a SourceGroupBuilder.  Visits are added in
+        the order readCatalog gives them, i.e. in order of their first CCD read,
+        so a visit completed early waits for those before it.  With
+        numCoresForReadSource > 1, readTimeout applies to each CCD.
+
+        Returns allMat, allSource and the list of dataRefs read.
+        """
+        self.log.info("Reading and merging catalogs ...")
+        self.log.info("Use %d cores for reading source catalog" % (numCoresForReadSource))
+
+        sourceReader = SourceReader(ct, self.config)
+
+        params = list()
+        numToRead = dict()
+        for dataRef in dataRefList:
+            params.append((sourceReader, dataRef))
+            visit = dataRef.dataId["visit"]
+            numToRead[visit] = numToRead.get(visit, 0) + 1
+
+        pool = None
+        try:
+            if numCoresForReadSource > 1:
+                pool = multiprocessing.Pool(processes=numCoresForReadSource, maxtasksperchild=1)
+                results = pool.imap(Worker(), params)
+                resultList = (unpackReadResult(results.next(readTimeout)) for p in params)
+            else:
+                resultList = (sourceReader.readSrc(dataRef) for sourceReader, dataRef in params)
+
+            builder = measMosaic.SourceGroupBuilder(d_lim, self.config.sourceMergeMode,
+                                                    self.config.numMatchThreads)
+            ssVisit = collections.OrderedDict()
+            mlVisit = dict()
+            dataRefListUsed = list()
+            for dataId, result in resultList:
+                sources, matches, wcs = result
+                visit = dataId["visit"]
+                numToRead[visit] -= 1
+                if sources is not None:
+                    if visit not in ssVisit:
+                        ssVisit[visit] = list()
+                        mlVisit[visit] = list()
+                    ssVisit[visit].extend(sources)
+                    mlVisit[visit].extend(matches)
+
+                    for dataRef in dataRefList:
+                        if dataRef.dataId == dataId:
+                            dataRefListUsed.append(dataRef)
+
+                while ssVisit:
+                    visit = next(iter(ssVisit))
+                    if numToRead[visit] > 0:
+                        break
+                    builder.addVisit(ssVisit.pop(visit), mlVisit.pop(visit))
+                    if verbose:
+                        self.log.info("Merged visit %d" % (visit))
+
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            # Do not leave workers behind if reading or merging raised
+            if pool is not None:
+                pool.terminate()
+
+        if builder.getNumVisits() == 0:
+            raise RuntimeError("No reference source matches found")
+
+        allMat = builder.getMatchTree().mergeMat()
+        self.log.info("# of allMat : %d" % self.countObsInSourceGroup(allMat))
+        self.log.info("len(allMat) = %d" % len(allMat))
+
+        allSource = builder.getSourceTree().mergeSource(self.config.numSourceMerge)
+        self.log.info("# of allSource : %d" % self.countObsInSourceGroup(allSource))
+        self.log.info("len(allSource) = %d" % len(allSource))
+
+        return allMat, allSource, dataRefListUsed
+
+    def getReaderConfig(self, ct):
+        """Return the settings that change what SourceReader produces
+
+        Catalogs saved for the incremental mode are only reused if these match.
+        """
+        names = ("cellSize", "nStarPerCell", "minNumMatch", "includeSaturated", "doColorTerms",
+                 "columnarCatalogs", "photoCatName", "extendednessForStarSelection", "saturatedForStarSelection",
+                 "psfStarForStarSelection", "calibStarForStarSelection", "parentForStarSelection",
+                 "nChildForStarSelection", "srcSchemaMap", "flagsToAlias")
+        readerConfig = dict((name, repr(getattr(self.config, name))) for name in names)
+        readerConfig["refDataset"] = self.config.loadAstrom.ref_dataset_name
+        readerConfig["colorterm"] = str(ct)
+
+        return readerConfig
+
+    def readCatalogIncremental(self, dataRefList, tract, ct=None, numCoresForReadSource=1, readTimeout=9999,
+                               verbose=False):
+        """Read catalogs, reusing those saved by a previous run on this tract
+
+        Only visits with CCDs that the previous run did not read (because
+        they are new, or their reading failed) or whose catalog files changed
+        since are read; the others are taken from the saved state.  Visits
+        that are no longer in dataRefList are dropped from the state, which is
+        then saved for the next run.  The return values are the same as for
+        readCatalog, in the same order.
+
+        Only the reading is incremental: the fit itself is redone from all the
+        catalogs, as every coefficient is coupled to all the others.
+        """
+        if not os.path.isdir(self.outputDir):
+            os.makedirs(self.outputDir)
+        filename = os.path.join(self.outputDir, self.config.incrementalStateFile)
+        readerConfig = self.getReaderConfig(ct)
+
+        state = None
+        if os.path.exists(filename):
+            state = MosaicState.read(filename)
+            if not state.isCompatible(tract, readerConfig):
+                self.log.warn("Ignoring %s: it was made for another tract or reader configuration" %
+                              (filename))
+                state = None
+        if state is None:
+            state = MosaicState(tract, readerConfig)
+
+        state.select(set(dataRef.dataId["visit"] for dataRef in dataRefList))
+        signatures = [self.getCatalogSignature(dataRef) for dataRef in dataRefList]
+        visitsToRead = state.getVisitsToRead(dataRefList, signatures)
+        toRead = [i for i, dataRef in enumerate(dataRefList) if dataRef.dataId["visit"] in visitsToRead]
+        dataRefListToRead = [dataRefList[i] for i in toRead]
+        self.log.info("Reusing %d visits; reading %d visits" %
+                      (len(set(state.dataIds) - visitsToRead), len(visitsToRead)))
+
+        ssVisit, mlVisit, dataRefListNew = self.readCatalogByVisit(dataRefListToRead, ct,
+                                                                   numCoresForReadSource, readTimeout, verbose)
+        state.update(dataRefListToRead, [signatures[i] for i in toRead], ssVisit, mlVisit, dataRefListNew)
+        state.write(filename)
+
+        return state.getCatalogs(dataRefList)
+
+    def getCatalogSignature(self, dataRef):
+        """Return the modification times and sizes of the src and srcMatch files of dataRef
+
+        A catalog regenerated under the same dataId changes its signature.  The
+        signature is None, so that the dataRef is always read, if the files
+        cannot be found.
+        """
+        try:
+            signature = list()
+            for datasetType in ("src", "srcMatch"):
+                stat = os.stat(dataRef.get(datasetType + "_filename")[0])
+                signature.append((stat.st_mtime, stat.st_size))
+            return tuple(signature)
+        except Exception:
+            return None
 
     def countObsInSourceGroup(self, sg):
         num = 0
@@ -606,6 +976,8 @@ class MosaicTask(pipeBase.CmdLineTask):
         return num
 
     def mergeCatalog(self, sourceSet, matchList, ccdSet, d_lim):
+        if self.config.columnarCatalogs:
+            return self.mergeCatalogArrays(sourceSet, matchList, d_lim)
 
         self.log.info("Creating kd-tree for matched catalog ...")
         self.log.info("len(matchList) = " + str(len(matchList)) + " " +
@@ -618,13 +990,49 @@ class MosaicTask(pipeBase.CmdLineTask):
         self.log.info("Creating kd-tree for source catalog ...")
         self.log.info("len(sourceSet) = " + str(len(sourceSet)) + " " +
                       str([len(sources) for sources in sourceSet]))
-        rootSource = measMosaic.kdtreeSource(sourceSet, rootMat, ccdSet, d_lim)
+        if self.config.sourceMergeMode == "fof":
+            rootSource = measMosaic.fofSource(sourceSet, rootMat, d_lim, self.config.numMatchThreads)
+        else:
+            rootSource = measMosaic.kdtreeSource(sourceSet, rootMat, ccdSet, d_lim,
+                                                 self.config.numMatchThreads)
         allSource = rootSource.mergeSource(self.config.numSourceMerge)
         self.log.info("# of allSource : %d" % self.countObsInSourceGroup(allSource))
         self.log.info("len(allSource) = %d" % len(allSource))
 
         return allMat, allSource
 
+    def mergeCatalogArrays(self, sourceSet, matchList, d_lim):
+        """Group the sources and matches read with columnarCatalogs
+
+        sourceSet has a SourceArrays of the sources of each visit, and
+        matchList a pair of SourceArrays of the reference objects and the
+        sources matched to them.  The groups are those of mergeCatalog, and
+        only their members are made into Sources.
+        """
+        self.log.info("Grouping matched catalog ...")
+        self.log.info("len(matchList) = " + str(len(matchList)) + " " +
+                      str([len(src) for ref, src in matchList]))
+        concatenate = measMosaic.SourceArrays.concatenate
+        allMatArrays = measMosaic.mergeMatArrays(concatenate([ref for ref, src in matchList]),
+                                                 concatenate([src for ref, src in matchList]))
+        allMat = measMosaic.sourceGroupFromArrays(allMatArrays)
+        self.log.info("# of allMat : %d" % self.countObsInSourceGroup(allMat))
+        self.log.info("len(allMat) = %d" % len(allMat))
+
+        self.log.info("Grouping source catalog ...")
+        self.log.info("len(sourceSet) = " + str(len(sourceSet)) + " " +
+                      str([len(sources) for sources in sourceSet]))
+        # The sources of each visit are contiguous, as mergeSourceArrays requires
+        allSourceArrays = measMosaic.mergeSourceArrays(concatenate(sourceSet), allMatArrays, d_lim,
+                                                       self.config.sourceMergeMode,
+                                                       self.config.numSourceMerge,
+                                                       self.config.numMatchThreads)
+        allSource = measMosaic.sourceGroupFromArrays(allSourceArrays)
+        self.log.info("# of allSource : %d" % self.countObsInSourceGroup(allSource))
+        self.log.info("len(allSource) = %d" % len(allSource))
+
+        return allMat, allSource
+
     def writeNewWcs(self, dataRefList):
         self.log.info("Write New WCS ...")
         for dataRef in dataRefList:
@@ -700,9 +1108,13 @@ class MosaicTask(pipeBase.CmdLineTask):
             except Exception as e:
                 print("failed to read Wcs for PhotoCalib: %s" % (e))
                 continue
+            # Persist a Chebyshev approximation of the Jacobian, so that
+            # evaluating the PhotoCalib doesn't go through the Wcs point by
+            # point.
             bf = measMosaic.FluxFitBoundedField(bbox, newP, wcs,
                                                 zeroPoint=constantPhotoCalib.getInstFluxAtZeroMagnitude(),
-                                                nQuarter=nQuarter)
+                                                nQuarter=nQuarter,
+                                                jacobian=measMosaic.fitJacobian(wcs, bbox))
             varyingPhotoCalib = afwImage.PhotoCalib(constantPhotoCalib.getCalibrationMean(),
                                                     constantPhotoCalib.getCalibrationErr(),
                                                     bf,
@@ -744,75 +1156,99 @@ class MosaicTask(pipeBase.CmdLineTask):
         # In this method, determine median magnitude difference between visits and
         # flag (set flux to negative value to be flagged as bad object) objects which
         # show large magnitude difference from median value.
-        visits = list(wcsDic.keys())
-        for j in range(len(visits) - 1):
-            visit_ref = visits[j]
-            for i in range(j + 1, len(visits)):
-                visit_targ = visits[i]
-                refs = list()
-                targs = list()
-                mref  = list()
-                mtarg = list()
-                for mm in allMat:
-                    j_ref = -1
-                    j_targ = -1
-                    for k in range(1, len(mm)):
-                        if mm[k].getExp() == visit_ref:
-                            j_ref = k
-                        elif mm[k].getExp() == visit_targ:
-                            j_targ = k
-                    if j_ref != -1 and j_targ != -1 and mm[j_ref].getFlux() > 0 and mm[j_targ].getFlux() > 0:
-                        refs.append(mm[j_ref])
-                        targs.append(mm[j_targ])
-                        mref.append(mm[j_ref].getFlux())
-                        mtarg.append(mm[j_targ].getFlux())
-                for ss in allSource:
-                    j_ref = -1
-                    j_targ = -1
-                    for k in range(1, len(ss)):
-                        if ss[k].getExp() == visit_ref:
-                            j_ref = k
-                        elif ss[k].getExp() == visit_targ:
-                            j_targ = k
-                    if j_ref != -1 and j_targ != -1 and ss[j_ref].getFlux() > 0 and ss[j_targ].getFlux() > 0:
-                        refs.append(ss[j_ref])
-                        targs.append(ss[j_targ])
-                        mref.append(ss[j_ref].getFlux())
-                        mtarg.append(ss[j_targ].getFlux())
-
-                # There is no overlapping sources
-                if len(mref) < 10:
-                    print("%d %d" % (visit_ref, visit_targ))
-                    continue
-
-                mref = -2.5*numpy.log10(mref)
-                mtarg = -2.5*numpy.log10(mtarg)
-
-                dm = mtarg - mref
-                med = numpy.median(dm)
-                Q1 = numpy.percentile(dm, 10)
-                Q3 = numpy.percentile(dm, 90)
-                SIQR = 0.5*(Q3 - Q1)
-
-                del dm
-
-                ngood = 0
-                nbad  = 0
-                for mr, mt, ref, targ in zip(mref, mtarg, refs, targs):
-                    if math.fabs(mt-mr-med) > 3.0*SIQR:
-                        ref.setFlux(-9999)
-                        targ.setFlux(-9999)
-                        nbad += 1
-                    else:
-                        ngood += 1
-
-                print("visit_ref visit_targ med SIQR ngood nbad")
-                print("%10d %10d %6.3f %5.3f %5d %5d" % (visit_ref, visit_targ, med, SIQR, ngood, nbad))
-
-                del mref
-                del mtarg
-                del refs
-                del targs
+        return measMosaic.flagSuspect(allMat, allSource, wcsDic, self.config.numMatchThreads)
+
+    def makeObsVec(self, name, sg, wcsDic, ccdSet):
+        timing = measMosaic.ObsVecTiming()
+        obsVec = measMosaic.obsVecFromSourceGroup(sg, wcsDic, ccdSet, self.config.numMatchThreads, timing)
+        self.log.info("Made %s of %d in %.2f s (prepare %.2f s, build %.2f s)" %
+                      (name, len(obsVec), timing.total, timing.prepare, timing.build))
+        return obsVec
+
+    def getVisitsByFilter(self, dataRefList):
+        visitsByFilter = dict()
+        for dataRef in dataRefList:
+            visitsByFilter.setdefault(dataRef.dataId["filter"], set()).add(dataRef.dataId["visit"])
+        return visitsByFilter
+
+    def getRefFluxes(self, matchList):
+        """Return the reference flux and error of each matched source, keyed by (visit, ccd, id)
+
+        The group of a reference object only keeps the flux in the filter of
+        the first visit in which it was matched, so in multiBand mode those of
+        the other filters are taken from the matches.
+        """
+        refFluxes = dict()
+        if self.config.columnarCatalogs:
+            for ref, src in matchList:
+                refFluxes.update(zip(zip(src.exp.tolist(), src.chip.tolist(), src.id.tolist()),
+                                     zip(ref.flux.tolist(), ref.fluxErr.tolist())))
+            return refFluxes
+        for matches in matchList:
+            for ref, src in matches:
+                refFluxes[(src.getExp(), src.getChip(), src.getId())] = (ref.getFlux(), ref.getFluxErr())
+        return refFluxes
+
+    def selectBand(self, visits, dataRefList, matchVec, sourceVec, wcsDic, ccdSet, refFluxes):
+        """Select the observations of the visits of one filter for its flux fit
+
+        The observations are copies, so that matchVec and sourceVec are left
+        as they are.  Their exposure and CCD indices are renumbered for the
+        visits and CCDs of the filter, and the catalog magnitudes of the
+        matches set to those in the filter.  An observation is only in one
+        filter, so the flux fits of different filters can run at the same time.
+        """
+        bandWcsDic = dict((visit, wcsDic[visit]) for visit in wcsDic if visit in visits)
+        ccds = set(dataRef.dataId["ccd"] for dataRef in dataRefList)
+        bandCcdSet = dict((ichip, ccdSet[ichip]) for ichip in ccdSet if ichip in ccds)
+        bandMatchVec = [measMosaic.Obs(m) for m in matchVec if m.iexp in bandWcsDic]
+        bandSourceVec = [measMosaic.Obs(s) for s in sourceVec if s.iexp in bandWcsDic]
+
+        jexp = dict((iexp, j) for j, iexp in enumerate(sorted(bandWcsDic)))
+        jchip = dict((ichip, j) for j, ichip in enumerate(sorted(bandCcdSet)))
+        for obsVec in (bandMatchVec, bandSourceVec):
+            for o in obsVec:
+                o.jexp = jexp[o.iexp]
+                o.jchip = jchip[o.ichip]
+
+        M_LN10 = math.log(10)
+        for m in bandMatchVec:
+            flux, fluxErr = refFluxes.get((m.iexp, m.ichip, m.id), (0.0, 0.0))
+            if flux > 0.0 and fluxErr > 0.0:
+                m.mag_cat = -2.5*math.log10(flux)
+                m.err_cat = 2.5/M_LN10*fluxErr/flux
+            else:
+                m.mag_cat = -9999
+                m.err_cat = -9999
+            m.mag0 = m.mag_cat
+
+        return pipeBase.Struct(matchVec=bandMatchVec, sourceVec=bandSourceVec, wcsDic=bandWcsDic,
+                               ccdSet=bandCcdSet)
+
+    def solveFlux(self, matchVec, nmatch, sourceVec, nsource, wcsDic, ccdSet):
+        startTime = time.time()
+        ffpSet = {}
+        for visit in wcsDic:
+            ffp = measMosaic.FluxFitParams(self.config.fluxFitOrder, self.config.fluxFitAbsolute,
+                                           self.config.chebyshev)
+            u_max, v_max = mosaicUtils.getExtent(matchVec)
+            ffp.u_max = (math.floor(u_max/10.0) + 1)*10
+            ffp.v_max = (math.floor(v_max/10.0) + 1)*10
+            ffpSet[visit] = ffp
+
+        fexp = {}
+        fchip = {}
+
+        iteration = measMosaic.FluxFitIteration()
+        iteration.maxIter = self.config.fluxFitMaxIter
+        iteration.chi2Tol = self.config.fluxFitChi2Tol
+        iteration.magTol = self.config.fluxFitMagTol
+        iteration.maxReject = self.config.fluxFitMaxReject
+        matchVec, sourceVec, wcsDic, ccdSet, fexp, fchip, ffpSet = measMosaic.fluxFit(self.config.fluxFitAbsolute, self.config.commonFluxCorr, matchVec, nmatch, sourceVec, nsource, wcsDic, ccdSet, fexp, fchip, ffpSet, self.config.fluxFitSolveCcd, self.config.fluxFitMaxChurn, iteration)
+
+        return pipeBase.Struct(matchVec=matchVec, sourceVec=sourceVec, wcsDic=wcsDic, ccdSet=ccdSet,
+                               fexp=fexp, fchip=fchip, ffpSet=ffpSet, iteration=iteration,
+                               fitTime=time.time() - startTime)
 
     def checkOverlapWithTract(self, tractInfo, dataRefList, verbose=False):
         dataRefListExists = list()
@@ -875,12 +1311,32 @@ class MosaicTask(pipeBase.CmdLineTask):
 
         dataRefListOverlapWithTract, dataRefListToUse = self.checkOverlapWithTract(tractInfo, dataRefList)
 
-        sourceSet, matchList, dataRefListUsed = self.readCatalog(dataRefListToUse, ct, numCoresForReadSource,
-                                                                 readTimeout, verbose)
-        if not matchList:
-            raise RuntimeError("No reference source matches found")
+        d_lim = afwGeom.Angle(self.config.radXMatch, afwGeom.arcseconds)
+        startTime = time.time()
+        runStartTime = startTime
+        streaming = self.config.streamCatalogs and not self.config.incremental and not self.config.multiBand
+        if streaming:
+            allMat, allSource, dataRefListUsed = self.readAndMergeCatalog(dataRefListToUse, d_lim, ct,
+                                                                          numCoresForReadSource, readTimeout,
+                                                                          verbose)
+        else:
+            if self.config.incremental:
+                sourceSet, matchList, dataRefListUsed = self.readCatalogIncremental(dataRefListToUse,
+                                                                                    tractInfo.getId(), ct,
+                                                                                    numCoresForReadSource,
+                                                                                    readTimeout, verbose)
+            else:
+                sourceSet, matchList, dataRefListUsed = self.readCatalog(dataRefListToUse, ct,
+                                                                         numCoresForReadSource, readTimeout,
+                                                                         verbose)
+            if not matchList:
+                raise RuntimeError("No reference source matches found")
 
         dataRefListToOutput = list(set(dataRefListUsed) & set(dataRefListOverlapWithTract))
+        if self.config.multiBand:
+            visitsByFilter = self.getVisitsByFilter(dataRefListUsed)
+            refFluxes = self.getRefFluxes(matchList)
+            self.log.info("Filters : " + ", ".join(sorted(visitsByFilter)))
 
         ccdSet = self.readCcd(dataRefListUsed)
 
@@ -902,38 +1358,48 @@ class MosaicTask(pipeBase.CmdLineTask):
         self.log.info("frameIds : " + str(list(wcsDic.keys())))
         self.log.info("ccdIds : " + str(list(ccdSet.keys())))
 
-        d_lim = afwGeom.Angle(self.config.radXMatch, afwGeom.arcseconds)
         if debug:
             self.log.info("d_lim : %f" % d_lim)
 
-        allMat, allSource =self.mergeCatalog(sourceSet, matchList, ccdSet, d_lim)
+        if not streaming:
+            allMat, allSource = self.mergeCatalog(sourceSet, matchList, ccdSet, d_lim)
+        # ru_maxrss is in kB on Linux
+        self.log.info("Read and merged catalogs in %.1f s; peak RSS %.0f MB" %
+                      (time.time() - startTime, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0))
 
         self.log.info("Flag suspect objects")
-        measMosaic.flagSuspect(allMat, allSource, wcsDic)
+        if self.config.multiBand:
+            # Magnitudes in different filters differ by the colors of the
+            # objects, so only compare visits in the same filter
+            for filterName in sorted(visitsByFilter):
+                self.flagSuspect(allMat, allSource, dict((visit, wcsDic[visit]) for visit in wcsDic
+                                                         if visit in visitsByFilter[filterName]))
+        else:
+            self.flagSuspect(allMat, allSource, wcsDic)
 
         if self.config.clipSourcesOutsideTract:
             tractBBox = afwGeom.Box2D(tractInfo.getBBox())
             tractWcs = tractInfo.getWcs()
-            allSourceClipped = [ss for ss in allSource if tractBBox.contains(tractWcs.skyToPixel(ss[0].getSky()))]
+            allSourceArrays = measMosaic.sourceGroupToArrays(allSource)
+            inside = measMosaic.getGroupsInBox(allSourceArrays, tractWcs, tractBBox)
+            allSourceClipped = measMosaic.selectSourceGroups(allSource, inside)
             self.log.info("Num of allSources: %d" % (len(allSource)))
             self.log.info("Num of clipped allSources: %d" % (len(allSourceClipped)))
+            self.log.info("# of clipped allSource : %d" % (mosaicUtils.getNumObs(allSourceArrays)[inside].sum()))
             allSource = allSourceClipped
 
         self.log.info("Make obsVec")
         nmatch  = len(allMat)
         nsource = len(allSource)
-        matchVec  = measMosaic.obsVecFromSourceGroup(allMat, wcsDic, ccdSet)
-        sourceVec = measMosaic.obsVecFromSourceGroup(allSource, wcsDic, ccdSet)
+        matchVec  = self.makeObsVec("matchVec", allMat, wcsDic, ccdSet)
+        sourceVec = self.makeObsVec("sourceVec", allSource, wcsDic, ccdSet)
 
         self.log.info("Solve mosaic ...")
+        startTime = time.time()
         order = self.config.fittingOrder
         internal = self.config.internalFitting
         solveCcd = self.config.solveCcd
         allowRotation = self.config.allowRotation
-        fluxFitOrder = self.config.fluxFitOrder
-        chebyshev = self.config.chebyshev
-        absolute = self.config.fluxFitAbsolute
-        solveCcdScale = self.config.fluxFitSolveCcd
         catRMS = self.config.catRMS
 
         if not internal:
@@ -1003,34 +1469,89 @@ class MosaicTask(pipeBase.CmdLineTask):
 
             del wcsAll
 
-        if self.config.doSolveFlux:
-
-            ffpSet = {}
-            for visit in wcsDic:
-                ffp = measMosaic.FluxFitParams(fluxFitOrder, absolute, chebyshev)
-                u_max, v_max = mosaicUtils.getExtent(matchVec)
-                ffp.u_max = (math.floor(u_max/10.0) + 1)*10
-                ffp.v_max = (math.floor(v_max/10.0) + 1)*10
-                ffpSet[visit] = ffp
-
-            fexp = {}
-            fchip = {}
-
-            matchVec, sourceVec, wcsDic, ccdSet, fexp, fchip, ffpSet = measMosaic.fluxFit(absolute, self.config.commonFluxCorr, matchVec, len(matchVec), sourceVec, len(sourceVec), wcsDic, ccdSet, fexp, fchip, ffpSet, solveCcdScale)
-
-            self.ffpSet = ffpSet
-            self.fexp = fexp
-            self.fchip = fchip
+        self.log.info("Solved mosaic in %.1f s" % (time.time() - startTime))
 
-            self.writeFcr(dataRefListToOutput)
-
-            if diagnostics:
-                self.outputDiagFlux()
-
-        if diagnostics and self.config.doSolveWcs and self.config.doSolveFlux:
-            if len(sourceVec) != 0:
-                mosaicUtils.writeCatalog(coeffSet, ffpSet, fexp, fchip, matchVec, sourceVec,
-                                         os.path.join(self.outputDir, "catalog.fits"))
+        if self.config.doSolveFlux:
+            startTime = time.time()
+            if self.config.multiBand:
+                filterNames = sorted(visitsByFilter)
+                bands = [self.selectBand(visitsByFilter[filterName],
+                                         [dataRef for dataRef in dataRefListUsed
+                                          if dataRef.dataId["filter"] == filterName],
+                                         matchVec, sourceVec, wcsDic, ccdSet, refFluxes)
+                         for filterName in filterNames]
+                numThreads = min(self.config.numFluxFitThreads or len(bands), len(bands))
+                pool = multiprocessing.pool.ThreadPool(processes=numThreads)
+                try:
+                    # The star indices are still those of the groups of all filters
+                    fluxResults = pool.map(lambda band: self.solveFlux(band.matchVec, len(matchVec),
+                                                                       band.sourceVec, len(sourceVec),
+                                                                       band.wcsDic, band.ccdSet),
+                                           bands)
+                    pool.close()
+                    pool.join()
+                finally:
+                    pool.terminate()
+            else:
+                filterNames = [None]
+                bands = [pipeBase.Struct(matchVec=matchVec, sourceVec=sourceVec, wcsDic=wcsDic, ccdSet=ccdSet)]
+                fluxResults = [self.solveFlux(matchVec, len(matchVec), sourceVec, len(sourceVec), wcsDic,
+                                              ccdSet)]
+            self.log.info("Solved flux correction for %d filter(s) in %.1f s" %
+                          (len(bands), time.time() - startTime))
+            if self.config.multiBand:
+                # Separate runs would each repeat the read, the merge and the
+                # astrometric solve, then solve their own filter in turn
+                sharedTime = startTime - runStartTime
+                wallTime = time.time() - runStartTime
+                separateTime = len(bands)*sharedTime + sum(result.fitTime for result in fluxResults)
+                self.metadata.set("multiBandWallTime", wallTime)
+                self.metadata.set("singleBandWallTimeEstimate", separateTime)
+                self.log.info("multiBand: %.1f s to here for %d filters; %d single-filter runs would take "
+                              "about %.1f s" % (wallTime, len(bands), len(bands), separateTime))
+
+            tractOutputDir = self.outputDir
+            for filterName, band, result in zip(filterNames, bands, fluxResults):
+                iteration = result.iteration
+                if filterName is None:
+                    self.metadata.set("fluxFitNumIter", iteration.nIter)
+                    self.metadata.set("fluxFitStopReason", iteration.reason)
+                    self.log.info("Flux fit stopped after %d iterations (%s)" %
+                                  (iteration.nIter, iteration.reason))
+                    dataRefListBand = dataRefListToOutput
+                else:
+                    self.metadata.add("fluxFitFilter", filterName)
+                    self.metadata.add("fluxFitNumIter", iteration.nIter)
+                    self.metadata.add("fluxFitStopReason", iteration.reason)
+                    self.log.info("Flux fit for %s stopped after %d iterations (%s)" %
+                                  (filterName, iteration.nIter, iteration.reason))
+                    dataRefListBand = [dataRef for dataRef in dataRefListToOutput
+                                       if dataRef.dataId["filter"] == filterName]
+                    self.matchVec = band.matchVec
+                    self.sourceVec = band.sourceVec
+                    self.wcsDic = band.wcsDic
+                    self.ccdSet = band.ccdSet
+                    self.outputDir = os.path.join(tractOutputDir, filterName)
+
+                self.ffpSet = result.ffpSet
+                self.fexp = result.fexp
+                self.fchip = result.fchip
+
+                self.writeFcr(dataRefListBand)
+
+                if diagnostics:
+                    self.outputDiagFlux()
+
+                if diagnostics and self.config.doSolveWcs and len(band.sourceVec) != 0:
+                    mosaicUtils.writeCatalog(coeffSet, self.ffpSet, self.fexp, self.fchip, band.matchVec,
+                                             band.sourceVec, os.path.join(self.outputDir, "catalog.fits"))
+
+            if self.config.multiBand:
+                self.matchVec = matchVec
+                self.sourceVec = sourceVec
+                self.wcsDic = wcsDic
+                self.ccdSet = ccdSet
+                self.outputDir = tractOutputDir
 
         return list(wcsDic.keys())
 
@@ -1044,12 +1565,17 @@ class MosaicTask(pipeBase.CmdLineTask):
 
         filters = set(dataRef.dataId['filter'] for dataRef in dataRefList)
 
-        if len(filters) != 1:
+        if len(filters) != 1 and not self.config.multiBand:
             self.log.warn("There are %d filters in input frames: %s" % (len(filters), ", ".join(filters)))
             if not self.config.allowMixedFilters:
                 raise pipeBase.TaskError("Multiple filters found: %s" % (filters,))
 
-        if self.config.doColorTerms and self.config.photoCatName:
+        if self.config.doColorTerms and self.config.photoCatName and self.config.multiBand:
+            ct = dict()
+            for filterName in sorted(filters):
+                ct[filterName] = self.config.colorterms.getColorterm(filterName, self.config.photoCatName)
+                self.log.info("color term for filter %s: %s" % (filterName, ct[filterName]))
+        elif self.config.doColorTerms and self.config.photoCatName:
             filterName = sorted(filters)[0]
             self.log.info("Using color terms for filter %s" % filterName)
             ct = self.config.colorterms.getColorterm(filterName, self.config.photoCatName)
@@ -185,6 +185,7 @@ void declareObs(py::module &mod) {
     cls.def(py::init<int, double, double, double, double, int, int>(), "id"_a, "ra"_a, "dec"_a, "x"_a, "y"_a,
             "ichip"_a, "iexp"_a);
     cls.def(py::init<int, double, double, int, int>(), "id"_a, "ra"_a, "dec"_a, "ichip"_a, "iexp"_a);
+    cls.def(py::init<Class const &>(), "other"_a);
 
     cls.def("setUV", &Class::setUV);
     cls.def("setXiEta", &Class::setXiEta);
@@ -225,12 +226,128 @@ void declareKDTree(py::module &mod) {
     cls.def("findNearest", &Class::findNearest);
     cls.def("distance", &Class::distance);
 }
+
+void declareFlatKDTree(py::module &mod) {
+    using Class = FlatKDTree;
+    using PyClass = py::class_<Class, std::shared_ptr<Class>>;
+
+    PyClass cls(mod, "FlatKDTree");
+
+    cls.def(py::init<ndarray::Array<double const, 1> const &, ndarray::Array<double const, 1> const &>(),
+            "ra"_a, "dec"_a);
+
+    cls.def("size", &Class::size);
+    cls.def("__len__", &Class::size);
+    cls.def("findNearest", (int (Class::*)(lsst::afw::geom::SpherePoint const &, lsst::afw::geom::Angle) const) &
+                                   Class::findNearest,
+            "sky"_a, "radius"_a);
+    cls.def("findWithin", (std::vector<int>(Class::*)(lsst::afw::geom::SpherePoint const &,
+                                                       lsst::afw::geom::Angle) const) &
+                                  Class::findWithin,
+            "sky"_a, "radius"_a);
+}
+
+void declareSourceGroupTree(py::module &mod) {
+    using Class = SourceGroupTree;
+    using PyClass = py::class_<Class, std::shared_ptr<Class>>;
+
+    PyClass cls(mod, "SourceGroupTree");
+
+    cls.def_readonly("groups", &Class::groups);
+
+    cls.def(py::init<SourceGroup, bool>(), "groups"_a, "indexMembers"_a = false);
+
+    cls.def("count", &Class::count);
+    cls.def("findSource", &Class::findSource);
+    cls.def("contains", &Class::contains);
+    cls.def("findNearest", &Class::findNearest, "s"_a, "d_lim"_a);
+    cls.def("mergeMat", &Class::mergeMat);
+    cls.def("mergeSource", &Class::mergeSource, "minNumMatch"_a = 2);
+}
+
+void declareSourceGroupBuilder(py::module &mod) {
+    using Class = SourceGroupBuilder;
+    using PyClass = py::class_<Class, std::shared_ptr<Class>>;
+
+    PyClass cls(mod, "SourceGroupBuilder");
+
+    cls.def(py::init<lsst::afw::geom::Angle, std::string const &, int>(), "d_lim"_a, "mode"_a = "nearest",
+            "nThreads"_a = 1);
+
+    cls.def("addVisit", &Class::addVisit, "sources"_a, "matches"_a);
+    cls.def("getNumVisits", &Class::getNumVisits);
+    cls.def("getMatchTree", &Class::getMatchTree);
+    cls.def("getSourceTree", &Class::getSourceTree);
+}
+
+template <typename Class, typename PyClass>
+void declareColumns(PyClass &cls) {
+    cls.def(py::init<>());
+
+    cls.def_readwrite("id", &Class::id);
+    cls.def_readwrite("chip", &Class::chip);
+    cls.def_readwrite("exp", &Class::exp);
+    cls.def_readwrite("ra", &Class::ra);
+    cls.def_readwrite("dec", &Class::dec);
+    cls.def_readwrite("x", &Class::x);
+    cls.def_readwrite("xErr", &Class::xErr);
+    cls.def_readwrite("y", &Class::y);
+    cls.def_readwrite("yErr", &Class::yErr);
+    cls.def_readwrite("flux", &Class::flux);
+    cls.def_readwrite("fluxErr", &Class::fluxErr);
+    cls.def_readwrite("astromBad", &Class::astromBad);
+}
+
+void declareSourceArrays(py::module &mod) {
+    using Class = SourceArrays;
+    using PyClass = py::class_<Class, std::shared_ptr<Class>>;
+
+    PyClass cls(mod, "SourceArrays");
+
+    declareColumns<Class>(cls);
+}
+
+void declareSourceGroupArrays(py::module &mod) {
+    using Class = SourceGroupArrays;
+    using PyClass = py::class_<Class, std::shared_ptr<Class>>;
+
+    PyClass cls(mod, "SourceGroupArrays");
+
+    declareColumns<Class>(cls);
+    cls.def_readwrite("offsets", &Class::offsets);
+}
+
+void declareObsVecTiming(py::module &mod) {
+    using Class = ObsVecTiming;
+    using PyClass = py::class_<Class, std::shared_ptr<Class>>;
+
+    PyClass cls(mod, "ObsVecTiming");
+
+    cls.def(py::init<>());
+
+    cls.def_readwrite("prepare", &Class::prepare);
+    cls.def_readwrite("build", &Class::build);
+    cls.def_readwrite("total", &Class::total);
+}
+
+void declareArrayMatch(py::module &mod) {
+    using Class = ArrayMatch;
+    using PyClass = py::class_<Class, std::shared_ptr<Class>>;
+
+    PyClass cls(mod, "ArrayMatch");
+
+    cls.def_readonly("groupId", &Class::groupId);
+    cls.def_readonly("members", &Class::members);
+    cls.def_readonly("offsets", &Class::offsets);
+    cls.def_readonly("refIndex", &Class::refIndex);
+}
 }
 
 PYBIND11_MODULE(mosaicfit, mod) {
     py::module::import("lsst.afw.cameraGeom");
     py::module::import("lsst.afw.geom");
     py::module::import("lsst.afw.image");
+    py::module::import("lsst.afw.math");
     py::module::import("lsst.afw.table");
 
     declareSource(mod);
@@ -238,11 +355,36 @@ PYBIND11_MODULE(mosaicfit, mod) {
     declareCoeff(mod);
     declareObs(mod);
     declareKDTree(mod);
-
-    mod.def("flagSuspect", flagSuspect);
+    declareFlatKDTree(mod);
+    declareSourceGroupTree(mod);
+    declareArrayMatch(mod);
+    declareSourceGroupBuilder(mod);
+    declareSourceArrays(mod);
+    declareSourceGroupArrays(mod);
+    declareObsVecTiming(mod);
+
+    mod.def("flagSuspect", flagSuspect, "allMat"_a, "allSource"_a, "wcsDic"_a, "nThreads"_a = 1);
     mod.def("kdtreeMat", kdtreeMat);
-    mod.def("kdtreeSource", kdtreeSource);
-    mod.def("obsVecFromSourceGroup", obsVecFromSourceGroup);
+    mod.def("kdtreeSource", kdtreeSource, "sourceSet"_a, "rootMat"_a, "ccdSet"_a, "d_lim"_a,
+            "nThreads"_a = 1);
+    mod.def("fofSource", fofSource, "sourceSet"_a, "rootMat"_a, "d_lim"_a, "nThreads"_a = 1);
+    mod.def("matchArrays", matchArrays, "ra"_a, "dec"_a, "visit"_a, "refRa"_a, "refDec"_a, "d_lim"_a,
+            "mode"_a = "nearest", "nThreads"_a = 1);
+    mod.def("sourceSetToArrays", sourceSetToArrays, "ss"_a);
+    mod.def("sourceSetFromArrays", sourceSetFromArrays, "arrays"_a);
+    mod.def("mergeMatArrays", mergeMatArrays, "ref"_a, "src"_a);
+    mod.def("mergeSourceArrays", mergeSourceArrays, "sources"_a, "allMat"_a, "d_lim"_a, "mode"_a = "nearest",
+            "minNumMatch"_a = 2, "nThreads"_a = 1);
+    mod.def("sourceGroupToArrays", sourceGroupToArrays, "sg"_a);
+    mod.def("sourceGroupFromArrays", sourceGroupFromArrays, "arrays"_a);
+    mod.def("selectSourceGroups", selectSourceGroups, "sg"_a, "keep"_a);
+    mod.def("getGroupsInBox", getGroupsInBox, "arrays"_a, "wcs"_a, "bbox"_a);
+    mod.def("obsVecFromSourceGroup",
+            (ObsVec(*)(SourceGroup const &, WcsDic &, CcdSet &, int, ObsVecTiming *))obsVecFromSourceGroup,
+            "all"_a, "wcsDic"_a, "ccdSet"_a, "nThreads"_a = 1, "timing"_a = nullptr);
+    mod.def("obsVecFromSourceGroup",
+            (ObsVec(*)(SourceGroupArrays const &, WcsDic &, CcdSet &, int, ObsVecTiming *))obsVecFromSourceGroup,
+            "all"_a, "wcsDic"_a, "ccdSet"_a, "nThreads"_a = 1, "timing"_a = nullptr);
     // Workaround because solveMosaic_CCD_shot uses in/out arguments of STL container types
     mod.def("solveMosaic_CCD_shot",
             [](int order, int nmatch, ObsVec &matchVec, WcsDic &wcsDic, CcdSet &ccdSet, bool solveCcd = true,
@@ -286,6 +428,13 @@ PYBIND11_MODULE(mosaicfit, mod) {
     mod.def("calculateJacobian",
             (ndarray::Array<double, 1>(*)(afw::geom::SkyWcs const &, ndarray::Array<double const, 1> const &,
                                           ndarray::Array<double const, 1> const &))calculateJacobian);
+    mod.def("calculateJacobian",
+            (double (*)(Coeff::Ptr &, afw::geom::Point2D const &))calculateJacobian, "coeff"_a, "point"_a);
+    mod.def("calculateJacobian",
+            (ndarray::Array<double, 1>(*)(Coeff::Ptr &, ndarray::Array<double const, 1> const &,
+                                          ndarray::Array<double const, 1> const &))calculateJacobian,
+            "coeff"_a, "x"_a, "y"_a);
+    mod.def("fitJacobian", fitJacobian, "wcs"_a, "bbox"_a, "order"_a = 6, "step"_a = 128);
 }
 }
 }
@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 
-from .mosaicfit import Source
+import numpy
+
+from .mosaicfit import Source, SourceArrays, SourceGroupArrays
 
 from lsst.utils import continueClass
 
@@ -14,3 +16,60 @@ class Source:
             self.getFlux(), self.getFluxErr(),
             self.getAstromBad(),
         )
+
+_columnTypes = dict(id=numpy.int64, chip=numpy.int32, exp=numpy.int32,
+                    ra=float, dec=float, x=float, xErr=float, y=float, yErr=float,
+                    flux=float, fluxErr=float, astromBad=bool)
+
+def _makeArrays(cls, columns):
+    """Make a SourceArrays or SourceGroupArrays from a dict of columns"""
+    self = cls()
+    for name, values in columns.items():
+        setattr(self, name, numpy.ascontiguousarray(values, dtype=cls._columnTypes[name]))
+    return self
+
+@continueClass
+class SourceArrays:
+    _columnTypes = _columnTypes
+
+    @classmethod
+    def fromColumns(cls, **columns):
+        """Make from NumPy arrays, or anything convertible to them, named as the columns"""
+        return _makeArrays(cls, columns)
+
+    @classmethod
+    def concatenate(cls, arraysList):
+        """Make from the rows of each of a list of SourceArrays in turn; empty if the list is"""
+        if len(arraysList) == 0:
+            return _makeArrays(cls, dict((name, []) for name in cls._columnTypes))
+        return _makeArrays(cls, dict((name, numpy.concatenate([getattr(a, name) for a in arraysList]))
+                                     for name in cls._columnTypes))
+
+    def getColumns(self):
+        """The columns as a dict of NumPy arrays"""
+        return dict((name, getattr(self, name)) for name in self._columnTypes)
+
+    def __len__(self):
+        return len(self.id)
+
+    def __reduce__(self):
+        return _makeArrays, (self.__class__, self.getColumns())
+
+@continueClass
+class SourceGroupArrays:
+    _columnTypes = dict(_columnTypes, offsets=numpy.int64)
+
+    @classmethod
+    def fromColumns(cls, **columns):
+        """Make from NumPy arrays, or anything convertible to them, named as the columns"""
+        return _makeArrays(cls, columns)
+
+    def getColumns(self):
+        """The columns, and offsets, as a dict of NumPy arrays"""
+        return dict((name, getattr(self, name)) for name in self._columnTypes)
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def __reduce__(self):
+        return _makeArrays, (self.__class__, self.getColumns())
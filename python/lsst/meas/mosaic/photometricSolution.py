@@ -8,6 +8,7 @@ import lsst.afw.geom                    as afwGeom
 import lsst.afw.image                   as afwImage
 import lsst.afw.table                   as afwTable
 from lsst.meas.photocal import PhotoCalTask
+from . import utils as mosaicUtils
 
 class PhotometricSolutionConfig(PhotoCalTask.ConfigClass):
     fluxFitOrder = pexConfig.Field(
@@ -24,35 +25,25 @@ class PhotometricSolutionTask(PhotoCalTask):
     def __init__(self, schema, **kwargs):
         super(PhotometricSolutionTask, self).__init__(schema, **kwargs)
 
-    def getExtent(self, matchVec):
-        u_max = float("-inf")
-        v_max = float("-inf")
-        for m in matchVec:
-            if (math.fabs(m.u) > u_max):
-                u_max = math.fabs(m.u)
-            if (math.fabs(m.v) > v_max):
-                v_max = math.fabs(m.v)
-
-        return u_max, v_max
-
     def decodeCcdExposureId(self, ccdId):
-        return ccdId/200, ccdId%200
-
-    def setCatFlux(self, m, f, key):
-        m[0].set(key, f)
-        return m
-
-    def selectStars(self, matches):
-        sourceList = [m[1] for m in matches]
-        psfKey = sourceList[0].schema.find("calib.psf.used").getKey()
-        extKey = sourceList[0].schema.find("classification.extendedness").getKey()
-        stars = list()
-        for m, s in zip(matches, sourceList):
-            star = ((psfKey is not None and s.get(psfKey)) or
-                    s.get(extKey) < 0.5)
-            if star:
-                stars.append(m)
-        return stars
+        """Return the visit and CCD of a CCD exposure id, or of each of an array of them"""
+        return ccdId//200, ccdId%200
+
+    def matchesToCatalogs(self, matches):
+        """Copy the reference objects and sources of matches to two contiguous catalogs"""
+        refCat = afwTable.SimpleCatalog(matches[0][0].schema)
+        srcCat = afwTable.SourceCatalog(matches[0][1].getTable().clone())
+        refCat.reserve(len(matches))
+        srcCat.reserve(len(matches))
+        refCat.extend([m[0] for m in matches], deep=True)
+        srcCat.extend([m[1] for m in matches], deep=True)
+        return refCat, srcCat
+
+    def selectStars(self, srcCat):
+        """Return whether each source is a star"""
+        psfKey = srcCat.schema.find("calib.psf.used").getKey()
+        extKey = srcCat.schema.find("classification.extendedness").getKey()
+        return numpy.logical_or(srcCat[psfKey], srcCat[extKey] < 0.5)
 
     def run(self, matchLists, filterName, wcsList, butler):
 
@@ -61,57 +52,60 @@ class PhotometricSolutionTask(PhotoCalTask):
         else:
             ct = None
 
-        # Convert matchLists to meas_mosaic specific format
-        mlVisit = dict()
-        for ccdId in matchLists:
-            if matchLists[ccdId] is None:
+        # Convert matchLists to meas_mosaic specific columns, visit by visit
+        ccdIds = numpy.array([ccdId for ccdId in matchLists if matchLists[ccdId] is not None],
+                             dtype=numpy.int64)
+        visits, ccds = self.decodeCcdExposureId(ccdIds)
+        refVisit = dict()
+        srcVisit = dict()
+        for ccdId, visit, ccd in zip(ccdIds.tolist(), visits.tolist(), ccds.tolist()):
+            matches = [m for m in matchLists[ccdId] if m[0] is not None and m[1] is not None]
+            if len(matches) == 0:
                 continue
-            visit, ccd = self.decodeCcdExposureId(ccdId)
-            if visit not in mlVisit:
-                mlVisit[visit] = list()
-            matches = [m for m in matchLists[ccdId] if m[0] is not None]
             keys = self.getKeys(matches[0][1].schema)
             matches = self.selectMatches(matches, keys)
-            matches = self.selectStars(matches)
+            if len(matches) == 0:
+                continue
+            refCat, srcCat = self.matchesToCatalogs(matches)
+            stars = self.selectStars(srcCat)
 
             # Apply color term
-            if ct is not None and len(matches) != 0:
-                refSchema = matches[0][0].schema
-                key_p = refSchema.find(ct.primary).key
-                key_s = refSchema.find(ct.secondary).key
-                key_f = refSchema.find("flux").key
-                refFlux1 = numpy.array([m[0].get(key_p) for m in matches])
-                refFlux2 = numpy.array([m[0].get(key_s) for m in matches])
-                refMag1 = -2.5*numpy.log10(refFlux1)
-                refMag2 = -2.5*numpy.log10(refFlux2)
+            if ct is not None:
+                key_p = refCat.schema.find(ct.primary).key
+                key_s = refCat.schema.find(ct.secondary).key
+                key_f = refCat.schema.find("flux").key
+                refMag1 = -2.5*numpy.log10(refCat[key_p])
+                refMag2 = -2.5*numpy.log10(refCat[key_s])
                 refMag = ct.transformMags(refMag1, refMag2)
                 refFlux = numpy.power(10.0, -0.4*refMag)
-                matches = [self.setCatFlux(m, f, key_f) for m, f in zip(matches, refFlux) if f == f]
+                refCat[key_f][:] = refFlux
+                stars &= (refFlux == refFlux)
+            if not stars.any():
+                continue
 
-            for m in matches:
-                if m[0] is not None and m[1] is not None:
-                    match = (measMosaic.Source(m[0], wcsList[ccdId]), measMosaic.Source(m[1]))
-                    match[1].setExp(visit)
-                    match[1].setChip(ccd)
-                    mlVisit[visit].append(match)
+            refCat = refCat[stars].copy(deep=True)
+            srcCat = srcCat[stars].copy(deep=True)
+            ref, src = mosaicUtils.matchesToArrays(refCat, srcCat, wcsList[ccdId], visit, ccd)
 
+            # Apply Jacobian correction calculated from wcs, as a scale of the flux
+            jacobian = measMosaic.calculateJacobian(wcsList[ccdId], src.x, src.y)
+            src.flux = src.flux*jacobian
+            src.fluxErr = src.fluxErr*jacobian
 
-        matchList = []
-        for visit in mlVisit:
-            matchList.append(mlVisit[visit])
+            refVisit.setdefault(visit, list()).append(ref)
+            srcVisit.setdefault(visit, list()).append(src)
 
-        rootMat = measMosaic.kdtreeMat(matchList)
-        allMat = rootMat.mergeMat()
+        if len(refVisit) == 0:
+            raise RuntimeError("No reference source matches found")
+        allMat = measMosaic.mergeMatArrays(
+            measMosaic.SourceArrays.concatenate([ref for visit in refVisit for ref in refVisit[visit]]),
+            measMosaic.SourceArrays.concatenate([src for visit in srcVisit for src in srcVisit[visit]]))
 
         # Read CCD information
         ccdSet = {}
-        for ccdId in matchLists:
-            if matchLists[ccdId] is None:
-                continue
-            visit, ccd = self.decodeCcdExposureId(ccdId)
-            if ccd not in ccdSet:
-                ccdDev = cameraGeomUtils.findCcd(butler.mapper.camera, cameraGeom.Id(int(ccd)))
-                ccdSet[ccd] = ccdDev
+        for ccd in set(ccds.tolist()):
+            ccdDev = cameraGeomUtils.findCcd(butler.mapper.camera, cameraGeom.Id(int(ccd)))
+            ccdSet[ccd] = ccdDev
 
         # meas_mosaic specific wcs information
         wcsDic = {}
@@ -127,20 +121,15 @@ class PhotometricSolutionTask(PhotoCalTask):
         matchVec  = measMosaic.obsVecFromSourceGroup(allMat, wcsDic, ccdSet)
         sourceVec = []
 
-        # Apply Jocabian correction calculated from wcs
-        for m in matchVec:
-            wcs = wcsList[m.iexp*200+m.ichip]
-            m.mag -= 2.5*math.log10(measMosaic.computeJacobian(wcs, afwGeom.Point2D(m.x, m.y)))
-
         fluxFitOrder = self.config.fluxFitOrder
         absolute = True
         chebyshev = True
         commonFluxCorr = False
         solveCcdScale = True
         ffpSet = {}
+        u_max, v_max = mosaicUtils.getExtent(matchVec)
         for visit in wcsDic:
             ffp = measMosaic.FluxFitParams(fluxFitOrder, absolute, chebyshev)
-            u_max, v_max = self.getExtent(matchVec)
             ffp.u_max = (math.floor(u_max / 10.) + 1) * 10
             ffp.v_max = (math.floor(v_max / 10.) + 1) * 10
             ffpSet[visit] = ffp
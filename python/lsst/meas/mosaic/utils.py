@@ -35,7 +35,7 @@ import lsst.afw.math as afwMath
 from lsst.afw.fits import readMetadata
 from .shimCameraGeom import getCenterInFpPixels, getWidth, getHeight, detPxToFpPxRot, getYaw
 from .fluxfit import FluxFitParams, getFCorImg
-from .mosaicfit import getJImg
+from .mosaicfit import getJImg, Source, SourceArrays
 
 # Use LaTeX to render figure captions? Requires dvipng (not available on lsst-dev).
 USETEX=False
@@ -152,6 +152,25 @@ def clippedStd(a, nStd):
 
     return [std, avg, len(b)]
 
+def getNumObs(groupArrays):
+    """!Return the number of detections in each group of a SourceGroupArrays
+
+    @param[in] groupArrays   an lsst.meas.mosaic SourceGroupArrays
+
+    @return    numpy array of the number of members of each group, less the reference or mean position
+    """
+    return numpy.diff(groupArrays.offsets) - 1
+
+def getGroupIndex(groupArrays):
+    """!Return the index of the group of each member of a SourceGroupArrays
+
+    @param[in] groupArrays   an lsst.meas.mosaic SourceGroupArrays
+
+    @return    numpy array of group indices, one per member
+    """
+    offsets = numpy.asarray(groupArrays.offsets)
+    return numpy.repeat(numpy.arange(len(offsets) - 1), numpy.diff(offsets))
+
 def getExtent(matchVec):
     """!Determine the extent of the matchVec in the Focal Plane
 
@@ -159,15 +178,63 @@ def getExtent(matchVec):
 
     @return    u_max, v_max  the maximum extent of the objects in matchVec in Focal Plane coordinates
     """
-    u_max = float("-inf")
-    v_max = float("-inf")
-    for m in matchVec:
-        if (math.fabs(m.u) > u_max):
-            u_max = math.fabs(m.u)
-        if (math.fabs(m.v) > v_max):
-            v_max = math.fabs(m.v)
+    if len(matchVec) == 0:
+        return float("-inf"), float("-inf")
+    u = numpy.fromiter((m.u for m in matchVec), dtype=float, count=len(matchVec))
+    v = numpy.fromiter((m.v for m in matchVec), dtype=float, count=len(matchVec))
+
+    return numpy.abs(u).max(), numpy.abs(v).max()
+
+def matchesToArrays(refCat, srcCat, wcs, visit, ccd):
+    """!Convert the matches of a CCD, given as catalogs, to columns
+
+    @param[in] refCat    lsst.afw.table.SimpleCatalog of the reference objects, with a "flux" field
+    @param[in] srcCat    lsst.afw.table.SourceCatalog of the sources matched to them, row by row, with
+                         centroid and calib flux slots
+    @param[in] wcs       lsst.afw.geom.SkyWcs of the CCD
+    @param[in] visit     visit of the sources
+    @param[in] ccd       CCD of the sources
 
-    return u_max, v_max
+    @return    ref, src  lsst.meas.mosaic SourceArrays of the reference objects and the sources, with the
+                         values of lsst.meas.mosaic Sources made from the records, for mergeMatArrays
+    """
+    if not refCat.isContiguous():
+        refCat = refCat.copy(deep=True)
+    if not srcCat.isContiguous():
+        srcCat = srcCat.copy(deep=True)
+
+    def getColumn(catalog, name, default):
+        try:
+            return catalog[name]
+        except LookupError:
+            return numpy.full(len(catalog), default)
+
+    n = len(srcCat)
+    refRa = refCat["coord_ra"]
+    refDec = refCat["coord_dec"]
+    if n > 0:
+        refX, refY = wcs.skyToPixelArray(refRa, refDec)
+    else:
+        refX, refY = numpy.empty(0), numpy.empty(0)
+    refFlux = refCat["flux"]
+    ref = SourceArrays.fromColumns(id=refCat["id"], chip=numpy.full(n, Source.UNSET),
+                                   exp=numpy.full(n, Source.UNSET),
+                                   ra=numpy.degrees(refRa), dec=numpy.degrees(refDec),
+                                   x=refX, xErr=numpy.full(n, numpy.nan), y=refY, yErr=numpy.full(n, numpy.nan),
+                                   flux=refFlux, fluxErr=numpy.full(n, numpy.nan),
+                                   astromBad=numpy.logical_not(numpy.isfinite(refFlux)))
+    src = SourceArrays.fromColumns(id=srcCat["id"], chip=numpy.full(n, ccd), exp=numpy.full(n, visit),
+                                   ra=numpy.degrees(srcCat["coord_ra"]), dec=numpy.degrees(srcCat["coord_dec"]),
+                                   x=srcCat["slot_Centroid_x"],
+                                   xErr=getColumn(srcCat, "slot_Centroid_xErr", numpy.nan),
+                                   y=srcCat["slot_Centroid_y"],
+                                   yErr=getColumn(srcCat, "slot_Centroid_yErr", numpy.nan),
+                                   flux=srcCat["slot_CalibFlux_instFlux"],
+                                   fluxErr=getColumn(srcCat, "slot_CalibFlux_instFluxErr", numpy.nan),
+                                   astromBad=numpy.logical_or(getColumn(srcCat, "slot_Centroid_flag", False),
+                                                              getColumn(srcCat, "slot_CalibFlux_flag", False)))
+
+    return ref, src
 
 def getCcdFpExtent(ccdSet):
     """!Determine the extent of the set of CCDs in ccdSet in the Focal Plane for plot limits
@@ -58,13 +58,15 @@ FluxFitBoundedField::FluxFitBoundedField(
     std::shared_ptr<FluxFitParams> const & ffp,
     std::shared_ptr<afw::geom::SkyWcs> const & wcs,
     double zeroPoint,
-    int nQuarter
+    int nQuarter,
+    std::shared_ptr<afw::math::BoundedField> const & jacobian
 ) : afw::math::BoundedField(bbox),
     _ffp(ffp),
     _wcs(wcs),
     _zeroPoint(zeroPoint),
     _nQuarter(nQuarter % 4),
-    _transform()
+    _transform(),
+    _jacobian(jacobian)
 {
     if (bbox.getMinX() != 0 || bbox.getMinY() != 0) {
         // HSC CCD bounding boxes are the only relevant ones, and this saves us
@@ -74,6 +76,12 @@ FluxFitBoundedField::FluxFitBoundedField(
             "FluxFitBoundedField does not support boxes with min != (0, 0)"
         );
     }
+    if (jacobian && jacobian->getBBox() != bbox) {
+        throw LSST_EXCEPT(
+            pex::exceptions::InvalidParameterError,
+            "The Jacobian field must have the bounding box of the FluxFitBoundedField"
+        );
+    }
     if (_nQuarter != 0) {
         auto r = afw::geom::LinearTransform::makeRotation(_nQuarter*90*afw::geom::degrees);
         if (_nQuarter == 2) {
@@ -102,16 +110,178 @@ double FluxFitBoundedField::evaluate(afw::geom::Point2D const & position) const
         }
         r *= std::pow(10.0, -0.4*_ffp->eval(xy.getX(), xy.getY()));
     }
-    if (_wcs) {
+    if (_jacobian) {
+        r *= _jacobian->evaluate(position);
+    } else if (_wcs) {
         r *= calculateJacobian(*_wcs, position);
     }
     return r;
 }
 
+ndarray::Array<double, 1, 1> FluxFitBoundedField::evaluate(ndarray::Array<double const, 1> const & x,
+                                                           ndarray::Array<double const, 1> const & y) const {
+    std::size_t const num = x.getSize<0>();
+    if (y.getSize<0>() != num) {
+        throw LSST_EXCEPT(
+            pex::exceptions::LengthError,
+            (boost::format("Size mismatch: %d vs %d") % num % y.getSize<0>()).str()
+        );
+    }
+    ndarray::Array<double, 1, 1> r = ndarray::allocate(num);
+    r.deep() = utils::referenceFlux/_zeroPoint;
+    if (_ffp) {
+        ndarray::Array<double, 1, 1> xt = ndarray::allocate(num);
+        ndarray::Array<double, 1, 1> yt = ndarray::allocate(num);
+        for (std::size_t i = 0; i < num; ++i) {
+            auto xy = _transform(afw::geom::Point2D(x[i], y[i]));
+            if (xy.getX() < -1E-8 || xy.getY() < -1E-8) {
+                throw LSST_EXCEPT(
+                    pex::exceptions::LogicError,
+                    (boost::format("Negative transformed point T(%f, %f) -> (%f, %f) for nQuarter=%d")
+                        % x[i] % y[i] % xy.getX() % xy.getY() % _nQuarter).str()
+                );
+            }
+            xt[i] = xy.getX();
+            yt[i] = xy.getY();
+        }
+        ndarray::Array<double, 1> mag = _ffp->eval(xt, yt);
+        for (std::size_t i = 0; i < num; ++i) {
+            r[i] *= std::pow(10.0, -0.4*mag[i]);
+        }
+    }
+    if (_jacobian || _wcs) {
+        ndarray::Array<double, 1> jacobian;
+        if (_jacobian) {
+            jacobian = _jacobian->evaluate(x, y);
+        } else {
+            jacobian = calculateJacobian(*_wcs, x, y);
+        }
+        for (std::size_t i = 0; i < num; ++i) {
+            r[i] *= jacobian[i];
+        }
+    }
+    return r;
+}
+
+// ------------------ image methods -------------------------------------------------------------------------
+
+namespace {
+
+// The nodes from min to max: every step pixels, and max
+std::vector<int> getGridNodes(int min, int max, int step) {
+    std::vector<int> nodes;
+    for (int i = min; i < max; i += step) {
+        nodes.push_back(i);
+    }
+    nodes.push_back(max);
+    return nodes;
+}
+
+/*
+ * Call functor(pixel, value) on each pixel of the image in the bbox of the
+ * field, with the value evaluated in one call on the grid of getGridNodes
+ * and interpolated bilinearly.  With unit steps every pixel is a node.
+ */
+template <typename T, typename F>
+void applyToImage(FluxFitBoundedField const & field, afw::image::Image<T> & image, F functor,
+                  bool overlapOnly, int xStep, int yStep) {
+    if (xStep < 1 || yStep < 1) {
+        throw LSST_EXCEPT(
+            pex::exceptions::InvalidParameterError,
+            (boost::format("Steps must be positive: xStep=%d, yStep=%d") % xStep % yStep).str()
+        );
+    }
+    afw::geom::Box2I region(field.getBBox());
+    if (overlapOnly) {
+        region.clip(image.getBBox());
+    } else if (region != image.getBBox()) {
+        throw LSST_EXCEPT(
+            pex::exceptions::RuntimeError,
+            "Image bounding box does not match field bounding box"
+        );
+    }
+    if (region.isEmpty()) return;
+
+    std::vector<int> const xNodes = getGridNodes(region.getMinX(), region.getMaxX(), xStep);
+    std::vector<int> const yNodes = getGridNodes(region.getMinY(), region.getMaxY(), yStep);
+    int const nx = xNodes.size();
+    int const ny = yNodes.size();
+    ndarray::Array<double, 1, 1> xGrid = ndarray::allocate(nx*ny);
+    ndarray::Array<double, 1, 1> yGrid = ndarray::allocate(nx*ny);
+    for (int j = 0; j < ny; ++j) {
+        for (int i = 0; i < nx; ++i) {
+            xGrid[j*nx + i] = xNodes[i];
+            yGrid[j*nx + i] = yNodes[j];
+        }
+    }
+    ndarray::Array<double, 1, 1> grid = field.evaluate(xGrid, yGrid);
+
+    std::vector<double> row(nx);
+    int j = 0;
+    for (int y = region.getMinY(); y <= region.getMaxY(); ++y) {
+        while (j + 2 < ny && yNodes[j + 1] <= y) ++j;
+        int const j1 = std::min(j + 1, ny - 1);
+        double const t = (j1 == j) ? 0.0 : double(y - yNodes[j])/(yNodes[j1] - yNodes[j]);
+        for (int i = 0; i < nx; ++i) {
+            row[i] = grid[j*nx + i] + (grid[j1*nx + i] - grid[j*nx + i])*t;
+        }
+
+        auto ptr = image.x_at(region.getMinX() - image.getX0(), y - image.getY0());
+        int i = 0;
+        for (int x = region.getMinX(); x <= region.getMaxX(); ++x, ++ptr) {
+            while (i + 2 < nx && xNodes[i + 1] <= x) ++i;
+            int const i1 = std::min(i + 1, nx - 1);
+            double const s = (i1 == i) ? 0.0 : double(x - xNodes[i])/(xNodes[i1] - xNodes[i]);
+            functor(*ptr, row[i] + (row[i1] - row[i])*s);
+        }
+    }
+}
+
+}  // namespace
+
+template <typename T>
+void FluxFitBoundedField::fillImage(afw::image::Image<T> & image, bool overlapOnly,
+                                    int xStep, int yStep) const {
+    applyToImage(*this, image, [](T & pixel, double value) { pixel = value; }, overlapOnly, xStep, yStep);
+}
+
+template <typename T>
+void FluxFitBoundedField::addToImage(afw::image::Image<T> & image, double scaleBy, bool overlapOnly,
+                                     int xStep, int yStep) const {
+    applyToImage(*this, image, [scaleBy](T & pixel, double value) { pixel += scaleBy*value; },
+                 overlapOnly, xStep, yStep);
+}
+
+template <typename T>
+void FluxFitBoundedField::multiplyImage(afw::image::Image<T> & image, bool overlapOnly,
+                                        int xStep, int yStep) const {
+    applyToImage(*this, image, [](T & pixel, double value) { pixel *= value; }, overlapOnly, xStep, yStep);
+}
+
+template <typename T>
+void FluxFitBoundedField::divideImage(afw::image::Image<T> & image, bool overlapOnly,
+                                      int xStep, int yStep) const {
+    applyToImage(*this, image, [](T & pixel, double value) { pixel /= value; }, overlapOnly, xStep, yStep);
+}
+
+#define INSTANTIATE(T) \
+    template void FluxFitBoundedField::fillImage(afw::image::Image<T> &, bool, int, int) const; \
+    template void FluxFitBoundedField::addToImage(afw::image::Image<T> &, double, bool, int, int) const; \
+    template void FluxFitBoundedField::multiplyImage(afw::image::Image<T> &, bool, int, int) const; \
+    template void FluxFitBoundedField::divideImage(afw::image::Image<T> &, bool, int, int) const
+
+INSTANTIATE(float);
+INSTANTIATE(double);
+
+#undef INSTANTIATE
+
 // ------------------ persistence ---------------------------------------------------------------------------
 
 namespace {
 
+// Version 1 adds the jacobian field; version 0 files have no version key
+int const CURRENT_VERSION = 1;
+
 struct PersistenceHelper {
     afw::table::Schema schema;
     afw::table::Key<int> wcs;
@@ -127,6 +297,8 @@ struct PersistenceHelper {
     afw::table::PointKey<int> bboxMax;
     afw::table::Key<double> zeroPoint;
     afw::table::Key<int> nQuarter;
+    afw::table::Key<int> version;
+    afw::table::Key<int> jacobian;
 
     static int computeSize(int order) {
         return (order + 2)*(order + 1)/2;
@@ -164,6 +336,10 @@ struct PersistenceHelper {
         )),
         nQuarter(schema.addField<int>(
             "nQuarter", "number of 90-deg rotations for CCD relative to focal plane"
+        )),
+        version(schema.addField<int>("version", "version of the persisted FluxFitBoundedField")),
+        jacobian(schema.addField<int>(
+            "jacobian", "archive ID of BoundedField approximating the Jacobian determinant factor"
         ))
     {}
 
@@ -182,7 +358,16 @@ struct PersistenceHelper {
         bboxMax(s["bbox_max"]),
         zeroPoint(s["zeroPoint"]),
         nQuarter(s["nQuarter"])
-    {}
+    {
+        if (s.getNames().count("version")) {
+            version = s["version"];
+            jacobian = s["jacobian"];
+        }
+    }
+
+    int getVersion(afw::table::BaseRecord const & record) const {
+        return version.isValid() ? record.get(version) : 0;
+    }
 
 };
 
@@ -196,6 +381,10 @@ public:
         PersistenceHelper const keys(record.getSchema());
 
         auto wcs = archive.get<afw::geom::SkyWcs>(record.get(keys.wcs));
+        std::shared_ptr<afw::math::BoundedField> jacobian;
+        if (keys.getVersion(record) >= 1) {
+            jacobian = archive.get<afw::math::BoundedField>(record.get(keys.jacobian));
+        }
 
         // NOTE: needed invert=false in case min=-1, max=0 (empty bbox). See RFC-324 and DM-10200
         afw::geom::Box2I bbox(record.get(keys.bboxMin), record.get(keys.bboxMax), false);
@@ -219,7 +408,8 @@ public:
             ffp,
             wcs,
             record.get(keys.zeroPoint),
-            record.get(keys.nQuarter)
+            record.get(keys.nQuarter),
+            jacobian
         );
     }
 
@@ -255,6 +445,8 @@ void FluxFitBoundedField::write(OutputArchiveHandle & handle) const {
     record->set(keys.bboxMax, getBBox().getMax());
     record->set(keys.zeroPoint, _zeroPoint);
     record->set(keys.nQuarter, _nQuarter);
+    record->set(keys.version, CURRENT_VERSION);
+    record->set(keys.jacobian, handle.put(_jacobian));
 
     record->set(keys.absolute, _ffp->absolute);
     record->set(keys.chebyshev, _ffp->chebyshev);
@@ -273,7 +465,8 @@ void FluxFitBoundedField::write(OutputArchiveHandle & handle) const {
 // ------------------ operators -----------------------------------------------------------------------------
 
 std::shared_ptr<afw::math::BoundedField> FluxFitBoundedField::operator*(double const scale) const {
-    return std::make_shared<FluxFitBoundedField>(getBBox(), _ffp, _wcs, _zeroPoint/scale, _nQuarter);
+    return std::make_shared<FluxFitBoundedField>(getBBox(), _ffp, _wcs, _zeroPoint/scale, _nQuarter,
+                                                 _jacobian);
 }
 
 bool FluxFitBoundedField::operator==(BoundedField const& rhs) const {
@@ -298,7 +491,8 @@ bool FluxFitBoundedField::operator==(BoundedField const& rhs) const {
             ffpEqual &&
             (_zeroPoint == rhsCasted->_zeroPoint) &&
             (_nQuarter == rhsCasted->_nQuarter) &&
-            sharedPtrsEqual(_wcs, rhsCasted->_wcs);
+            sharedPtrsEqual(_wcs, rhsCasted->_wcs) &&
+            sharedPtrsEqual(_jacobian, rhsCasted->_jacobian);
 }
 
 std::string FluxFitBoundedField::toString() const {
@@ -11,6 +11,8 @@ namespace lsst { namespace meas { namespace mosaic {
 namespace lapack {
 
     dgesv_t dgesv = NULL;
+    dgetrf_t dgetrf = NULL;
+    dgetrs_t dgetrs = NULL;
 
     bool loadMKL() {
 	bool isOK = (
@@ -29,6 +31,10 @@ namespace lapack {
 
 	(void*&)dgesv = dlsym(RTLD_DEFAULT, "dgesv");
 	if(!dgesv) return false;
+	(void*&)dgetrf = dlsym(RTLD_DEFAULT, "dgetrf");
+	if(!dgetrf) return false;
+	(void*&)dgetrs = dlsym(RTLD_DEFAULT, "dgetrs");
+	if(!dgetrs) return false;
 
 	return true;
     }
@@ -39,6 +45,10 @@ namespace lapack {
 
 	(void*&)dgesv = dlsym(h, "dgesv_");
 	if(!dgesv) return false;
+	(void*&)dgetrf = dlsym(h, "dgetrf_");
+	if(!dgetrf) return false;
+	(void*&)dgetrs = dlsym(h, "dgetrs_");
+	if(!dgetrs) return false;
 
 	return true;
     }
@@ -26,6 +26,13 @@ namespace lapack {
     typedef void (*dgesv_t)(MKL_INT*, MKL_INT*, double*, MKL_INT*, MKL_INT*, double*, MKL_INT*, MKL_INT*);
     extern dgesv_t       dgesv;
 
+    typedef void (*dgetrf_t)(MKL_INT*, MKL_INT*, double*, MKL_INT*, MKL_INT*, MKL_INT*);
+    extern dgetrf_t      dgetrf;
+
+    typedef void (*dgetrs_t)(char*, MKL_INT*, MKL_INT*, double*, MKL_INT*, MKL_INT*, double*, MKL_INT*,
+                             MKL_INT*);
+    extern dgetrs_t      dgetrs;
+
 } // namespace lapack
 
 }}} // namespace lsst::meas::mosaic
@@ -2,11 +2,15 @@
 #include "lsst/meas/mosaic/mosaicfit.h"
 #include "lsst/meas/mosaic/shimCameraGeom.h"
 #include "ndarray.h"
+#include "Eigen/LU"
+#include "dynamic_lapack.h"
+#include "parallel.h"
 
 using namespace lsst::meas::mosaic;
 
 extern Eigen::VectorXd solveMatrix(long size, Eigen::MatrixXd &a_data, Eigen::VectorXd &b_data);
 extern int binomial(int n, int k);
+extern std::vector<int> indexStars(int const *num, int n, int *nstar);
 
 FluxFitParams::FluxFitParams(int order_, bool absolute_, bool chebyshev_)
     : order(order_),
@@ -113,34 +117,133 @@ FluxFitParams::FluxFitParams(const FluxFitParams &p) {
 }
 
 double FluxFitParams::eval(double u, double v) const {
+    std::vector<double> basis(2 * (order + 1));
+    evalBasis(u, v, &basis[0], &basis[order + 1]);
+    return evalFromBasis(&basis[0], &basis[order + 1]);
+}
+
+void FluxFitParams::evalBasis(double u, double v, double *bu, double *bv) const {
     double uu = (u + x0) / u_max;
     double vv = (v + y0) / v_max;
-    double val = 0.0;
 
     if (this->chebyshev) {
-        for (int k = 0; k < ncoeff; k++) {
-            val += coeff[k] * Tn(xorder[k], uu) * Tn(yorder[k], vv);
+        // The recurrence of Tn, once for all orders
+        for (int i = 0; i <= order; i++) {
+            if (i == 0) {
+                bu[i] = 1.0;
+                bv[i] = 1.0;
+            } else if (i == 1) {
+                bu[i] = uu;
+                bv[i] = vv;
+            } else if (i == 2) {
+                bu[i] = 2.0 * uu * uu - 1.0;
+                bv[i] = 2.0 * vv * vv - 1.0;
+            } else {
+                bu[i] = 2.0 * uu * bu[i - 1] - bu[i - 2];
+                bv[i] = 2.0 * vv * bv[i - 1] - bv[i - 2];
+            }
         }
     } else {
-        for (int k = 0; k < ncoeff; k++) {
-            val += coeff[k] * pow(uu, xorder[k]) * pow(vv, yorder[k]);
+        for (int i = 0; i <= order; i++) {
+            bu[i] = pow(uu, i);
+            bv[i] = pow(vv, i);
         }
     }
+}
 
+double FluxFitParams::evalFromBasis(double const *bu, double const *bv) const {
+    double val = 0.0;
+    for (int k = 0; k < ncoeff; k++) {
+        val += coeff[k] * bu[xorder[k]] * bv[yorder[k]];
+    }
     return val;
 }
 
+namespace {
+int const EVAL_BLOCK = 64;                  // points evaluated together
+long const EVAL_MIN_PER_THREAD = 1L << 16;  // smallest share of a thread
+
+/*
+ * FluxFitParams::eval for the points [begin, end).  Each block of points
+ * has its basis laid out as bu[i*EVAL_BLOCK + point], so that the
+ * recurrence and the sum over the coefficients run along the points and
+ * vectorize.  Every point gets the same operations, in the same order, as
+ * in the scalar eval.
+ */
+void evalRange(FluxFitParams const &p, ndarray::Array<double const, 1> const &x,
+               ndarray::Array<double const, 1> const &y, ndarray::Array<double, 1> const &out, long begin,
+               long end) {
+    // Row 1 holds the scaled coordinates, even for order 0
+    int const nrow = std::max(p.order, 1) + 1;
+    std::vector<double> bu(nrow * EVAL_BLOCK);
+    std::vector<double> bv(nrow * EVAL_BLOCK);
+    double *u1 = &bu[EVAL_BLOCK];
+    double *v1 = &bv[EVAL_BLOCK];
+    double val[EVAL_BLOCK];
+
+    for (long start = begin; start < end; start += EVAL_BLOCK) {
+        int const n = std::min<long>(EVAL_BLOCK, end - start);
+        for (int j = 0; j < n; j++) {
+            u1[j] = (x[start + j] + p.x0) / p.u_max;
+            v1[j] = (y[start + j] + p.y0) / p.v_max;
+        }
+        for (int i = 0; i <= p.order; i++) {
+            if (i == 1) continue;
+            double *u = &bu[i * EVAL_BLOCK];
+            double *v = &bv[i * EVAL_BLOCK];
+            if (!p.chebyshev) {
+                for (int j = 0; j < n; j++) {
+                    u[j] = pow(u1[j], i);
+                    v[j] = pow(v1[j], i);
+                }
+            } else if (i == 0) {
+                std::fill(u, u + n, 1.0);
+                std::fill(v, v + n, 1.0);
+            } else if (i == 2) {
+                for (int j = 0; j < n; j++) {
+                    u[j] = 2.0 * u1[j] * u1[j] - 1.0;
+                    v[j] = 2.0 * v1[j] * v1[j] - 1.0;
+                }
+            } else {
+                double const *u_1 = u - EVAL_BLOCK;
+                double const *u_2 = u - 2 * EVAL_BLOCK;
+                double const *v_1 = v - EVAL_BLOCK;
+                double const *v_2 = v - 2 * EVAL_BLOCK;
+                for (int j = 0; j < n; j++) {
+                    u[j] = 2.0 * u1[j] * u_1[j] - u_2[j];
+                    v[j] = 2.0 * v1[j] * v_1[j] - v_2[j];
+                }
+            }
+        }
+
+        std::fill(val, val + n, 0.0);
+        for (int k = 0; k < p.ncoeff; k++) {
+            double const c = p.coeff[k];
+            double const *u = &bu[p.xorder[k] * EVAL_BLOCK];
+            double const *v = &bv[p.yorder[k] * EVAL_BLOCK];
+            for (int j = 0; j < n; j++) {
+                val[j] += c * u[j] * v[j];
+            }
+        }
+        for (int j = 0; j < n; j++) {
+            out[start + j] = val[j];
+        }
+    }
+}
+}  // namespace
+
 ndarray::Array<double, 1> FluxFitParams::eval(ndarray::Array<double const, 1> const &x,
-                                              ndarray::Array<double const, 1> const &y) const {
+                                              ndarray::Array<double const, 1> const &y, int nThreads) const {
     int const num = x.getShape()[0];
     if (y.getShape()[0] != num) {
         throw LSST_EXCEPT(pex::exceptions::LengthError,
                           str(boost::format("Size mismatch: %d vs %d") % x.getShape()[0] % y.getShape()[0]));
     }
     ndarray::Array<double, 1> out = ndarray::allocate(ndarray::makeVector(num));
-    for (int i = 0; i < num; ++i) {
-        out[i] = eval(x[i], y[i]);
-    }
+    nThreads = std::min<long>(getNumThreads(nThreads), std::max(1L, num / EVAL_MIN_PER_THREAD));
+    parallelFor(num, nThreads, [this, &x, &y, &out](long begin, long end) {
+        evalRange(*this, x, y, out, begin, end);
+    });
     return out;
 }
 
@@ -154,8 +257,491 @@ int FluxFitParams::getIndex(int i, int j) const {
     return -1;
 }
 
+namespace {
+/*
+ * LU factorization of a square matrix, kept to solve for right-hand sides
+ * given later; through lapack if it is available, as solveMatrix.
+ */
+class LuSolver {
+public:
+    void factor(Eigen::MatrixXd const &a) {
+        if (lapack::isLapackAvailable) {
+            _lu = a;
+            lapack::MKL_INT n = a.rows();
+            lapack::MKL_INT info = 0;
+            _ipiv.resize(n);
+            lapack::dgetrf(&n, &n, _lu.data(), &n, _ipiv.data(), &info);
+            if (info != 0) {
+                throw LSST_EXCEPT(
+                        pex::exceptions::RuntimeError,
+                        str(boost::format("LU factorization failed: dgetrf returned %1%") % info));
+            }
+        } else {
+            _eigen.compute(a);
+        }
+    }
+
+    Eigen::MatrixXd solve(Eigen::MatrixXd const &b) const {
+        if (!lapack::isLapackAvailable) return _eigen.solve(b);
+        Eigen::MatrixXd x = b;
+        char trans = 'N';
+        lapack::MKL_INT n = _lu.rows();
+        lapack::MKL_INT nrhs = b.cols();
+        lapack::MKL_INT info = 0;
+        lapack::dgetrs(&trans, &n, &nrhs, const_cast<double *>(_lu.data()), &n,
+                       const_cast<lapack::MKL_INT *>(_ipiv.data()), x.data(), &n, &info);
+        if (info != 0) {
+            throw LSST_EXCEPT(
+                    pex::exceptions::RuntimeError,
+                    str(boost::format("solving linear equation failed: dgetrs returned %1%") % info));
+        }
+        return x;
+    }
+
+private:
+    Eigen::MatrixXd _lu;
+    std::vector<lapack::MKL_INT> _ipiv;
+    Eigen::FullPivLU<Eigen::MatrixXd> _eigen;
+};
+
+/*
+ * Factor the symmetric matrix d as u v^T with at most maxRank columns,
+ * through LDL^T with diagonal pivoting stopped once the rest is zero to
+ * rounding.  Returns false if the rank is larger, or if no element on the
+ * diagonal of the rest can be a pivot.
+ */
+bool factorLowRank(Eigen::MatrixXd d, long maxRank, Eigen::MatrixXd &u, Eigen::MatrixXd &v) {
+    u.resize(d.rows(), 0);
+    v.resize(d.rows(), 0);
+    if (d.size() == 0) return true;
+    double const tol = d.cwiseAbs().maxCoeff() * d.rows() * std::numeric_limits<double>::epsilon();
+    for (long r = 0;; r++) {
+        if (d.cwiseAbs().maxCoeff() <= tol) return true;
+        long p;
+        if (r >= maxRank || d.diagonal().cwiseAbs().maxCoeff(&p) <= tol) return false;
+        u.conservativeResize(Eigen::NoChange, r + 1);
+        v.conservativeResize(Eigen::NoChange, r + 1);
+        u.col(r) = d.col(p);
+        v.col(r) = d.row(p).transpose() / d(p, p);
+        d -= u.col(r) * v.col(r).transpose();
+    }
+}
+
+/*
+ * The normal equations of a flux fit, with the star magnitudes, unknowns
+ * [starBegin, starBegin + nstar), kept apart from the rest.  A star couples
+ * only to itself and the parameters of its own observations, so its block
+ * is diagonal and its couplings are sparse; solve() eliminates the stars
+ * through the Schur complement and solves a dense system of ndim - nstar.
+ * Elements are set as those of an Eigen::MatrixXd of ndim x ndim.
+ *
+ * With keep, solve() keeps the reduced system and its factorization, and
+ * update() adds a system of the same layout holding the changes of some
+ * observations.  Each changed star replaces its rank-one term of the Schur
+ * complement, and the changes of the rest are factored into rank-one terms
+ * by factorLowRank; while there are few of those, the kept factorization
+ * solves the updated system through the Woodbury identity, otherwise the
+ * reduced system is factorized again.  Neither needs the other stars.  The
+ * rows and columns after the stars hold constraints; those of the update
+ * are ignored.
+ */
+class StarSystem {
+public:
+    StarSystem(int ndim, int starBegin, int nstar)
+            : _starBegin(starBegin),
+              _nstar(nstar),
+              _global(Eigen::MatrixXd::Zero(ndim - nstar, ndim - nstar)),
+              _diag(nstar, 0.0),
+              _col(nstar),
+              _row(nstar) {}
+
+    double &operator()(int i, int j) {
+        bool iStar = isStar(i);
+        bool jStar = isStar(j);
+        if (!iStar && !jStar) {
+            return _global(toGlobal(i), toGlobal(j));
+        } else if (iStar && jStar) {
+            if (i != j) {
+                throw LSST_EXCEPT(pex::exceptions::LogicError,
+                                  str(boost::format("Stars %d and %d are coupled") % i % j));
+            }
+            return _diag[i - _starBegin];
+        } else if (jStar) {
+            return _col[j - _starBegin].add(toGlobal(i));
+        }
+        return _row[i - _starBegin].add(toGlobal(j));
+    }
+
+    // The solution of the full system with right-hand side b; call once
+    Eigen::VectorXd solve(Eigen::VectorXd const &b, bool keep = false) {
+        long const nGlobal = _global.rows();
+        for (int k = 0; k < _nstar; k++) {
+            std::vector<Coupling::Term> const &col = _col[k].merge();
+            std::vector<Coupling::Term> const &row = _row[k].merge();
+            for (size_t j = 0; j < row.size(); j++) {
+                double const r = row[j].second / _diag[k];
+                double *column = &_global(0, row[j].first);
+                for (size_t i = 0; i < col.size(); i++) column[col[i].first] -= col[i].second * r;
+            }
+        }
+        _active.assign(_nstar, 1);
+
+        if (!keep) {
+            Eigen::VectorXd bGlobal = reduce(b);
+            return backSubstitute(b, solveMatrix(nGlobal, _global, bGlobal));
+        }
+
+        _b = b;
+        _lu.factor(_global);
+        _u.resize(nGlobal, 0);
+        _v.resize(nGlobal, 0);
+        return backSubstitute(_b, _lu.solve(reduce(_b)));
+    }
+
+    /*
+     * Add delta, with right-hand side bDelta, to the system kept by
+     * solve(keep=true) and return the new solution.  Stars not in active
+     * have lost all their observations and are left out; their solutions
+     * are zero.  lowRank is set to whether the kept factorization was used.
+     */
+    Eigen::VectorXd update(StarSystem &delta, Eigen::VectorXd const &bDelta, std::vector<char> const &active,
+                           bool &lowRank) {
+        long const nGlobal = _global.rows();
+        std::vector<Eigen::VectorXd> uTerms;
+        std::vector<Eigen::VectorXd> vTerms;
+
+        // The changes of the rest, in the rows and columns they touch
+        std::vector<long> changed;
+        for (long j = 0; j < _starBegin; j++) {
+            if (!delta._global.col(j).head(_starBegin).isZero(0.0)) changed.push_back(j);
+        }
+        Eigen::MatrixXd dGlobal(changed.size(), changed.size());
+        for (size_t j = 0; j < changed.size(); j++) {
+            for (size_t i = 0; i < changed.size(); i++) {
+                dGlobal(i, j) = delta._global(changed[i], changed[j]);
+                _global(changed[i], changed[j]) += dGlobal(i, j);
+            }
+        }
+        for (long i = 0; i < _starBegin; i++) _b(i) += bDelta(i);
+
+        for (int k = 0; k < _nstar; k++) {
+            std::vector<Coupling::Term> const &dCol = delta._col[k].merge();
+            std::vector<Coupling::Term> const &dRow = delta._row[k].merge();
+            if (delta._diag[k] == 0.0 && dCol.empty() && dRow.empty() && _active[k] == active[k]) continue;
+            if (_active[k]) {
+                addSchur(k, 1.0, uTerms, vTerms);
+            }
+            _diag[k] += delta._diag[k];
+            _b(_starBegin + k) += bDelta(_starBegin + k);
+            for (size_t i = 0; i < dCol.size(); i++) _col[k].add(dCol[i].first) = dCol[i].second;
+            for (size_t i = 0; i < dRow.size(); i++) _row[k].add(dRow[i].first) = dRow[i].second;
+            _col[k].merge();
+            _row[k].merge();
+            _active[k] = active[k];
+            if (_active[k]) {
+                addSchur(k, -1.0, uTerms, vTerms);
+            }
+        }
+
+        // Each changed observation adds one to the rank of dGlobal, which
+        // is usually much less than the number of columns it touches
+        long const maxRank = nGlobal / 8 - _u.cols() - static_cast<long>(uTerms.size());
+        Eigen::MatrixXd dU;
+        Eigen::MatrixXd dV;
+        lowRank = maxRank >= 0 && factorLowRank(dGlobal, maxRank, dU, dV);
+        if (!lowRank) {
+            std::cout << "StarSystem::update: factorizing again" << std::endl;
+            _lu.factor(_global);
+            _u.resize(nGlobal, 0);
+            _v.resize(nGlobal, 0);
+            return backSubstitute(_b, _lu.solve(reduce(_b)));
+        }
+
+        long const nOld = _u.cols();
+        long const rank = nOld + uTerms.size() + dU.cols();
+        std::cout << "StarSystem::update: rank " << rank << " of " << nGlobal << std::endl;
+        _u.conservativeResize(nGlobal, rank);
+        _v.conservativeResize(nGlobal, rank);
+        _u.rightCols(rank - nOld).setZero();
+        _v.rightCols(rank - nOld).setZero();
+        for (size_t t = 0; t < uTerms.size(); t++) {
+            _u.col(nOld + t) = uTerms[t];
+            _v.col(nOld + t) = vTerms[t];
+        }
+        for (long t = 0; t < dU.cols(); t++) {
+            for (size_t i = 0; i < changed.size(); i++) {
+                _u(changed[i], nOld + uTerms.size() + t) = dU(i, t);
+                _v(changed[i], nOld + uTerms.size() + t) = dV(i, t);
+            }
+        }
+
+        // (F + U V^T)^-1 y = F^-1 y - F^-1 U (I + V^T F^-1 U)^-1 V^T F^-1 y
+        Eigen::VectorXd y = _lu.solve(reduce(_b));
+        if (rank > 0) {
+            Eigen::MatrixXd z = _lu.solve(_u);
+            Eigen::MatrixXd c = Eigen::MatrixXd::Identity(rank, rank) + _v.transpose() * z;
+            y -= z * c.fullPivLu().solve(_v.transpose() * y);
+        }
+        return backSubstitute(_b, y);
+    }
+
+private:
+    // Sparse elements of a row or column; terms are appended and summed
+    // when there are twice as many as when they were last summed.
+    class Coupling {
+    public:
+        typedef std::pair<int, double> Term;
+
+        Coupling() : _nMerged(0) {}
+
+        double &add(int index) {
+            if (_terms.size() >= 2 * _nMerged + 32) merge();
+            _terms.push_back(Term(index, 0.0));
+            return _terms.back().second;
+        }
+
+        std::vector<Term> const &merge() {
+            std::sort(_terms.begin(), _terms.end(),
+                      [](Term const &a, Term const &b) { return a.first < b.first; });
+            size_t n = 0;
+            for (size_t i = 0; i < _terms.size(); i++) {
+                if (n > 0 && _terms[n - 1].first == _terms[i].first) {
+                    _terms[n - 1].second += _terms[i].second;
+                } else {
+                    _terms[n++] = _terms[i];
+                }
+            }
+            _terms.resize(n);
+            _nMerged = n;
+            return _terms;
+        }
+
+        std::vector<Term> const &getTerms() const { return _terms; }
+
+    private:
+        std::vector<Term> _terms;
+        size_t _nMerged;
+    };
+
+    // The right-hand side of the reduced system; the couplings are merged
+    Eigen::VectorXd reduce(Eigen::VectorXd const &b) const {
+        long const nGlobal = _global.rows();
+        Eigen::VectorXd bGlobal(nGlobal);
+        for (long i = 0; i < nGlobal; i++) bGlobal(i) = b(fromGlobal(i));
+        for (int k = 0; k < _nstar; k++) {
+            if (!_active[k]) continue;
+            std::vector<Coupling::Term> const &col = _col[k].getTerms();
+            double const bStar = b(_starBegin + k) / _diag[k];
+            for (size_t i = 0; i < col.size(); i++) bGlobal(col[i].first) -= col[i].second * bStar;
+        }
+        return bGlobal;
+    }
+
+    Eigen::VectorXd backSubstitute(Eigen::VectorXd const &b, Eigen::VectorXd const &xGlobal) const {
+        long const nGlobal = _global.rows();
+        Eigen::VectorXd x(nGlobal + _nstar);
+        for (long i = 0; i < nGlobal; i++) x(fromGlobal(i)) = xGlobal(i);
+        for (int k = 0; k < _nstar; k++) {
+            if (!_active[k]) {
+                x(_starBegin + k) = 0.0;
+                continue;
+            }
+            std::vector<Coupling::Term> const &row = _row[k].getTerms();
+            double sum = b(_starBegin + k);
+            for (size_t j = 0; j < row.size(); j++) sum -= row[j].second * xGlobal(row[j].first);
+            x(_starBegin + k) = sum / _diag[k];
+        }
+        return x;
+    }
+
+    // Add sign times the Schur complement term of star k to the reduced
+    // system, and record it as a rank-one term
+    void addSchur(int k, double sign, std::vector<Eigen::VectorXd> &uTerms,
+                  std::vector<Eigen::VectorXd> &vTerms) {
+        long const nGlobal = _global.rows();
+        std::vector<Coupling::Term> const &col = _col[k].getTerms();
+        std::vector<Coupling::Term> const &row = _row[k].getTerms();
+        Eigen::VectorXd u = Eigen::VectorXd::Zero(nGlobal);
+        Eigen::VectorXd v = Eigen::VectorXd::Zero(nGlobal);
+        for (size_t i = 0; i < col.size(); i++) u(col[i].first) = sign * col[i].second / _diag[k];
+        for (size_t j = 0; j < row.size(); j++) v(row[j].first) = row[j].second;
+        for (size_t j = 0; j < row.size(); j++) {
+            double *column = &_global(0, row[j].first);
+            for (size_t i = 0; i < col.size(); i++) column[col[i].first] += u(col[i].first) * row[j].second;
+        }
+        uTerms.push_back(u);
+        vTerms.push_back(v);
+    }
+
+    bool isStar(int i) const { return i >= _starBegin && i < _starBegin + _nstar; }
+    int toGlobal(int i) const { return i < _starBegin ? i : i - _nstar; }
+    int fromGlobal(int i) const { return i < _starBegin ? i : i + _nstar; }
+
+    int _starBegin;
+    int _nstar;
+    Eigen::MatrixXd _global;
+    std::vector<double> _diag;
+    std::vector<Coupling> _col;  // elements (i, star) for each star
+    std::vector<Coupling> _row;  // elements (star, j) for each star
+    std::vector<char> _active;   // stars still in the system
+
+    // Kept by solve(keep=true)
+    Eigen::VectorXd _b;
+    LuSolver _lu;        // of the reduced system, less _u _v^T
+    Eigen::MatrixXd _u;  // rank-one terms added since the factorization
+    Eigen::MatrixXd _v;
+};
+
+/*
+ * The output of FluxFitParams::evalBasis for each Obs of a list.  The
+ * focal plane positions do not change during a flux fit, so the basis is
+ * computed once and shared by the fits and FluxResiduals of all its
+ * iterations.  All the FluxFitParams of an FfpSet have the same
+ * order, type and scaling, so one basis serves each of them.
+ */
+class FluxBasis {
+public:
+    FluxBasis(std::vector<Obs::Ptr> const &obs, FluxFitParams const &p)
+        : _n(p.order + 1), _u(obs.size() * _n), _v(obs.size() * _n) {
+        for (size_t i = 0; i < obs.size(); i++) {
+            p.evalBasis(obs[i]->u, obs[i]->v, &_u[i * _n], &_v[i * _n]);
+        }
+    }
+
+    double const *getU(size_t i) const { return &_u[i * _n]; }
+    double const *getV(size_t i) const { return &_v[i * _n]; }
+
+private:
+    size_t _n;
+    std::vector<double> _u;
+    std::vector<double> _v;
+};
+
+// 1 for the observations used in a flux fit, 0 for the others
+std::vector<double> getWeights(std::vector<Obs::Ptr> const &obs, bool catalog) {
+    std::vector<double> weight(obs.size(), 0.0);
+    for (size_t i = 0; i < obs.size(); i++) {
+        if (obs[i]->jstar == -1 || !obs[i]->good || obs[i]->mag == -9999 || obs[i]->err == -9999) continue;
+        if (catalog && obs[i]->mag_cat == -9999) continue;
+        weight[i] = 1.0;
+    }
+    return weight;
+}
+
+// Reset jstar of the observations of stars not numbered in starIndex
+void dropStars(std::vector<Obs::Ptr> &obs, int offset, std::vector<int> const &starIndex) {
+    for (size_t i = 0; i < obs.size(); i++) {
+        if (starIndex[offset + obs[i]->istar] == -1) obs[i]->jstar = -1;
+    }
+}
+
+/*
+ * The normal equations of the previous iteration of a flux fit, with the
+ * numbering of its stars and the weights of its observations.  When the
+ * weights of at most maxChurn of the observations used have changed since,
+ * a fit builds its equations from the changes alone, in the numbering of
+ * the kept system, and StarSystem::update solves them; otherwise it
+ * builds and solves them in full.  With maxChurn = 0 nothing is kept.
+ */
+class FluxFitCache {
+public:
+    explicit FluxFitCache(double maxChurn) : _maxChurn(maxChurn), _nstar(0), _nUpdate(0), _nLowRank(0) {}
+
+    /*
+     * Whether the fit with starIndex, nstar and the weights can update the
+     * kept system.  If so, the weights are replaced by their changes.
+     */
+    bool prepare(std::vector<int> const &starIndex, int nstar, std::vector<double> &mWeight,
+                 std::vector<double> &sWeight) {
+        if (_maxChurn <= 0.0) return false;
+        bool update = _system && starIndex.size() == _starIndex.size() &&
+                      mWeight.size() == _mWeight.size() && sWeight.size() == _sWeight.size();
+        if (update) {
+            long nChanged = 0;
+            long nUsed = 0;
+            for (size_t i = 0; i < mWeight.size(); i++) {
+                if (mWeight[i] != _mWeight[i]) nChanged++;
+                if (_mWeight[i] != 0.0) nUsed++;
+            }
+            for (size_t i = 0; i < sWeight.size(); i++) {
+                if (sWeight[i] != _sWeight[i]) nChanged++;
+                if (_sWeight[i] != 0.0) nUsed++;
+            }
+            update = nChanged <= _maxChurn * nUsed;
+            // A star new to the fit has no place in the kept system
+            for (size_t i = 0; update && i < starIndex.size(); i++) {
+                if (starIndex[i] != -1 && _starIndex[i] == -1) update = false;
+            }
+        }
+        if (!update) {
+            _system.reset();
+            _starIndex = starIndex;
+            _nstar = nstar;
+            _mWeight = mWeight;
+            _sWeight = sWeight;
+            return false;
+        }
+
+        _active.assign(_nstar, 0);
+        for (size_t i = 0; i < starIndex.size(); i++) {
+            if (_starIndex[i] != -1) _active[_starIndex[i]] = (starIndex[i] != -1);
+        }
+        for (size_t i = 0; i < mWeight.size(); i++) {
+            std::swap(mWeight[i], _mWeight[i]);
+            mWeight[i] = _mWeight[i] - mWeight[i];
+        }
+        for (size_t i = 0; i < sWeight.size(); i++) {
+            std::swap(sWeight[i], _sWeight[i]);
+            sWeight[i] = _sWeight[i] - sWeight[i];
+        }
+        return true;
+    }
+
+    // The number of stars of the kept system
+    int getNstar() const { return _nstar; }
+
+    // Number the stars of obs as in the kept system
+    void renumber(std::vector<Obs::Ptr> &obs, int offset) const {
+        for (size_t i = 0; i < obs.size(); i++) {
+            obs[i]->jstar = _starIndex[offset + obs[i]->istar];
+        }
+    }
+
+    // Solve a_data, or add it to the kept system if prepare() returned true
+    Eigen::VectorXd solve(StarSystem &a_data, Eigen::VectorXd const &b_data, bool update) {
+        if (update) {
+            bool lowRank = false;
+            Eigen::VectorXd solution = _system->update(a_data, b_data, _active, lowRank);
+            _nUpdate++;
+            if (lowRank) _nLowRank++;
+            return solution;
+        }
+        if (_maxChurn <= 0.0) return a_data.solve(b_data);
+        Eigen::VectorXd solution = a_data.solve(b_data, true);
+        _system.reset(new StarSystem(std::move(a_data)));
+        return solution;
+    }
+
+    // The number of solutions by update, and of those without a new factorization
+    int getNumUpdate() const { return _nUpdate; }
+    int getNumLowRank() const { return _nLowRank; }
+
+private:
+    double _maxChurn;
+    std::unique_ptr<StarSystem> _system;
+    std::vector<int> _starIndex;
+    int _nstar;
+    std::vector<double> _mWeight;
+    std::vector<double> _sWeight;
+    std::vector<char> _active;  // stars of the kept system still in the fit
+    int _nUpdate;
+    int _nLowRank;
+};
+}  // namespace
+
 Eigen::VectorXd fluxFit_rel(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Obs::Ptr> &s, int nsource,
-                            int nexp, int nchip, FfpSet &ffpSet, bool solveCcd) {
+                            int nexp, int nchip, FfpSet &ffpSet, bool solveCcd,
+                            FluxBasis const &mBasis, FluxBasis const &sBasis, FluxFitCache &cache) {
     int nMobs = m.size();
     int nSobs = s.size();
     int nFfp = ffpSet.size();
@@ -174,31 +760,25 @@ Eigen::VectorXd fluxFit_rel(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
             num[nmatch + s[i]->istar] += 1;
         }
     }
-    std::vector<int> v_istar;
-    for (int i = 0; i < nmatch + nsource; i++) {
-        if (num[i] >= 2) {
-            v_istar.push_back(i);
-        }
-    }
+    int nstar;
+    std::vector<int> starIndex = indexStars(num, nmatch + nsource, &nstar);
     delete[] num;
-    int nstar = v_istar.size();
     std::cout << "fluxFit_rel: nstar =  " << nstar << std::endl;
 
     for (int i = 0; i < nMobs; i++) {
-        std::vector<int>::iterator it = std::find(v_istar.begin(), v_istar.end(), m[i]->istar);
-        if (it != v_istar.end()) {
-            m[i]->jstar = it - v_istar.begin();
-        } else {
-            m[i]->jstar = -1;
-        }
+        m[i]->jstar = starIndex[m[i]->istar];
     }
     for (int i = 0; i < nSobs; i++) {
-        std::vector<int>::iterator it = std::find(v_istar.begin(), v_istar.end(), nmatch + s[i]->istar);
-        if (it != v_istar.end()) {
-            s[i]->jstar = it - v_istar.begin();
-        } else {
-            s[i]->jstar = -1;
-        }
+        s[i]->jstar = starIndex[nmatch + s[i]->istar];
+    }
+
+    std::vector<double> mWeight = getWeights(m, false);
+    std::vector<double> sWeight = getWeights(s, false);
+    bool update = cache.prepare(starIndex, nstar, mWeight, sWeight);
+    if (update) {
+        nstar = cache.getNstar();
+        cache.renumber(m, 0);
+        cache.renumber(s, nmatch);
     }
 
     int ncoeff_offset = 3;	// Fit from 2nd order only
@@ -209,42 +789,38 @@ Eigen::VectorXd fluxFit_rel(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
     int ncoeff = p->ncoeff - ncoeff_offset;
     int *xorder = &p->xorder[ncoeff_offset];
     int *yorder = &p->yorder[ncoeff_offset];
-    double u_max = p->u_max;
-    double v_max = p->v_max;
 
     Eigen::VectorXd pu(ncoeff);
     Eigen::VectorXd pv(ncoeff);
 
     int ndim;
+    int starBegin;
     if (solveCcd) {
-        ndim = nexp + nchip + ncoeff * nFfp + nstar + 2;
+        starBegin = nexp + nchip + ncoeff * nFfp;
+        ndim = starBegin + nstar + 2;
     } else {
-        ndim = nexp + ncoeff * nFfp + nstar + 1;
+        starBegin = nexp + ncoeff * nFfp;
+        ndim = starBegin + nstar + 1;
     }
     std::cout << "fluxFit_rel: ndim =  " << ndim << std::endl;
 
-    Eigen::MatrixXd a_data = Eigen::MatrixXd::Zero(ndim, ndim);
+    StarSystem a_data(ndim, starBegin, nstar);
     Eigen::VectorXd b_data = Eigen::VectorXd::Zero(ndim);
 
     double is2 = 1.0;
 
     if (solveCcd) {
         for (int i = 0; i < nMobs; i++) {
-            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999) continue;
+            if (mWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], m[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], m[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(m[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(m[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = mBasis.getU(i);
+            double const *bv = mBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(m[i]->err, 2);
+            is2 = mWeight[i] / pow(m[i]->err, 2);
 
             a_data(m[i]->jexp, m[i]->jexp) -= is2;
             a_data(m[i]->jexp, nexp + m[i]->jchip) -= is2;
@@ -288,21 +864,16 @@ Eigen::VectorXd fluxFit_rel(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
             b_data(nexp + nchip + ncoeff * nFfp + m[i]->jstar) -= m[i]->mag * is2;
         }
         for (int i = 0; i < nSobs; i++) {
-            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            if (sWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], s[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], s[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(s[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(s[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = sBasis.getU(i);
+            double const *bv = sBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(s[i]->err, 2);
+            is2 = sWeight[i] / pow(s[i]->err, 2);
 
             a_data(s[i]->jexp, s[i]->jexp) -= is2;
             a_data(s[i]->jexp, nexp + s[i]->jchip) -= is2;
@@ -357,21 +928,16 @@ Eigen::VectorXd fluxFit_rel(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
         b_data(ndim - 1) = 0;
     } else {
         for (int i = 0; i < nMobs; i++) {
-            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999) continue;
+            if (mWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], m[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], m[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(m[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(m[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = mBasis.getU(i);
+            double const *bv = mBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(m[i]->err, 2);
+            is2 = mWeight[i] / pow(m[i]->err, 2);
 
             a_data(m[i]->jexp, m[i]->jexp) -= is2;
             for (int k = 0; k < ncoeff; k++) {
@@ -403,21 +969,16 @@ Eigen::VectorXd fluxFit_rel(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
             b_data(nexp + ncoeff * nFfp + m[i]->jstar) -= m[i]->mag * is2;
         }
         for (int i = 0; i < nSobs; i++) {
-            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            if (sWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], s[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], s[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(s[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(s[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = sBasis.getU(i);
+            double const *bv = sBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(s[i]->err, 2);
+            is2 = sWeight[i] / pow(s[i]->err, 2);
 
             a_data(s[i]->jexp, s[i]->jexp) -= is2;
             for (int k = 0; k < ncoeff; k++) {
@@ -454,7 +1015,11 @@ Eigen::VectorXd fluxFit_rel(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
         b_data(ndim - 1) = 0;
     }
 
-    Eigen::VectorXd solution = solveMatrix(ndim, a_data, b_data);
+    Eigen::VectorXd solution = cache.solve(a_data, b_data, update);
+    if (update) {
+        dropStars(m, 0, starIndex);
+        dropStars(s, nmatch, starIndex);
+    }
 
     std::vector<double> v;
     std::vector<double> e;
@@ -551,7 +1116,8 @@ Eigen::VectorXd fluxFit_rel(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
 }
 
 Eigen::VectorXd fluxFit_rel1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Obs::Ptr> &s, int nsource,
-                             int nexp, int nchip, FfpSet &ffpSet, bool solveCcd) {
+                             int nexp, int nchip, FfpSet &ffpSet, bool solveCcd,
+                             FluxBasis const &mBasis, FluxBasis const &sBasis, FluxFitCache &cache) {
     int nMobs = m.size();
     int nSobs = s.size();
 
@@ -569,31 +1135,25 @@ Eigen::VectorXd fluxFit_rel1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
             num[nmatch + s[i]->istar] += 1;
         }
     }
-    std::vector<int> v_istar;
-    for (int i = 0; i < nmatch + nsource; i++) {
-        if (num[i] >= 2) {
-            v_istar.push_back(i);
-        }
-    }
+    int nstar;
+    std::vector<int> starIndex = indexStars(num, nmatch + nsource, &nstar);
     delete[] num;
-    int nstar = v_istar.size();
     std::cout << "fluxFit_rel1: nstar = " << nstar << std::endl;
 
     for (int i = 0; i < nMobs; i++) {
-        std::vector<int>::iterator it = std::find(v_istar.begin(), v_istar.end(), m[i]->istar);
-        if (it != v_istar.end()) {
-            m[i]->jstar = it - v_istar.begin();
-        } else {
-            m[i]->jstar = -1;
-        }
+        m[i]->jstar = starIndex[m[i]->istar];
     }
     for (int i = 0; i < nSobs; i++) {
-        std::vector<int>::iterator it = std::find(v_istar.begin(), v_istar.end(), nmatch + s[i]->istar);
-        if (it != v_istar.end()) {
-            s[i]->jstar = it - v_istar.begin();
-        } else {
-            s[i]->jstar = -1;
-        }
+        s[i]->jstar = starIndex[nmatch + s[i]->istar];
+    }
+
+    std::vector<double> mWeight = getWeights(m, false);
+    std::vector<double> sWeight = getWeights(s, false);
+    bool update = cache.prepare(starIndex, nstar, mWeight, sWeight);
+    if (update) {
+        nstar = cache.getNstar();
+        cache.renumber(m, 0);
+        cache.renumber(s, nmatch);
     }
 
     int ncoeff_offset = 3;  // Fit from 2nd order only
@@ -604,42 +1164,38 @@ Eigen::VectorXd fluxFit_rel1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
     int ncoeff = p->ncoeff - ncoeff_offset;
     int *xorder = &p->xorder[ncoeff_offset];
     int *yorder = &p->yorder[ncoeff_offset];
-    double u_max = p->u_max;
-    double v_max = p->v_max;
 
     Eigen::VectorXd pu(ncoeff);
     Eigen::VectorXd pv(ncoeff);
 
     int ndim;
+    int starBegin;
     if (solveCcd) {
-        ndim = nexp + nchip + ncoeff + nstar + 2;
+        starBegin = nexp + nchip + ncoeff;
+        ndim = starBegin + nstar + 2;
     } else {
-        ndim = nexp + ncoeff + nstar + 1;
+        starBegin = nexp + ncoeff;
+        ndim = starBegin + nstar + 1;
     }
     std::cout << "fluxFit_rel1: ndim =  " << ndim << std::endl;
 
-    Eigen::MatrixXd a_data = Eigen::MatrixXd::Zero(ndim, ndim);
+    StarSystem a_data(ndim, starBegin, nstar);
     Eigen::VectorXd b_data = Eigen::VectorXd::Zero(ndim);
 
     double is2 = 1.0;
 
     if (solveCcd) {
         for (int i = 0; i < nMobs; i++) {
-            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999) continue;
+            if (mWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], m[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], m[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(m[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(m[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = mBasis.getU(i);
+            double const *bv = mBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(m[i]->err, 2);
+            is2 = mWeight[i] / pow(m[i]->err, 2);
 
             a_data(m[i]->jexp, m[i]->jexp) -= is2;
             a_data(m[i]->jexp, nexp + m[i]->jchip) -= is2;
@@ -679,21 +1235,16 @@ Eigen::VectorXd fluxFit_rel1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
             b_data(nexp + nchip + ncoeff + m[i]->jstar) -= m[i]->mag * is2;
         }
         for (int i = 0; i < nSobs; i++) {
-            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            if (sWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], s[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], s[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(s[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(s[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = sBasis.getU(i);
+            double const *bv = sBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(s[i]->err, 2);
+            is2 = sWeight[i] / pow(s[i]->err, 2);
 
             a_data(s[i]->jexp, s[i]->jexp) -= is2;
             a_data(s[i]->jexp, nexp + s[i]->jchip) -= is2;
@@ -744,21 +1295,16 @@ Eigen::VectorXd fluxFit_rel1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
         b_data(ndim - 1) = 0;
     } else {
         for (int i = 0; i < nMobs; i++) {
-            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999) continue;
+            if (mWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], m[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], m[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(m[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(m[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = mBasis.getU(i);
+            double const *bv = mBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(m[i]->err, 2);
+            is2 = mWeight[i] / pow(m[i]->err, 2);
 
             a_data(m[i]->jexp, m[i]->jexp) -= is2;
             for (int k = 0; k < ncoeff; k++) {
@@ -787,21 +1333,16 @@ Eigen::VectorXd fluxFit_rel1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
             b_data(nexp + ncoeff + m[i]->jstar) -= m[i]->mag * is2;
         }
         for (int i = 0; i < nSobs; i++) {
-            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            if (sWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], s[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], s[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(s[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(s[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = sBasis.getU(i);
+            double const *bv = sBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(s[i]->err, 2);
+            is2 = sWeight[i] / pow(s[i]->err, 2);
 
             a_data(s[i]->jexp, s[i]->jexp) -= is2;
             for (int k = 0; k < ncoeff; k++) {
@@ -835,7 +1376,11 @@ Eigen::VectorXd fluxFit_rel1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
         b_data(ndim - 1) = 0;
     }
 
-    Eigen::VectorXd solution = solveMatrix(ndim, a_data, b_data);
+    Eigen::VectorXd solution = cache.solve(a_data, b_data, update);
+    if (update) {
+        dropStars(m, 0, starIndex);
+        dropStars(s, nmatch, starIndex);
+    }
 
     std::vector<double> v;
     std::vector<double> e;
@@ -930,7 +1475,8 @@ Eigen::VectorXd fluxFit_rel1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
 }
 
 Eigen::VectorXd fluxFit_abs(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Obs::Ptr> &s, int nsource,
-                            int nexp, int nchip, FfpSet &ffpSet, bool solveCcd) {
+                            int nexp, int nchip, FfpSet &ffpSet, bool solveCcd,
+                            FluxBasis const &mBasis, FluxBasis const &sBasis, FluxFitCache &cache) {
     int nMobs = m.size();
     int nSobs = s.size();
     int nFfp = ffpSet.size();
@@ -944,23 +1490,21 @@ Eigen::VectorXd fluxFit_abs(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
             num[s[i]->istar] += 1;
         }
     }
-    std::vector<int> v_istar;
-    for (int i = 0; i < nsource; i++) {
-        if (num[i] >= 2) {
-            v_istar.push_back(i);
-        }
-    }
+    int nstar;
+    std::vector<int> starIndex = indexStars(num, nsource, &nstar);
     delete[] num;
-    int nstar = v_istar.size();
     std::cout << "fluxFit_abs: nstar =  " << nstar << std::endl;
 
     for (int i = 0; i < nSobs; i++) {
-        std::vector<int>::iterator it = std::find(v_istar.begin(), v_istar.end(), s[i]->istar);
-        if (it != v_istar.end()) {
-            s[i]->jstar = it - v_istar.begin();
-        } else {
-            s[i]->jstar = -1;
-        }
+        s[i]->jstar = starIndex[s[i]->istar];
+    }
+
+    std::vector<double> mWeight = getWeights(m, true);
+    std::vector<double> sWeight = getWeights(s, false);
+    bool update = cache.prepare(starIndex, nstar, mWeight, sWeight);
+    if (update) {
+        nstar = cache.getNstar();
+        cache.renumber(s, 0);
     }
 
     int ncoeff_offset = 1;	// Fit from 1st order only
@@ -968,44 +1512,38 @@ Eigen::VectorXd fluxFit_abs(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
     int ncoeff = p->ncoeff - ncoeff_offset;
     int *xorder = &p->xorder[ncoeff_offset];
     int *yorder = &p->yorder[ncoeff_offset];
-    double u_max = p->u_max;
-    double v_max = p->v_max;
 
     Eigen::VectorXd pu(ncoeff);
     Eigen::VectorXd pv(ncoeff);
 
     int ndim;
+    int starBegin;
     if (solveCcd) {
-        ndim = nexp + nchip + ncoeff * nFfp + nstar + 1;
+        starBegin = nexp + nchip + ncoeff * nFfp;
+        ndim = starBegin + nstar + 1;
     } else {
-        ndim = nexp + ncoeff * nFfp + nstar;
+        starBegin = nexp + ncoeff * nFfp;
+        ndim = starBegin + nstar;
     }
     std::cout << "fluxFit_abs: ndim =  " << ndim << std::endl;
 
-    Eigen::MatrixXd a_data = Eigen::MatrixXd::Zero(ndim, ndim);
+    StarSystem a_data(ndim, starBegin, nstar);
     Eigen::VectorXd b_data = Eigen::VectorXd::Zero(ndim);
 
     double is2 = 1.0;
 
     if (solveCcd) {
         for (int i = 0; i < nMobs; i++) {
-            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999 ||
-                m[i]->mag_cat == -9999)
-                continue;
+            if (mWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], m[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], m[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(m[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(m[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = mBasis.getU(i);
+            double const *bv = mBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / (pow(m[i]->err, 2) + pow(m[i]->err_cat, 2));
+            is2 = mWeight[i] / (pow(m[i]->err, 2) + pow(m[i]->err_cat, 2));
 
             a_data(m[i]->jexp, m[i]->jexp) -= is2;
             a_data(m[i]->jexp, nexp + m[i]->jchip) -= is2;
@@ -1036,21 +1574,16 @@ Eigen::VectorXd fluxFit_abs(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
             }
         }
         for (int i = 0; i < nSobs; i++) {
-            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            if (sWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], s[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], s[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(s[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(s[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = sBasis.getU(i);
+            double const *bv = sBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(s[i]->err, 2);
+            is2 = sWeight[i] / pow(s[i]->err, 2);
 
             a_data(s[i]->jexp, s[i]->jexp) -= is2;
             a_data(s[i]->jexp, nexp + s[i]->jchip) -= is2;
@@ -1102,23 +1635,16 @@ Eigen::VectorXd fluxFit_abs(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
         b_data(ndim - 1) = 0;
     } else {
         for (int i = 0; i < nMobs; i++) {
-            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999 ||
-                m[i]->mag_cat == -9999)
-                continue;
+            if (mWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], m[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], m[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(m[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(m[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = mBasis.getU(i);
+            double const *bv = mBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / (pow(m[i]->err, 2) + pow(m[i]->err_cat, 2));
+            is2 = mWeight[i] / (pow(m[i]->err, 2) + pow(m[i]->err_cat, 2));
 
             a_data(m[i]->jexp, m[i]->jexp) -= is2;
             for (int k = 0; k < ncoeff; k++) {
@@ -1139,21 +1665,16 @@ Eigen::VectorXd fluxFit_abs(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
             }
         }
         for (int i = 0; i < nSobs; i++) {
-            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            if (sWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], s[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], s[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(s[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(s[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = sBasis.getU(i);
+            double const *bv = sBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(s[i]->err, 2);
+            is2 = sWeight[i] / pow(s[i]->err, 2);
 
             a_data(s[i]->jexp, s[i]->jexp) -= is2;
             for (int k = 0; k < ncoeff; k++) {
@@ -1186,7 +1707,10 @@ Eigen::VectorXd fluxFit_abs(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
         }
     }
 
-    Eigen::VectorXd solution = solveMatrix(ndim, a_data, b_data);
+    Eigen::VectorXd solution = cache.solve(a_data, b_data, update);
+    if (update) {
+        dropStars(s, 0, starIndex);
+    }
 
     if (solveCcd) {
         for (int i = 0; i < nSobs; i++) {
@@ -1222,7 +1746,8 @@ Eigen::VectorXd fluxFit_abs(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Ob
 Eigen::VectorXd fluxFit_abs1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<Obs::Ptr> &s, int nsource,
                              int nexp, int nchip,
                              // FluxFitParams::Ptr p,
-                             FfpSet &ffpSet, bool solveCcd) {
+                             FfpSet &ffpSet, bool solveCcd,
+                             FluxBasis const &mBasis, FluxBasis const &sBasis, FluxFitCache &cache) {
     int nMobs = m.size();
     int nSobs = s.size();
 
@@ -1235,23 +1760,21 @@ Eigen::VectorXd fluxFit_abs1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
             num[s[i]->istar] += 1;
         }
     }
-    std::vector<int> v_istar;
-    for (int i = 0; i < nsource; i++) {
-        if (num[i] >= 2) {
-            v_istar.push_back(i);
-        }
-    }
+    int nstar;
+    std::vector<int> starIndex = indexStars(num, nsource, &nstar);
     delete[] num;
-    int nstar = v_istar.size();
     std::cout << "fluxFit_abs1: nstar =  " << nstar << std::endl;
 
     for (int i = 0; i < nSobs; i++) {
-        std::vector<int>::iterator it = std::find(v_istar.begin(), v_istar.end(), s[i]->istar);
-        if (it != v_istar.end()) {
-            s[i]->jstar = it - v_istar.begin();
-        } else {
-            s[i]->jstar = -1;
-        }
+        s[i]->jstar = starIndex[s[i]->istar];
+    }
+
+    std::vector<double> mWeight = getWeights(m, true);
+    std::vector<double> sWeight = getWeights(s, false);
+    bool update = cache.prepare(starIndex, nstar, mWeight, sWeight);
+    if (update) {
+        nstar = cache.getNstar();
+        cache.renumber(s, 0);
     }
 
     int ncoeff_offset = 1;  // Fit from 1st order only
@@ -1259,44 +1782,38 @@ Eigen::VectorXd fluxFit_abs1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
     int ncoeff = p->ncoeff - ncoeff_offset;
     int *xorder = &p->xorder[ncoeff_offset];
     int *yorder = &p->yorder[ncoeff_offset];
-    double u_max = p->u_max;
-    double v_max = p->v_max;
 
     Eigen::VectorXd pu(ncoeff);
     Eigen::VectorXd pv(ncoeff);
 
     int ndim;
+    int starBegin;
     if (solveCcd) {
-        ndim = nexp + nchip + ncoeff + nstar + 1;
+        starBegin = nexp + nchip + ncoeff;
+        ndim = starBegin + nstar + 1;
     } else {
-        ndim = nexp + ncoeff + nstar;
+        starBegin = nexp + ncoeff;
+        ndim = starBegin + nstar;
     }
     std::cout << "fluxFit_abs1: ndim = " << ndim << std::endl;
 
-    Eigen::MatrixXd a_data = Eigen::MatrixXd::Zero(ndim, ndim);
+    StarSystem a_data(ndim, starBegin, nstar);
     Eigen::VectorXd b_data = Eigen::VectorXd::Zero(ndim);
 
     double is2 = 1.0;
 
     if (solveCcd) {
         for (int i = 0; i < nMobs; i++) {
-            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999 ||
-                m[i]->mag_cat == -9999)
-                continue;
+            if (mWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], m[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], m[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(m[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(m[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = mBasis.getU(i);
+            double const *bv = mBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / (pow(m[i]->err, 2) + pow(m[i]->err_cat, 2));
+            is2 = mWeight[i] / (pow(m[i]->err, 2) + pow(m[i]->err_cat, 2));
 
             a_data(m[i]->jexp, m[i]->jexp) -= is2;
             a_data(m[i]->jexp, nexp + m[i]->jchip) -= is2;
@@ -1325,21 +1842,16 @@ Eigen::VectorXd fluxFit_abs1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
             }
         }
         for (int i = 0; i < nSobs; i++) {
-            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            if (sWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], s[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], s[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(s[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(s[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = sBasis.getU(i);
+            double const *bv = sBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(s[i]->err, 2);
+            is2 = sWeight[i] / pow(s[i]->err, 2);
 
             a_data(s[i]->jexp, s[i]->jexp) -= is2;
             a_data(s[i]->jexp, nexp + s[i]->jchip) -= is2;
@@ -1387,23 +1899,16 @@ Eigen::VectorXd fluxFit_abs1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
         b_data(ndim - 1) = 0;
     } else {
         for (int i = 0; i < nMobs; i++) {
-            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999 ||
-                m[i]->mag_cat == -9999)
-                continue;
+            if (mWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], m[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], m[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(m[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(m[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = mBasis.getU(i);
+            double const *bv = mBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / (pow(m[i]->err, 2) + pow(m[i]->err_cat, 2));
+            is2 = mWeight[i] / (pow(m[i]->err, 2) + pow(m[i]->err_cat, 2));
 
             a_data(m[i]->jexp, m[i]->jexp) -= is2;
             for (int k = 0; k < ncoeff; k++) {
@@ -1423,21 +1928,16 @@ Eigen::VectorXd fluxFit_abs1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
             }
         }
         for (int i = 0; i < nSobs; i++) {
-            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            if (sWeight[i] == 0.0) continue;
 
-            if (p->chebyshev) {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = Tn(xorder[k], s[i]->u / u_max);
-                    pv(k) = Tn(yorder[k], s[i]->v / v_max);
-                }
-            } else {
-                for (int k = 0; k < ncoeff; k++) {
-                    pu(k) = pow(s[i]->u / u_max, xorder[k]);
-                    pv(k) = pow(s[i]->v / v_max, yorder[k]);
-                }
+            double const *bu = sBasis.getU(i);
+            double const *bv = sBasis.getV(i);
+            for (int k = 0; k < ncoeff; k++) {
+                pu(k) = bu[xorder[k]];
+                pv(k) = bv[yorder[k]];
             }
 
-            is2 = 1.0 / pow(s[i]->err, 2);
+            is2 = sWeight[i] / pow(s[i]->err, 2);
 
             a_data(s[i]->jexp, s[i]->jexp) -= is2;
             for (int k = 0; k < ncoeff; k++) {
@@ -1467,7 +1967,10 @@ Eigen::VectorXd fluxFit_abs1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
         }
     }
 
-    Eigen::VectorXd solution = solveMatrix(ndim, a_data, b_data);
+    Eigen::VectorXd solution = cache.solve(a_data, b_data, update);
+    if (update) {
+        dropStars(s, 0, starIndex);
+    }
 
     if (solveCcd) {
         for (int i = 0; i < nSobs; i++) {
@@ -1498,162 +2001,230 @@ Eigen::VectorXd fluxFit_abs1(std::vector<Obs::Ptr> &m, int nmatch, std::vector<O
     return solution;
 }
 
-double calcChi2_rel(std::vector<Obs::Ptr> &m, std::vector<Obs::Ptr> &s, std::map<int, float> &fexp,
-                    std::map<int, float> &fchip,
-                    // FluxFitParams::Ptr p,
-                    FfpSet &ffpSet, bool mag = false) {
-    int nMobs = m.size();
-    int nSobs = s.size();
+namespace {
+// Sums of the residuals of a set of observations
+struct FluxStats {
+    FluxStats() : chi2(0.0), mag2(0.0), num(0) {}
 
-    double chi2 = 0.0;
-    double mag2 = 0.0;
-    int num = 0;
-    for (int i = 0; i < nMobs; i++) {
-        if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999) continue;
-        double val = m[i]->mag - 2.5 * log10(fexp[m[i]->iexp] * fchip[m[i]->ichip]);
-        val += ffpSet[m[i]->iexp]->eval(m[i]->u, m[i]->v);
-        chi2 += pow((val - m[i]->mag0) / m[i]->err, 2.0);
-        mag2 += pow((val - m[i]->mag0), 2.0);
-        num++;
-    }
-    for (int i = 0; i < nSobs; i++) {
-        if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
-        double val = s[i]->mag - 2.5 * log10(fexp[s[i]->iexp] * fchip[s[i]->ichip]);
-        val += ffpSet[s[i]->iexp]->eval(s[i]->u, s[i]->v);
-        chi2 += pow((val - s[i]->mag0) / s[i]->err, 2.0);
-        mag2 += pow((val - s[i]->mag0), 2.0);
+    void add(double chi2_, double mag2_) {
+        chi2 += chi2_;
+        mag2 += mag2_;
         num++;
     }
 
-    if (mag)
-        return mag2 / num;
-    else
-        return chi2 / num;
-}
-
-double calcChi2_abs(std::vector<Obs::Ptr> &m, std::vector<Obs::Ptr> &s, std::map<int, float> &fexp,
-                    std::map<int, float> &fchip,
-                    // FluxFitParams::Ptr p,
-                    FfpSet &ffpSet, bool mag = false) {
-    int nMobs = m.size();
-    int nSobs = s.size();
+    double chi2;  // sum of the squared normalized residuals
+    double mag2;  // sum of the squared residuals in magnitudes
+    int num;
+};
+
+/*
+ * The residuals of matchVec and sourceVec from a flux solution.  The
+ * magnitude offsets of the exposures and chips go into a table indexed by
+ * (jexp, jchip) and the FluxFitParams into a vector indexed by jexp, so
+ * that one pass evaluates each Obs once, from its basis, and accumulates
+ * chi2 in total, by exposure and by chip.  flag() then rejects from the
+ * stored residuals.  With absolute, the matched stars are compared with
+ * the catalog magnitudes instead of the star magnitudes.
+ */
+class FluxResiduals {
+public:
+    FluxResiduals(std::vector<Obs::Ptr> &m, std::vector<Obs::Ptr> &s, FluxBasis const &mBasis,
+                  FluxBasis const &sBasis, WcsDic &wcsDic, CcdSet &ccdSet, std::map<int, float> &fexp,
+                  std::map<int, float> &fchip, FfpSet &ffpSet, bool absolute)
+        : _m(m), _s(s), _absolute(absolute), _expStats(wcsDic.size()), _chipStats(ccdSet.size()) {
+        int nchip = ccdSet.size();
+        std::vector<FluxFitParams const *> ffp;
+        std::vector<double> offset;
+        offset.reserve(wcsDic.size() * nchip);
+        for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++) {
+            ffp.push_back(ffpSet[it->first].get());
+            for (CcdSet::iterator ic = ccdSet.begin(); ic != ccdSet.end(); ic++) {
+                offset.push_back(2.5 * log10(fexp[it->first] * fchip[ic->first]));
+            }
+        }
 
-    double chi2 = 0.0;
-    double mag2 = 0.0;
-    int num = 0;
-    for (int i = 0; i < nMobs; i++) {
-        if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999 ||
-            m[i]->mag_cat == -9999)
+        _mRes.resize(m.size());
+        for (size_t i = 0; i < m.size(); i++) {
+            _mRes[i] = NAN;
+            if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999) continue;
+            if (_absolute && m[i]->mag_cat == -9999) continue;
+            double val = m[i]->mag - offset[m[i]->jexp * nchip + m[i]->jchip];
+            val += ffp[m[i]->jexp]->evalFromBasis(mBasis.getU(i), mBasis.getV(i));
+            if (_absolute) {
+                _mRes[i] = val - m[i]->mag_cat;
+                add(m[i], pow(_mRes[i], 2.0) / (pow(m[i]->err, 2.0) + pow(m[i]->err_cat, 2.0)),
+                    pow(_mRes[i], 2.0));
+            } else {
+                _mRes[i] = val - m[i]->mag0;
+                add(m[i], pow(_mRes[i] / m[i]->err, 2.0), pow(_mRes[i], 2.0));
+            }
+        }
+        _sRes.resize(s.size());
+        for (size_t i = 0; i < s.size(); i++) {
+            _sRes[i] = NAN;
+            if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
+            double val = s[i]->mag - offset[s[i]->jexp * nchip + s[i]->jchip];
+            val += ffp[s[i]->jexp]->evalFromBasis(sBasis.getU(i), sBasis.getV(i));
+            _sRes[i] = val - s[i]->mag0;
+            add(s[i], pow(_sRes[i] / s[i]->err, 2.0), pow(_sRes[i], 2.0));
+        }
+    }
+
+    // Mean squared normalized residual
+    double getChi2() const { return _total.chi2 / _total.num; }
+    // Mean squared residual in magnitudes
+    double getErr2() const { return _total.mag2 / _total.num; }
+    FluxStats const &getExpStats(int jexp) const { return _expStats[jexp]; }
+    FluxStats const &getChipStats(int jchip) const { return _chipStats[jchip]; }
+
+    // Mark as bad the observations with a squared residual above e2, plus
+    // 9 times the squared catalog error for the absolute matches
+    int flag(double e2) {
+        int nreject = 0;
+        for (size_t i = 0; i < _m.size(); i++) {
+            if (std::isnan(_mRes[i])) continue;
+            double lim = _absolute ? e2 + 9.0 * pow(_m[i]->err_cat, 2.0) : e2;
+            if (pow(_mRes[i], 2.0) > lim) {
+                _m[i]->good = false;
+                nreject++;
+            }
+        }
+        for (size_t i = 0; i < _s.size(); i++) {
+            if (std::isnan(_sRes[i])) continue;
+            if (pow(_sRes[i], 2.0) > e2) {
+                _s[i]->good = false;
+                nreject++;
+            }
+        }
+        return nreject;
+    }
+
+private:
+    void add(Obs::Ptr const &o, double chi2, double mag2) {
+        _total.add(chi2, mag2);
+        _expStats[o->jexp].add(chi2, mag2);
+        _chipStats[o->jchip].add(chi2, mag2);
+    }
+
+    std::vector<Obs::Ptr> &_m;
+    std::vector<Obs::Ptr> &_s;
+    bool _absolute;
+    std::vector<double> _mRes;  // residual of each match, NaN if not used
+    std::vector<double> _sRes;  // residual of each source, NaN if not used
+    FluxStats _total;
+    std::vector<FluxStats> _expStats;
+    std::vector<FluxStats> _chipStats;
+};
+
+void printFluxStats(char const *name, FluxResiduals const &res, WcsDic &wcsDic, CcdSet &ccdSet) {
+    int j = 0;
+    for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++, j++) {
+        FluxStats const &st = res.getExpStats(j);
+        if (st.num == 0) {
+            printf("%s EXP %d: num = 0\n", name, it->first);
             continue;
-        double val = m[i]->mag - 2.5 * log10(fexp[m[i]->iexp] * fchip[m[i]->ichip]);
-        val += ffpSet[m[i]->iexp]->eval(m[i]->u, m[i]->v);
-        chi2 += pow(val - m[i]->mag_cat, 2.0) / (pow(m[i]->err, 2.0) + pow(m[i]->err_cat, 2.0));
-        mag2 += pow(val - m[i]->mag_cat, 2.0);
-        num++;
-    }
-    for (int i = 0; i < nSobs; i++) {
-        if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
-        double val = s[i]->mag - 2.5 * log10(fexp[s[i]->iexp] * fchip[s[i]->ichip]);
-        val += ffpSet[s[i]->iexp]->eval(s[i]->u, s[i]->v);
-        chi2 += pow((val - s[i]->mag0) / s[i]->err, 2.0);
-        mag2 += pow((val - s[i]->mag0), 2.0);
-        num++;
-    }
-
-    if (mag)
-        return mag2 / num;
-    else
-        return chi2 / num;
-}
-
-void flagObj_rel(std::vector<Obs::Ptr> &m, std::vector<Obs::Ptr> &s, double e2, std::map<int, float> &fexp,
-                 std::map<int, float> &fchip,
-                 // FluxFitParams::Ptr p)
-                 FfpSet &ffpSet) {
-    int nMobs = m.size();
-    int nSobs = s.size();
-
-    int nreject = 0;
-    for (int i = 0; i < nMobs; i++) {
-        if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999) continue;
-        double val = m[i]->mag - 2.5 * log10(fexp[m[i]->iexp] * fchip[m[i]->ichip]);
-        val += ffpSet[m[i]->iexp]->eval(m[i]->u, m[i]->v);
-        // double r2 = pow((val - m[i]->mag0)/m[i]->err, 2.0);
-        double r2 = pow((val - m[i]->mag0), 2.0);
-        if (r2 > e2) {
-            m[i]->good = false;
-            nreject++;
         }
+        printf("%s EXP %d: num = %d  chi2 = %e  err = %f (mag)\n", name, it->first, st.num,
+               st.chi2 / st.num, sqrt(st.mag2 / st.num));
     }
-    for (int i = 0; i < nSobs; i++) {
-        if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
-        double val = s[i]->mag - 2.5 * log10(fexp[s[i]->iexp] * fchip[s[i]->ichip]);
-        val += ffpSet[s[i]->iexp]->eval(s[i]->u, s[i]->v);
-        // double r2 = pow((val - s[i]->mag0)/s[i]->err, 2.0);
-        double r2 = pow((val - s[i]->mag0), 2.0);
-        if (r2 > e2) {
-            s[i]->good = false;
-            nreject++;
+    j = 0;
+    for (CcdSet::iterator it = ccdSet.begin(); it != ccdSet.end(); it++, j++) {
+        FluxStats const &st = res.getChipStats(j);
+        if (st.num == 0) {
+            printf("%s CCD %d: num = 0\n", name, it->first);
+            continue;
         }
+        printf("%s CCD %d: num = %d  chi2 = %e  err = %f (mag)\n", name, it->first, st.num,
+               st.chi2 / st.num, sqrt(st.mag2 / st.num));
     }
-
-    printf("flagObj_rel: nreject = %d\n", nreject);
 }
 
-void flagObj_abs(std::vector<Obs::Ptr> &m, std::vector<Obs::Ptr> &s, double e2, std::map<int, float> &fexp,
-                 std::map<int, float> &fchip,
-                 // FluxFitParams::Ptr p)
-                 FfpSet &ffpSet) {
-    int nMobs = m.size();
-    int nSobs = s.size();
+/*
+ * The stopping rule of FluxFitIteration, applied to the solutions of the
+ * iterations of a flux fit in turn.  The zero points are compared as
+ * magnitudes, -2.5 log10 of fexp and fchip.
+ */
+class FluxConvergence {
+public:
+    explicit FluxConvergence(FluxFitIteration &iteration) : _iteration(iteration), _chi2(NAN) {}
+
+    // Whether the solution of iteration k, with chi2, is the last
+    bool isLast(int k, double chi2, std::map<int, float> &fexp, std::map<int, float> &fchip, FfpSet &ffpSet) {
+        std::vector<double> mag;
+        for (std::map<int, float>::iterator it = fexp.begin(); it != fexp.end(); it++) {
+            mag.push_back(-2.5 * log10(it->second));
+        }
+        for (std::map<int, float>::iterator it = fchip.begin(); it != fchip.end(); it++) {
+            mag.push_back(-2.5 * log10(it->second));
+        }
+        std::vector<double> coeff;
+        for (FfpSet::iterator it = ffpSet.begin(); it != ffpSet.end(); it++) {
+            coeff.insert(coeff.end(), it->second->coeff, it->second->coeff + it->second->ncoeff);
+        }
 
-    int nreject = 0;
-    for (int i = 0; i < nMobs; i++) {
-        if (m[i]->jstar == -1 || !m[i]->good || m[i]->mag == -9999 || m[i]->err == -9999 ||
-            m[i]->mag_cat == -9999)
-            continue;
-        double val = m[i]->mag - 2.5 * log10(fexp[m[i]->iexp] * fchip[m[i]->ichip]);
-        // val += p->eval(m[i]->u, m[i]->v);
-        val += ffpSet[m[i]->iexp]->eval(m[i]->u, m[i]->v);
-        // double r2 = pow(val - m[i]->mag_cat, 2.0) / (pow(m[i]->err, 2.0) + pow(m[i]->err_cat, 2.0));
-        // if (r2 > e2) {
-        double r2 = pow(val - m[i]->mag_cat, 2.0);
-        if (r2 > e2 + 9.0 * pow(m[i]->err_cat, 2.0)) {
-            m[i]->good = false;
-            nreject++;
+        bool converged = false;
+        if (k > 0) {
+            double dMag = 0.0;
+            for (size_t i = 0; i < mag.size(); i++) dMag = std::max(dMag, fabs(mag[i] - _mag[i]));
+            double dCoeff = 0.0;
+            for (size_t i = 0; i < coeff.size(); i++) dCoeff = std::max(dCoeff, fabs(coeff[i] - _coeff[i]));
+            printf("FluxConvergence: dchi2 = %e  dmag = %e  dcoeff = %e\n", chi2 - _chi2, dMag, dCoeff);
+            converged = fabs(chi2 - _chi2) <= _iteration.chi2Tol * chi2 && dMag <= _iteration.magTol &&
+                        dCoeff <= _iteration.magTol;
         }
+        _chi2 = chi2;
+        _mag.swap(mag);
+        _coeff.swap(coeff);
+
+        if (k + 1 >= _iteration.maxIter) return stop(k, "maxIter");
+        if (converged) return stop(k, "converged");
+        return false;
     }
-    for (int i = 0; i < nSobs; i++) {
-        if (s[i]->jstar == -1 || !s[i]->good || s[i]->mag == -9999 || s[i]->err == -9999) continue;
-        double val = s[i]->mag - 2.5 * log10(fexp[s[i]->iexp] * fchip[s[i]->ichip]);
-        // val += p->eval(s[i]->u, s[i]->v);
-        val += ffpSet[s[i]->iexp]->eval(s[i]->u, s[i]->v);
-        // double r2 = pow((val - s[i]->mag0)/s[i]->err, 2.0);
-        double r2 = pow((val - s[i]->mag0), 2.0);
-        if (r2 > e2) {
-            s[i]->good = false;
-            nreject++;
-        }
+
+    // Whether iteration k, which rejected nreject observations, is the last
+    bool isLastAfterReject(int k, int nreject) {
+        if (nreject <= _iteration.maxReject) return stop(k, "rejection");
+        return false;
     }
 
-    printf("flagObj_abs: nreject = %d\n", nreject);
-}
+private:
+    bool stop(int k, char const *reason) {
+        _iteration.nIter = k + 1;
+        _iteration.reason = reason;
+        printf("FluxConvergence: stop after %d iterations (%s)\n", k + 1, reason);
+        return true;
+    }
+
+    FluxFitIteration &_iteration;
+    double _chi2;
+    std::vector<double> _mag;
+    std::vector<double> _coeff;
+};
+}  // namespace
 
 void fluxFitRelative(ObsVec &matchVec, int nmatch, ObsVec &sourceVec, int nsource, WcsDic &wcsDic,
                      CcdSet &ccdSet, std::map<int, float> &fexp, std::map<int, float> &fchip, FfpSet &ffpSet,
-                     bool solveCcd, bool common) {
+                     bool solveCcd, bool common, double maxChurn, FluxFitIteration &iteration) {
     int nexp = wcsDic.size();
     int nchip = ccdSet.size();
 
-    for (int k = 0; k < 3; k++) {
+    FluxFitParams const &p = *ffpSet.begin()->second;
+    FluxBasis mBasis(matchVec, p);
+    FluxBasis sBasis(sourceVec, p);
+    FluxFitCache cache(maxChurn);
+    FluxConvergence convergence(iteration);
+
+    for (int k = 0;; k++) {
         Eigen::VectorXd fsol;
         for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++) {
             ffpSet[it->first]->coeff[0] = 0.0;
         }
         if (common) {
-            fsol = fluxFit_rel1(matchVec, nmatch, sourceVec, nsource, nexp, nchip, ffpSet, solveCcd);
+            fsol = fluxFit_rel1(matchVec, nmatch, sourceVec, nsource, nexp, nchip, ffpSet, solveCcd,
+                                mBasis, sBasis, cache);
         } else {
-            fsol = fluxFit_rel(matchVec, nmatch, sourceVec, nsource, nexp, nchip, ffpSet, solveCcd);
+            fsol = fluxFit_rel(matchVec, nmatch, sourceVec, nsource, nexp, nchip, ffpSet, solveCcd,
+                               mBasis, sBasis, cache);
         }
         int i = 0;
         for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++, i++) {
@@ -1675,13 +2246,24 @@ void fluxFitRelative(ObsVec &matchVec, int nmatch, ObsVec &sourceVec, int nsourc
                 fchip[it->first] = 1.0;
             }
         }
-        double chi2f = calcChi2_rel(matchVec, sourceVec, fexp, fchip, ffpSet);
+        FluxResiduals res(matchVec, sourceVec, mBasis, sBasis, wcsDic, ccdSet, fexp, fchip, ffpSet, false);
+        double chi2f = res.getChi2();
         printf("fluxFitRelative: chi2f = %e\n", chi2f);
-        double e2f = calcChi2_rel(matchVec, sourceVec, fexp, fchip, ffpSet, true);
+        double e2f = res.getErr2();
         printf("fluxFitRelative: err = %f (mag)\n", sqrt(e2f));
-        // flagObj_rel(matchVec, sourceVec, 9.0, fexp, fchip, ffp);
-        if (k < 2) flagObj_rel(matchVec, sourceVec, 9.0 * e2f, fexp, fchip, ffpSet);
+        bool last = convergence.isLast(k, chi2f, fexp, fchip, ffpSet);
+        if (!last) {
+            int nreject = res.flag(9.0 * e2f);
+            printf("fluxFitRelative: nreject = %d\n", nreject);
+            last = convergence.isLastAfterReject(k, nreject);
+        }
+        if (last) {
+            printFluxStats("fluxFitRelative", res, wcsDic, ccdSet);
+            break;
+        }
     }
+    iteration.nUpdate = cache.getNumUpdate();
+    iteration.nLowRank = cache.getNumLowRank();
 
     printf("fluxFitRelative FFP:   ");
     for (FfpSet::iterator it = ffpSet.begin(); it != ffpSet.end(); it++) {
@@ -1709,19 +2291,27 @@ void fluxFitRelative(ObsVec &matchVec, int nmatch, ObsVec &sourceVec, int nsourc
 
 void fluxFitAbsolute(ObsVec &matchVec, int nmatch, ObsVec &sourceVec, int nsource, WcsDic &wcsDic,
                      CcdSet &ccdSet, std::map<int, float> &fexp, std::map<int, float> &fchip, FfpSet &ffpSet,
-                     bool solveCcd, bool common) {
+                     bool solveCcd, bool common, double maxChurn, FluxFitIteration &iteration) {
     int nexp = wcsDic.size();
     int nchip = ccdSet.size();
 
-    for (int k = 0; k < 3; k++) {
+    FluxFitParams const &p = *ffpSet.begin()->second;
+    FluxBasis mBasis(matchVec, p);
+    FluxBasis sBasis(sourceVec, p);
+    FluxFitCache cache(maxChurn);
+    FluxConvergence convergence(iteration);
+
+    for (int k = 0;; k++) {
         Eigen::VectorXd fsol;
         for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++) {
             ffpSet[it->first]->coeff[0] = 0.0;
         }
         if (common) {
-            fsol = fluxFit_abs1(matchVec, nmatch, sourceVec, nsource, nexp, nchip, ffpSet, solveCcd);
+            fsol = fluxFit_abs1(matchVec, nmatch, sourceVec, nsource, nexp, nchip, ffpSet, solveCcd,
+                                mBasis, sBasis, cache);
         } else {
-            fsol = fluxFit_abs(matchVec, nmatch, sourceVec, nsource, nexp, nchip, ffpSet, solveCcd);
+            fsol = fluxFit_abs(matchVec, nmatch, sourceVec, nsource, nexp, nchip, ffpSet, solveCcd,
+                               mBasis, sBasis, cache);
         }
         int i = 0;
         for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++, i++) {
@@ -1743,13 +2333,24 @@ void fluxFitAbsolute(ObsVec &matchVec, int nmatch, ObsVec &sourceVec, int nsourc
                 fchip[it->first] = 1.0;
             }
         }
-        double chi2f = calcChi2_abs(matchVec, sourceVec, fexp, fchip, ffpSet);
+        FluxResiduals res(matchVec, sourceVec, mBasis, sBasis, wcsDic, ccdSet, fexp, fchip, ffpSet, true);
+        double chi2f = res.getChi2();
         printf("fluxFitAbsolute: chi2f = %e\n", chi2f);
-        double e2f = calcChi2_abs(matchVec, sourceVec, fexp, fchip, ffpSet, true);
+        double e2f = res.getErr2();
         printf("fluxFitAbsolute: err = %f (mag)\n", sqrt(e2f));
-        // flagObj_abs(matchVec, sourceVec, 9.0, fexp, fchip, ffp);
-        if (k < 2) flagObj_abs(matchVec, sourceVec, 9.0 * e2f, fexp, fchip, ffpSet);
+        bool last = convergence.isLast(k, chi2f, fexp, fchip, ffpSet);
+        if (!last) {
+            int nreject = res.flag(9.0 * e2f);
+            printf("fluxFitAbsolute: nreject = %d\n", nreject);
+            last = convergence.isLastAfterReject(k, nreject);
+        }
+        if (last) {
+            printFluxStats("fluxFitAbsolute", res, wcsDic, ccdSet);
+            break;
+        }
     }
+    iteration.nUpdate = cache.getNumUpdate();
+    iteration.nLowRank = cache.getNumLowRank();
 
     printf("fluxFitAbsolute FFP:   ");
     for (FfpSet::iterator it = ffpSet.begin(); it != ffpSet.end(); it++) {
@@ -1777,14 +2378,21 @@ void fluxFitAbsolute(ObsVec &matchVec, int nmatch, ObsVec &sourceVec, int nsourc
 
 void lsst::meas::mosaic::fluxFit(bool absolute, bool common, ObsVec &matchVec, int nmatch, ObsVec &sourceVec,
                                  int nsource, WcsDic &wcsDic, CcdSet &ccdSet, std::map<int, float> &fexp,
-                                 std::map<int, float> &fchip, FfpSet &ffpSet, bool solveCcd) {
+                                 std::map<int, float> &fchip, FfpSet &ffpSet, bool solveCcd,
+                                 double maxChurn, FluxFitIteration *iteration) {
     printf("fluxFit ...\n");
+    FluxFitIteration defaultIteration;
+    if (iteration == NULL) iteration = &defaultIteration;
+    if (iteration->maxIter < 1) {
+        throw LSST_EXCEPT(pex::exceptions::InvalidParameterError,
+                          str(boost::format("maxIter is %d; must be at least 1") % iteration->maxIter));
+    }
     if (absolute) {
         fluxFitAbsolute(matchVec, nmatch, sourceVec, nsource, wcsDic, ccdSet, fexp, fchip, ffpSet, solveCcd,
-                        common);
+                        common, maxChurn, *iteration);
     } else {
         fluxFitRelative(matchVec, nmatch, sourceVec, nsource, wcsDic, ccdSet, fexp, fchip, ffpSet, solveCcd,
-                        common);
+                        common, maxChurn, *iteration);
     }
 }
 
@@ -1848,98 +2456,99 @@ lsst::daf::base::PropertySet::Ptr lsst::meas::mosaic::metadataFromFluxFitParams(
     return metadata;
 }
 
-std::shared_ptr<lsst::afw::image::Image<float>> lsst::meas::mosaic::getFCorImg(
-    FluxFitParams::Ptr &p, PTR(lsst::afw::cameraGeom::Detector) & ccd, Coeff::Ptr &coeff) {
-    int width = getWidth(ccd);
-    int height = getHeight(ccd);
-
-    std::shared_ptr<lsst::afw::image::Image<float>> img(new lsst::afw::image::Image<float>(width, height));
-
-    Eigen::VectorXd vals(width);
-
-    int interpLength = 100;
-
-    for (int y = 0; y != height; y++) {
-        for (int x = 0; x < width + interpLength; x += interpLength) {
-            int interval = interpLength;
-            int xend = x + interval;
-            int stop = interval;
-            if (xend >= width) {
-                xend = width - 1;
-                interval = xend - x;
-                stop = interval + 1;
-            }
-
-            afw::geom::Point2D uv =
-                detPxToFpPxRot(ccd, afw::geom::Point2D(x, y)) + afw::geom::Extent2D(coeff->x0, coeff->y0);
-            double val0 = p->eval(uv.getX(), uv.getY());
-            uv = detPxToFpPxRot(ccd, afw::geom::Point2D(xend, y)) + afw::geom::Extent2D(coeff->x0, coeff->y0);
-            double val1 = p->eval(uv.getX(), uv.getY());
-
-            for (int i = 0; i < stop; i++) {
-                vals[x + i] = val0 + (val1 - val0) / interval * i;
-            }
-        }
+namespace {
+int const FCOR_INTERP_LENGTH = 100;  // pixels between the nodes of the flux correction grid
 
-        lsst::afw::image::Image<float>::x_iterator begin = img->row_begin(y);
-        lsst::afw::image::Image<float>::x_iterator end = img->row_end(y);
-
-        for (lsst::afw::image::Image<float>::x_iterator ptr = begin; ptr != end; ptr++) {
-            int x = ptr - begin;
-            *ptr = pow(10., -0.4 * vals(x));
-        }
+// The nodes along an axis of length n: every FCOR_INTERP_LENGTH pixels, and the last pixel
+std::vector<int> getFCorNodes(int n) {
+    std::vector<int> nodes;
+    for (int i = 0; i < n - 1; i += FCOR_INTERP_LENGTH) {
+        nodes.push_back(i);
     }
-
-    return img;
+    nodes.push_back(std::max(n - 1, 0));
+    return nodes;
 }
 
-std::shared_ptr<lsst::afw::image::Image<float>> lsst::meas::mosaic::getFCorImg(FluxFitParams::Ptr &p,
-                                                                               int width, int height) {
+/*
+ * The image of 10^(-0.4*mag(x, y)), with mag evaluated on the grid of
+ * getFCorNodes and interpolated bilinearly in between.  Along a row mag is
+ * linear between nodes, so the flux is geometric and takes two
+ * exponentials per interval rather than one per pixel.  Rows are split
+ * across nThreads threads (0 for one per CPU).
+ */
+template <typename MagFunc>
+std::shared_ptr<lsst::afw::image::Image<float>> makeFCorImg(int width, int height, MagFunc const &mag,
+                                                            int nThreads) {
     std::shared_ptr<lsst::afw::image::Image<float>> img(new lsst::afw::image::Image<float>(width, height));
+    if (width <= 0 || height <= 0) return img;
 
-    Eigen::VectorXd vals(width);
-
-    int interpLength = 100;
+    std::vector<int> const xNodes = getFCorNodes(width);
+    std::vector<int> const yNodes = getFCorNodes(height);
+    int const nx = xNodes.size();
+    int const ny = yNodes.size();
+    std::vector<double> grid(nx * ny);
+    parallelFor(ny, nThreads, [&](long begin, long end) {
+        for (long j = begin; j < end; j++) {
+            for (int i = 0; i < nx; i++) {
+                grid[j * nx + i] = mag(xNodes[i], yNodes[j]);
+            }
+        }
+    });
 
-    for (int y = 0; y != height; y++) {
-        for (int x = 0; x < width + interpLength; x += interpLength) {
-            int interval = interpLength;
-            int xend = x + interval;
-            int stop = interval;
-            if (xend >= width) {
-                xend = width - 1;
-                interval = xend - x;
-                stop = interval + 1;
+    double const k = -0.4 * M_LN10;
+    parallelFor(height, nThreads, [&](long begin, long end) {
+        std::vector<double> row(nx);
+        int j = 0;
+        for (long y = begin; y < end; y++) {
+            while (j + 2 < ny && yNodes[j + 1] <= y) j++;
+            int const j1 = std::min(j + 1, ny - 1);
+            double const t = (j1 == j) ? 0.0 : double(y - yNodes[j]) / (yNodes[j1] - yNodes[j]);
+            for (int i = 0; i < nx; i++) {
+                row[i] = grid[j * nx + i] + (grid[j1 * nx + i] - grid[j * nx + i]) * t;
             }
 
-            double u = x;
-            double v = y;
-            double val0 = p->eval(u, v);
-            u = xend;
-            v = y;
-            double val1 = p->eval(u, v);
-            for (int i = 0; i < stop; i++) {
-                vals[x + i] = val0 + (val1 - val0) / interval * i;
+            lsst::afw::image::Image<float>::x_iterator ptr = img->row_begin(y);
+            if (nx == 1) {
+                ptr[0] = exp(k * row[0]);
+                continue;
+            }
+            for (int i = 0; i + 1 < nx; i++) {
+                int const x0 = xNodes[i];
+                int const x1 = xNodes[i + 1];
+                int const stop = (i + 2 == nx) ? x1 + 1 : x1;
+                double f = exp(k * row[i]);
+                double const r = exp(k * (row[i + 1] - row[i]) / (x1 - x0));
+                for (int x = x0; x < stop; x++) {
+                    ptr[x] = f;
+                    f *= r;
+                }
             }
         }
+    });
 
-        lsst::afw::image::Image<float>::x_iterator begin = img->row_begin(y);
-        lsst::afw::image::Image<float>::x_iterator end = img->row_end(y);
-
-        for (lsst::afw::image::Image<float>::x_iterator ptr = begin; ptr != end; ptr++) {
-            int x = ptr - begin;
+    return img;
+}
+}  // namespace
 
-            *ptr = pow(10., -0.4 * vals(x));
-        }
-    }
+std::shared_ptr<lsst::afw::image::Image<float>> lsst::meas::mosaic::getFCorImg(
+    FluxFitParams::Ptr &p, PTR(lsst::afw::cameraGeom::Detector) & ccd, Coeff::Ptr &coeff, int nThreads) {
+    afw::geom::Extent2D const offset(coeff->x0, coeff->y0);
+    return makeFCorImg(getWidth(ccd), getHeight(ccd), [&p, &ccd, &offset](int x, int y) {
+        afw::geom::Point2D uv = detPxToFpPxRot(ccd, afw::geom::Point2D(x, y)) + offset;
+        return p->eval(uv.getX(), uv.getY());
+    }, nThreads);
+}
 
-    return img;
+std::shared_ptr<lsst::afw::image::Image<float>> lsst::meas::mosaic::getFCorImg(FluxFitParams::Ptr &p,
+                                                                               int width, int height,
+                                                                               int nThreads) {
+    return makeFCorImg(width, height, [&p](int x, int y) { return p->eval(x, y); }, nThreads);
 }
 
 std::shared_ptr<lsst::afw::image::Image<float>> lsst::meas::mosaic::getFCorImg(
-    FluxFitParams::Ptr &p, PTR(lsst::afw::cameraGeom::Detector) & ccd) {
+    FluxFitParams::Ptr &p, PTR(lsst::afw::cameraGeom::Detector) & ccd, int nThreads) {
     int width = getWidth(ccd);
     int height = getHeight(ccd);
 
-    return getFCorImg(p, width, height);
+    return getFCorImg(p, width, height, nThreads);
 }
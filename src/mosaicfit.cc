@@ -1,7 +1,10 @@
 #include <strings.h>
+#include <algorithm>
+#include <chrono>
 #include <cmath>
 #include <ctime>
 #include <memory>
+#include <unordered_map>
 
 #include "dynamic_lapack.h"
 
@@ -12,6 +15,7 @@
 #include "lsst/meas/mosaic/mosaicfit.h"
 #include "lsst/meas/mosaic/shimCameraGeom.h"
 #include "lsst/meas/mosaic/snapshot.h"
+#include "parallel.h"
 
 #define D2R (M_PI / 180.)
 #define R2D (180. / M_PI)
@@ -22,6 +26,7 @@ using namespace lsst::meas::mosaic;
 #include "Eigen/LU"
 
 Eigen::VectorXd solveMatrix(long size, Eigen::MatrixXd &a_data, Eigen::VectorXd &b_data);
+std::vector<int> indexStars(int const *num, int n, int *nstar);
 
 static void decodeSipHeader(CONST_PTR(lsst::daf::base::PropertySet) const &fitsMetadata,
                             std::string const &which, Eigen::MatrixXd *m);
@@ -485,14 +490,37 @@ void KDTree::_initializeMatches(SourceMatchSet &m, int depth) {
 }
 
 KDTree::~KDTree() {
-    if (this->left != NULL) {
-        this->left.reset();
+    // Unlink the subtrees here rather than through nested destructors, which
+    // would recurse once per level of a degenerate tree.
+    std::vector<KDTree::Ptr> stack;
+    if (this->left != NULL) stack.push_back(std::move(this->left));
+    if (this->right != NULL) stack.push_back(std::move(this->right));
+    while (!stack.empty()) {
+        KDTree::Ptr node = std::move(stack.back());
+        stack.pop_back();
+        if (node.use_count() == 1) {
+            if (node->left != NULL) stack.push_back(std::move(node->left));
+            if (node->right != NULL) stack.push_back(std::move(node->right));
+        }
     }
+}
 
-    if (this->right != NULL) {
-        this->right.reset();
+namespace {
+// Nodes of the tree in pre-order (node, left subtree, right subtree), without recursion
+template <typename NodeT>
+std::vector<NodeT *> preorderNodes(NodeT *root) {
+    std::vector<NodeT *> nodes;
+    std::vector<NodeT *> stack(1, root);
+    while (!stack.empty()) {
+        NodeT *node = stack.back();
+        stack.pop_back();
+        nodes.push_back(node);
+        if (node->right != NULL) stack.push_back(node->right.get());
+        if (node->left != NULL) stack.push_back(node->left.get());
     }
+    return nodes;
 }
+}  // namespace
 
 KDTree::ConstPtr KDTree::search(lsst::afw::geom::SpherePoint const &sky) const {
     lsst::afw::geom::Angle ra = sky.getLongitude();
@@ -552,14 +580,7 @@ void KDTree::add(SourceMatch const &m) {
     }
 }
 
-int KDTree::count(void) {
-    int n = 1;
-
-    if (this->left != NULL) n += this->left->count();
-    if (this->right != NULL) n += this->right->count();
-
-    return n;
-}
+int KDTree::count(void) { return preorderNodes(this).size(); }
 
 KDTree::ConstPtr KDTree::findSource(Source const &s) const {
     lsst::afw::geom::Angle ra = s.getRa();
@@ -705,27 +726,27 @@ void KDTree::add(PTR(Source) s, lsst::afw::geom::Angle d_lim) {
 }
 
 SourceGroup KDTree::mergeMat() const {
+    std::vector<KDTree const *> nodes = preorderNodes(this);
     SourceGroup sg;
-    sg.push_back(this->set);
-
-    if (this->left != NULL) {
-        SourceGroup sg_left = this->left->mergeMat();
-        for (size_t i = 0; i < sg_left.size(); i++) {
-            sg.push_back(sg_left[i]);
-        }
-    }
-    if (this->right != NULL) {
-        SourceGroup sg_right = this->right->mergeMat();
-        for (size_t i = 0; i < sg_right.size(); i++) {
-            sg.push_back(sg_right[i]);
-        }
+    sg.reserve(nodes.size());
+    for (size_t i = 0; i < nodes.size(); i++) {
+        sg.push_back(nodes[i]->set);
     }
     return sg;
 }
 
 SourceGroup KDTree::mergeSource(unsigned int minNumMatch) {
+    std::vector<KDTree *> nodes = preorderNodes(this);
+    size_t n = 0;
+    for (size_t i = 0; i < nodes.size(); i++) {
+        if (nodes[i]->set.size() >= minNumMatch) n++;
+    }
+
     SourceGroup sg;
-    if (this->set.size() >= minNumMatch) {
+    sg.reserve(n);
+    for (size_t k = 0; k < nodes.size(); k++) {
+        SourceSet &set = nodes[k]->set;
+        if (set.size() < minNumMatch) continue;
         double sr = 0.0;
         double sd = 0.0;
         double sm = 0.0;
@@ -741,81 +762,353 @@ SourceGroup KDTree::mergeSource(unsigned int minNumMatch) {
         double mag = sm / sn;
         PTR(Source)
         source(new Source(lsst::afw::geom::SpherePoint(ra, dec, lsst::afw::geom::degrees), mag));
-        this->set.insert(set.begin(), source);
-        sg.push_back(this->set);
+        set.insert(set.begin(), source);
+        sg.push_back(set);
+    }
+    return sg;
+}
+
+void KDTree::printMat() const {
+    std::vector<KDTree const *> nodes = preorderNodes(this);
+    for (size_t k = 0; k < nodes.size(); k++) {
+        double ra = nodes[k]->set[0]->getRa().asDegrees();
+        double dec = nodes[k]->set[0]->getDec().asDegrees();
+
+        std::cout << "circle(" << ra << "," << dec << ",5.0\") # color=magenta" << std::endl;
+    }
+}
+
+void KDTree::printSource() const {
+    std::vector<KDTree const *> nodes = preorderNodes(this);
+    for (size_t k = 0; k < nodes.size(); k++) {
+        SourceSet const &set = nodes[k]->set;
+        double sr = 0.0;
+        double sd = 0.0;
+        double sn = 0.0;
+        for (size_t i = 0; i < set.size(); i++) {
+            sr += set[i]->getRa().asDegrees();
+            sd += set[i]->getDec().asDegrees();
+            sn += 1.0;
+        }
+        double ra = sr / sn;
+        double dec = sd / sn;
+
+        if (sn >= 2.0) {
+            std::cout << "circle(" << ra << "," << dec << ",5.0\") # color=red" << std::endl;
+        } else {
+            std::cout << "circle(" << ra << "," << dec << ",5.0\")" << std::endl;
+        }
+    }
+}
+
+FlatKDTree::FlatKDTree(std::vector<double> const &xyz, int begin, int end) : _begin(begin) {
+    if (end < 0) {
+        end = xyz.size() / 3;
+    }
+    _points.resize(end - begin);
+    for (int i = begin; i < end; i++) {
+        Point &p = _points[i - begin];
+        p.v[0] = xyz[3 * i];
+        p.v[1] = xyz[3 * i + 1];
+        p.v[2] = xyz[3 * i + 2];
+        p.index = i;
+        p.axis = 0;
+    }
+    _build();
+}
+
+FlatKDTree::FlatKDTree(ndarray::Array<double const, 1> const &ra, ndarray::Array<double const, 1> const &dec)
+        : _begin(0) {
+    if (ra.getSize<0>() != dec.getSize<0>()) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                          (boost::format("Size mismatch between ra (%d) and dec (%d)") % ra.getSize<0>() %
+                           dec.getSize<0>()).str());
+    }
+    _points.resize(ra.getSize<0>());
+    for (size_t i = 0; i < _points.size(); i++) {
+        toVector(ra[i] * D2R, dec[i] * D2R, _points[i].v);
+        _points[i].index = i;
+        _points[i].axis = 0;
+    }
+    _build();
+}
+
+void FlatKDTree::toVector(double ra, double dec, double v[3]) {
+    double cosDec = cos(dec);
+    v[0] = cosDec * cos(ra);
+    v[1] = cosDec * sin(ra);
+    v[2] = sin(dec);
+}
+
+void FlatKDTree::_build() {
+    // Split each range at its median along the axis of largest extent.  The
+    // ranges are processed from an explicit stack, so there is no recursion.
+    std::vector<std::pair<int, int> > stack;
+    if (_points.size() > 1) {
+        stack.push_back(std::make_pair(0, static_cast<int>(_points.size())));
+    }
+    while (!stack.empty()) {
+        int lo = stack.back().first;
+        int hi = stack.back().second;
+        stack.pop_back();
+
+        double vmin[3] = {2.0, 2.0, 2.0};
+        double vmax[3] = {-2.0, -2.0, -2.0};
+        for (int i = lo; i < hi; i++) {
+            for (int k = 0; k < 3; k++) {
+                vmin[k] = std::min(vmin[k], _points[i].v[k]);
+                vmax[k] = std::max(vmax[k], _points[i].v[k]);
+            }
+        }
+        int axis = 0;
+        for (int k = 1; k < 3; k++) {
+            if (vmax[k] - vmin[k] > vmax[axis] - vmin[axis]) axis = k;
+        }
+
+        int mid = lo + (hi - lo) / 2;
+        std::nth_element(_points.begin() + lo, _points.begin() + mid, _points.begin() + hi,
+                         [axis](Point const &a, Point const &b) { return a.v[axis] < b.v[axis]; });
+        _points[mid].axis = axis;
+
+        if (mid - lo > 1) stack.push_back(std::make_pair(lo, mid));
+        if (hi - mid - 1 > 1) stack.push_back(std::make_pair(mid + 1, hi));
     }
+}
 
-    if (this->left != NULL) {
-        SourceGroup sg_left = this->left->mergeSource(minNumMatch);
-        for (size_t i = 0; i < sg_left.size(); i++) {
-            sg.push_back(sg_left[i]);
+namespace {
+struct FlatKDTreeRange {
+    int lo;
+    int hi;
+    double bound;  // lower bound on the squared chord to any point in the range
+};
+}  // namespace
+
+int FlatKDTree::findNearest(double const v[3], double maxChord2, double *chord2) const {
+    int best = -1;
+    double bestChord2 = maxChord2;
+
+    // The depth of the tree is at most log2(size) + 1, and each level leaves
+    // at most one range on the stack.
+    FlatKDTreeRange stack[128];
+    int n = 0;
+    if (!_points.empty()) {
+        stack[n++] = {0, size(), 0.0};
+    }
+    while (n > 0) {
+        FlatKDTreeRange r = stack[--n];
+        if (r.bound >= bestChord2) continue;
+
+        int mid = r.lo + (r.hi - r.lo) / 2;
+        Point const &p = _points[mid];
+        double dx = v[0] - p.v[0];
+        double dy = v[1] - p.v[1];
+        double dz = v[2] - p.v[2];
+        double d2 = dx * dx + dy * dy + dz * dz;
+        if (d2 < bestChord2) {
+            bestChord2 = d2;
+            best = p.index;
         }
+        if (r.hi - r.lo == 1) continue;
+
+        double diff = v[p.axis] - p.v[p.axis];
+        FlatKDTreeRange lower = {r.lo, mid, r.bound};
+        FlatKDTreeRange upper = {mid + 1, r.hi, r.bound};
+        FlatKDTreeRange &far = diff < 0 ? upper : lower;
+        FlatKDTreeRange &near = diff < 0 ? lower : upper;
+        far.bound = std::max(r.bound, diff * diff);
+        // Push the far side first so that the near side is searched first
+        if (far.hi > far.lo) stack[n++] = far;
+        if (near.hi > near.lo) stack[n++] = near;
+    }
+
+    if (best >= 0 && chord2 != NULL) {
+        *chord2 = bestChord2;
     }
-    if (this->right != NULL) {
-        SourceGroup sg_right = this->right->mergeSource(minNumMatch);
-        for (size_t i = 0; i < sg_right.size(); i++) {
-            sg.push_back(sg_right[i]);
+    return best;
+}
+
+void FlatKDTree::findWithin(double const v[3], double maxChord2, std::vector<int> &result) const {
+    FlatKDTreeRange stack[128];
+    int n = 0;
+    if (!_points.empty()) {
+        stack[n++] = {0, size(), 0.0};
+    }
+    while (n > 0) {
+        FlatKDTreeRange r = stack[--n];
+        if (r.bound >= maxChord2) continue;
+
+        int mid = r.lo + (r.hi - r.lo) / 2;
+        Point const &p = _points[mid];
+        double dx = v[0] - p.v[0];
+        double dy = v[1] - p.v[1];
+        double dz = v[2] - p.v[2];
+        if (dx * dx + dy * dy + dz * dz < maxChord2) {
+            result.push_back(p.index);
         }
+        if (r.hi - r.lo == 1) continue;
+
+        double diff = v[p.axis] - p.v[p.axis];
+        FlatKDTreeRange lower = {r.lo, mid, r.bound};
+        FlatKDTreeRange upper = {mid + 1, r.hi, r.bound};
+        (diff < 0 ? upper : lower).bound = std::max(r.bound, diff * diff);
+        if (lower.hi > lower.lo) stack[n++] = lower;
+        if (upper.hi > upper.lo) stack[n++] = upper;
     }
-    return sg;
 }
 
-void KDTree::printMat() const {
-    double ra = set[0]->getRa().asDegrees();
-    double dec = set[0]->getDec().asDegrees();
+int FlatKDTree::findNearest(lsst::afw::geom::SpherePoint const &sky, lsst::afw::geom::Angle radius) const {
+    double v[3];
+    toVector(sky.getLongitude().asRadians(), sky.getLatitude().asRadians(), v);
+    return findNearest(v, chord2(radius));
+}
 
-    std::cout << "circle(" << ra << "," << dec << ",5.0\") # color=magenta" << std::endl;
+std::vector<int> FlatKDTree::findWithin(lsst::afw::geom::SpherePoint const &sky,
+                                        lsst::afw::geom::Angle radius) const {
+    double v[3];
+    toVector(sky.getLongitude().asRadians(), sky.getLatitude().asRadians(), v);
+    std::vector<int> result;
+    findWithin(v, chord2(radius), result);
+    return result;
+}
 
-    if (this->left != NULL) {
-        this->left->printMat();
+SourceGroupTree::SourceGroupTree(SourceGroup g, bool indexMembers)
+        : groups(std::move(g)), _maxChord2(0.0), _indexed(indexMembers) {
+    // An empty group has no position to put in the tree, such as that of the
+    // detections of a visit without matches in SourceGroupBuilder::addVisit
+    groups.erase(std::remove_if(groups.begin(), groups.end(),
+                                [](SourceSet const &set) { return set.empty(); }),
+                 groups.end());
+    std::vector<double> xyz(3 * groups.size());
+    for (size_t i = 0; i < groups.size(); i++) {
+        double *c = &xyz[3 * i];
+        FlatKDTree::toVector(*groups[i][0], c);
+        if (indexMembers) {
+            for (size_t j = 0; j < groups[i].size(); j++) {
+                _members.insert(SourceKey(*groups[i][j]));
+            }
+        }
+        for (size_t j = 1; j < groups[i].size(); j++) {
+            double v[3];
+            FlatKDTree::toVector(*groups[i][j], v);
+            double d2 = (v[0] - c[0]) * (v[0] - c[0]) + (v[1] - c[1]) * (v[1] - c[1]) +
+                        (v[2] - c[2]) * (v[2] - c[2]);
+            _maxChord2 = std::max(_maxChord2, d2);
+        }
     }
-    if (this->right != NULL) {
-        this->right->printMat();
+    _tree = FlatKDTree(xyz);
+}
+
+bool SourceGroupTree::findSource(Source const &s) const {
+    // Any member closer than 0.01 arcsec to s counts; the groups to check are
+    // those whose first member is within that plus the largest group extent.
+    static double const matchChord2 =
+            FlatKDTree::chord2(lsst::afw::geom::Angle(0.01, lsst::afw::geom::arcseconds));
+    double v[3];
+    FlatKDTree::toVector(s, v);
+    double r = sqrt(_maxChord2) + sqrt(matchChord2);
+    std::vector<int> candidates;
+    _tree.findWithin(v, r * r * (1.0 + 1.0e-12), candidates);
+    for (size_t i = 0; i < candidates.size(); i++) {
+        SourceSet const &set = groups[candidates[i]];
+        for (size_t j = 0; j < set.size(); j++) {
+            double w[3];
+            FlatKDTree::toVector(*set[j], w);
+            double d2 = (v[0] - w[0]) * (v[0] - w[0]) + (v[1] - w[1]) * (v[1] - w[1]) +
+                        (v[2] - w[2]) * (v[2] - w[2]);
+            if (d2 < matchChord2) return true;
+        }
     }
+    return false;
 }
 
-void KDTree::printSource() const {
-    double sr = 0.0;
-    double sd = 0.0;
-    double sn = 0.0;
-    for (size_t i = 0; i < set.size(); i++) {
-        sr += set[i]->getRa().asDegrees();
-        sd += set[i]->getDec().asDegrees();
-        sn += 1.0;
-    }
-    double ra = sr / sn;
-    double dec = sd / sn;
-
-    if (sn >= 2.0) {
-        std::cout << "circle(" << ra << "," << dec << ",5.0\") # color=red" << std::endl;
-    } else {
-        std::cout << "circle(" << ra << "," << dec << ",5.0\")" << std::endl;
+bool SourceGroupTree::contains(Source const &s) const {
+    if (!_indexed) {
+        return findSource(s);
     }
+    return _members.find(SourceKey(s)) != _members.end();
+}
+
+int SourceGroupTree::findNearest(Source const &s, lsst::afw::geom::Angle d_lim) const {
+    return _tree.findNearest(s.getSky(), d_lim);
+}
 
-    if (this->left != NULL) {
-        this->left->printSource();
+SourceGroup SourceGroupTree::mergeMat() const { return groups; }
+
+SourceGroup SourceGroupTree::mergeSource(unsigned int minNumMatch) const {
+    size_t n = 0;
+    for (size_t i = 0; i < groups.size(); i++) {
+        if (groups[i].size() >= minNumMatch) n++;
     }
-    if (this->right != NULL) {
-        this->right->printSource();
+
+    SourceGroup sg;
+    sg.reserve(n);
+    for (size_t i = 0; i < groups.size(); i++) {
+        SourceSet const &set = groups[i];
+        if (set.size() < minNumMatch) continue;
+
+        // Mean position as the normalized mean unit vector, so that groups
+        // straddling RA=0 are averaged correctly.
+        double c[3] = {0.0, 0.0, 0.0};
+        double sm = 0.0;
+        for (size_t j = 0; j < set.size(); j++) {
+            double v[3];
+            FlatKDTree::toVector(*set[j], v);
+            c[0] += v[0];
+            c[1] += v[1];
+            c[2] += v[2];
+            sm += set[j]->getFlux();
+        }
+        double ra = atan2(c[1], c[0]);
+        if (ra < 0.0) ra += 2.0 * M_PI;
+        double dec = atan2(c[2], sqrt(c[0] * c[0] + c[1] * c[1]));
+        PTR(Source)
+        source(new Source(lsst::afw::geom::SpherePoint(ra, dec, lsst::afw::geom::radians), sm / set.size()));
+
+        sg.push_back(SourceSet());
+        sg.back().reserve(set.size() + 1);
+        sg.back().push_back(source);
+        sg.back().insert(sg.back().end(), set.begin(), set.end());
     }
+    return sg;
 }
 
-KDTree::Ptr lsst::meas::mosaic::kdtreeMat(SourceMatchGroup &matchList) {
+namespace {
+struct SkyKeyHash {
+    size_t operator()(std::pair<double, double> const &key) const {
+        size_t h = std::hash<double>()(key.first);
+        return h ^ (std::hash<double>()(key.second) + 0x9e3779b97f4a7c15ULL + (h << 6) + (h >> 2));
+    }
+};
+}  // namespace
+
+SourceGroupTree::Ptr lsst::meas::mosaic::kdtreeMat(SourceMatchGroup &matchList) {
     if (matchList.size() == 0) {
         throw std::runtime_error("Can't create kd-tree for empty match list");
     }
-    KDTree::Ptr root = KDTree::Ptr(new KDTree(matchList[0], 0));
-    // std::cout << "root->count() : " << root->count() << std::endl;
 
-    for (unsigned int j = 1; j < matchList.size(); j++) {
-        for (unsigned int i = 0; i < matchList[j].size(); i++) {
-            root->add(matchList[j][i]);
+    // Matches to the same reference object (identical coordinates) form one
+    // group, with the reference object first.
+    std::unordered_map<std::pair<double, double>, int, SkyKeyHash> index;
+    SourceGroup groups;
+    for (size_t j = 0; j < matchList.size(); j++) {
+        for (size_t i = 0; i < matchList[j].size(); i++) {
+            SourceMatch const &m = matchList[j][i];
+            std::pair<double, double> key(m.first->getRa().asRadians(), m.first->getDec().asRadians());
+            auto it = index.find(key);
+            if (it == index.end()) {
+                index[key] = groups.size();
+                groups.push_back(SourceSet());
+                groups.back().push_back(m.first);
+                groups.back().push_back(m.second);
+            } else {
+                groups[it->second].push_back(m.second);
+            }
         }
-        // std::cout << "root->count() : " << root->count() << std::endl;
     }
-    // std::cout << root->count() << std::endl;
 
-    return root;
+    // Index the detections so that kdtreeSource can skip matched sources by
+    // identity instead of by position.
+    return std::make_shared<SourceGroupTree>(std::move(groups), true);
 }
 #if 0
 KDTree::Ptr
@@ -893,44 +1186,747 @@ lsst::meas::mosaic::kdtreeSource(SourceGroup const &sourceSet,
     return rootSource;
 }
 #endif
-KDTree::Ptr lsst::meas::mosaic::kdtreeSource(SourceGroup const &sourceSet, KDTree::Ptr rootMat,
-                                             CcdSet &ccdSet, lsst::afw::geom::Angle d_lim) {
-    // std::cout << "(1) " << sourceSet[0].size() << std::endl;
+namespace {
+int findRoot(std::vector<int> &parent, int i) {
+    while (parent[i] != i) {
+        parent[i] = parent[parent[i]];
+        i = parent[i];
+    }
+    return i;
+}
 
-    SourceSet set;
-    for (size_t i = 0; i < sourceSet[0].size(); i++) {
-        if (rootMat->findSource(*sourceSet[0][i]) == NULL) {
-            set.push_back(sourceSet[0][i]);
+void unite(std::vector<int> &parent, std::vector<int> &size, int i, int j) {
+    i = findRoot(parent, i);
+    j = findRoot(parent, j);
+    if (i == j) return;
+    if (size[i] < size[j]) std::swap(i, j);
+    parent[j] = i;
+    size[i] += size[j];
+}
+
+/*
+ * Sky grid of bands in Dec of height cellSize, each split in RA into cells at
+ * least cellSize wide over the whole band.
+ */
+class SkyGrid {
+public:
+    explicit SkyGrid(double cellSize)
+            : _cellSize(cellSize), _nBand(std::max(1, static_cast<int>(ceil(M_PI / cellSize)))) {
+        _nRa.resize(_nBand);
+        for (int b = 0; b < _nBand; b++) {
+            // The band edge nearest the pole sets the narrowest cell
+            double decLow = -0.5 * M_PI + b * cellSize;
+            double decHigh = std::min(0.5 * M_PI, decLow + cellSize);
+            double cosDec = std::min(cos(decLow), cos(decHigh));
+            _nRa[b] = std::max(1, static_cast<int>(floor(2.0 * M_PI * cosDec / cellSize)));
         }
     }
-    // std::cout << "(2) " << set.size() << std::endl;
 
-    KDTree::Ptr rootSource;
-    if (set.size() > 0) {
-        rootSource = KDTree::Ptr(new KDTree(set, 0));
+    int getBand(double dec) const {
+        return std::min(_nBand - 1, std::max(0, static_cast<int>(floor((dec + 0.5 * M_PI) / _cellSize))));
+    }
+    int getCell(int band, double ra) const {
+        int n = _nRa[band];
+        int c = static_cast<int>(floor(ra / (2.0 * M_PI) * n));
+        return ((c % n) + n) % n;
+    }
+    long getKey(int band, int cell) const { return static_cast<long>(band) * _nRaMax() + cell; }
+
+    // Cells that may hold points within cellSize of any point in the given cell
+    template <typename F>
+    void forNeighbours(int band, int cell, F f) const {
+        double decLow = -0.5 * M_PI + band * _cellSize;
+        double maxDec = std::max(fabs(decLow), fabs(decLow + _cellSize));
+        double raLow = 2.0 * M_PI * cell / _nRa[band];
+        double raHigh = 2.0 * M_PI * (cell + 1) / _nRa[band];
+        // Largest RA offset of a point within cellSize, from the haversine formula
+        double cosDec = cos(std::min(0.5 * M_PI, maxDec + _cellSize));
+        double sinHalf = sin(0.5 * _cellSize);
+        double dra = sinHalf < cosDec ? 2.0 * asin(sinHalf / cosDec) : 2.0 * M_PI;
+        for (int b = std::max(0, band - 1); b <= std::min(_nBand - 1, band + 1); b++) {
+            int n = _nRa[b];
+            long c0 = static_cast<long>(floor((raLow - dra) / (2.0 * M_PI) * n));
+            long c1 = static_cast<long>(floor((raHigh + dra) / (2.0 * M_PI) * n));
+            if (dra >= M_PI || c1 - c0 + 1 >= n) {
+                for (int c = 0; c < n; c++) f(getKey(b, c));
+                continue;
+            }
+            for (long c = c0; c <= c1; c++) {
+                f(getKey(b, static_cast<int>(((c % n) + n) % n)));
+            }
+        }
     }
 
-    // std::cout << "(3) " << rootSource->count() << std::endl;
-    for (size_t j = 1; j < sourceSet.size(); j++) {
-        for (size_t i = 0; i < sourceSet[j].size(); i++) {
-            if (rootMat->findSource(*sourceSet[j][i]) == NULL) {
-                if (rootSource) {
-                    KDTree::Ptr leaf = rootSource->findNearest(*sourceSet[j][i]);
-                    if (leaf->distance(*sourceSet[j][i]) < d_lim.asDegrees()) {
-                        leaf->set.push_back(sourceSet[j][i]);
-                    } else {
-                        rootSource->add(sourceSet[j][i]);
-                    }
-                } else {
-                    rootSource = KDTree::Ptr(new KDTree(sourceSet[j][i], 0));
+private:
+    long _nRaMax() const { return static_cast<long>(ceil(2.0 * M_PI / _cellSize)) + 1; }
+
+    double _cellSize;
+    int _nBand;
+    std::vector<int> _nRa;
+};
+
+/*
+ * Group the n points of one visit, given as unit vectors (3 per point): each
+ * point joins the group whose first point is nearest, if that is closer than
+ * maxChord2, and otherwise starts a new one.  Points only join groups started
+ * by earlier visits.  first holds the unit vector of the first point of each
+ * group, and is extended with the new groups; groups are numbered in order of
+ * creation.
+ *
+ * The groups are indexed by a forest of flat kd-trees over consecutive ranges
+ * of groups; trees of similar size are rebuilt into one, so only O(log n)
+ * trees are searched.  As the trees do not change within a visit, the
+ * searches run on nThreads chunks of the points, and the groups are then
+ * updated in point order; the result does not depend on nThreads.
+ */
+void groupVisit(std::vector<double> &first, std::vector<FlatKDTree> &forest, double const *xyz, long n,
+                double maxChord2, int nThreads, int *group) {
+    parallelFor(n, nThreads, [&](long begin, long end) {
+        for (long i = begin; i < end; i++) {
+            group[i] = -1;
+            double bestChord2 = maxChord2;
+            for (size_t k = 0; k < forest.size(); k++) {
+                double d2;
+                int m = forest[k].findNearest(&xyz[3 * i], bestChord2, &d2);
+                if (m >= 0) {
+                    group[i] = m;
+                    bestChord2 = d2;
                 }
             }
         }
-        // std::cout << "(3) " << rootSource->count() << std::endl;
+    });
+
+    int nOld = first.size() / 3;
+    int nGroup = nOld;
+    for (long i = 0; i < n; i++) {
+        if (group[i] < 0) {
+            group[i] = nGroup++;
+            first.insert(first.end(), &xyz[3 * i], &xyz[3 * i] + 3);
+        }
+    }
+
+    if (nGroup > nOld) {
+        forest.push_back(FlatKDTree(first, nOld));
+        while (forest.size() > 1 && forest[forest.size() - 2].size() <= 2 * forest.back().size()) {
+            int treeBegin = forest[forest.size() - 2].getBegin();
+            forest.pop_back();
+            forest.pop_back();
+            forest.push_back(FlatKDTree(first, treeBegin));
+        }
+    }
+}
+
+// groupVisit for all the visits, which start at visitBegin
+std::vector<int> groupNearest(std::vector<double> const &xyz, std::vector<long> const &visitBegin,
+                              double maxChord2, int nThreads) {
+    long const n = xyz.size() / 3;
+    std::vector<int> group(n, -1);
+    std::vector<double> first;
+    std::vector<FlatKDTree> forest;
+    for (size_t j = 0; j < visitBegin.size(); j++) {
+        long const begin = visitBegin[j];
+        long const end = j + 1 < visitBegin.size() ? visitBegin[j + 1] : n;
+        groupVisit(first, forest, xyz.data() + 3 * begin, end - begin, maxChord2, nThreads, group.data() + begin);
+    }
+    return group;
+}
+
+/*
+ * Friends-of-friends groups of points at (ra, dec) (radians) closer than
+ * d_lim.  Returns the group of each point; groups are numbered in order of
+ * their first point.
+ *
+ * The points are binned in cells no smaller than d_lim, so that all
+ * neighbours are in adjacent cells.  Each of nThreads threads links the
+ * points of a stripe of consecutive Dec bands to their neighbours, which may
+ * lie in the adjacent stripes.  A pair is only recorded from the cell of its
+ * lower-numbered point, so pairs on the stripe boundaries are not
+ * duplicated, and the links are joined in stripe order; the result does not
+ * depend on nThreads.
+ */
+std::vector<int> groupFof(std::vector<double> const &ra, std::vector<double> const &dec, double d_lim,
+                          int nThreads) {
+    int const n = ra.size();
+    SkyGrid grid(d_lim);
+    std::vector<double> xyz(3 * n);
+    std::vector<std::pair<long, int> > keys(n);
+    std::vector<std::pair<int, int> > cellOf(n);
+    parallelFor(n, nThreads, [&](long begin, long end) {
+        for (long i = begin; i < end; i++) {
+            FlatKDTree::toVector(ra[i], dec[i], &xyz[3 * i]);
+            int band = grid.getBand(dec[i]);
+            int cell = grid.getCell(band, ra[i]);
+            cellOf[i] = std::make_pair(band, cell);
+            keys[i] = std::make_pair(grid.getKey(band, cell), static_cast<int>(i));
+        }
+    });
+    std::sort(keys.begin(), keys.end());
+
+    // Cells in key order, i.e. in Dec bands from south to north
+    std::vector<std::pair<int, int> > cellRanges;
+    std::unordered_map<long, std::pair<int, int> > cells;
+    for (int k = 0; k < n;) {
+        int l = k;
+        while (l < n && keys[l].first == keys[k].first) l++;
+        cellRanges.push_back(std::make_pair(k, l));
+        cells[keys[k].first] = cellRanges.back();
+        k = l;
+    }
+
+    double const maxChord2 = FlatKDTree::chord2(lsst::afw::geom::Angle(d_lim, lsst::afw::geom::radians));
+    int const nStripe = std::min<long>(getNumThreads(nThreads), std::max<size_t>(1, cellRanges.size()));
+    std::vector<std::vector<std::pair<int, int> > > links(nStripe);
+    parallelFor(nStripe, nStripe, [&](long stripeBegin, long stripeEnd) {
+        for (long stripe = stripeBegin; stripe < stripeEnd; stripe++) {
+            size_t cellBegin = cellRanges.size() * stripe / nStripe;
+            size_t cellEnd = cellRanges.size() * (stripe + 1) / nStripe;
+            for (size_t c = cellBegin; c < cellEnd; c++) {
+                int const begin = cellRanges[c].first;
+                int const end = cellRanges[c].second;
+                int const i0 = keys[begin].second;
+                grid.forNeighbours(cellOf[i0].first, cellOf[i0].second, [&](long key) {
+                    auto it = cells.find(key);
+                    if (it == cells.end()) return;
+                    for (int k = begin; k < end; k++) {
+                        int i = keys[k].second;
+                        double const *v = &xyz[3 * i];
+                        for (int l = it->second.first; l < it->second.second; l++) {
+                            int j = keys[l].second;
+                            if (j <= i) continue;
+                            double const *w = &xyz[3 * j];
+                            double d2 = (v[0] - w[0]) * (v[0] - w[0]) + (v[1] - w[1]) * (v[1] - w[1]) +
+                                        (v[2] - w[2]) * (v[2] - w[2]);
+                            if (d2 < maxChord2) links[stripe].push_back(std::make_pair(i, j));
+                        }
+                    }
+                });
+            }
+        }
+    });
+
+    std::vector<int> parent(n);
+    std::vector<int> size(n, 1);
+    for (int i = 0; i < n; i++) parent[i] = i;
+    for (size_t stripe = 0; stripe < links.size(); stripe++) {
+        for (size_t k = 0; k < links[stripe].size(); k++) {
+            unite(parent, size, links[stripe][k].first, links[stripe][k].second);
+        }
     }
-    // std::cout << "(4) " << rootSource->count() << std::endl;
 
-    return rootSource;
+    std::vector<int> group(n, -1);
+    int nGroup = 0;
+    for (int i = 0; i < n; i++) {
+        int root = findRoot(parent, i);
+        if (group[root] < 0) group[root] = nGroup++;
+        group[i] = group[root];
+    }
+    return group;
+}
+
+// Sort the members of each group into a SourceGroup, keeping their order
+SourceGroupTree::Ptr makeGroups(SourceSet const &sources, std::vector<int> const &group) {
+    int nGroup = 0;
+    for (size_t i = 0; i < group.size(); i++) nGroup = std::max(nGroup, group[i] + 1);
+    std::vector<int> count(nGroup, 0);
+    for (size_t i = 0; i < group.size(); i++) count[group[i]]++;
+    SourceGroup groups(nGroup);
+    for (int k = 0; k < nGroup; k++) groups[k].reserve(count[k]);
+    for (size_t i = 0; i < group.size(); i++) groups[group[i]].push_back(sources[i]);
+    return std::make_shared<SourceGroupTree>(std::move(groups));
+}
+
+// The sources of sourceSet that are not in rootMat, in order, and where each visit starts
+void selectUnmatched(SourceGroup const &sourceSet, SourceGroupTree::Ptr rootMat, int nThreads,
+                     SourceSet &sources, std::vector<long> &visitBegin) {
+    for (size_t j = 0; j < sourceSet.size(); j++) {
+        SourceSet const &visit = sourceSet[j];
+        std::vector<char> matched(visit.size());
+        parallelFor(visit.size(), nThreads, [&](long begin, long end) {
+            for (long i = begin; i < end; i++) matched[i] = rootMat->contains(*visit[i]);
+        });
+        visitBegin.push_back(sources.size());
+        for (size_t i = 0; i < visit.size(); i++) {
+            if (!matched[i]) sources.push_back(visit[i]);
+        }
+    }
+}
+}  // namespace
+
+SourceGroupTree::Ptr lsst::meas::mosaic::kdtreeSource(SourceGroup const &sourceSet, SourceGroupTree::Ptr rootMat,
+                                                      CcdSet &ccdSet, lsst::afw::geom::Angle d_lim,
+                                                      int nThreads) {
+    SourceSet sources;
+    std::vector<long> visitBegin;
+    selectUnmatched(sourceSet, rootMat, nThreads, sources, visitBegin);
+    std::vector<double> xyz(3 * sources.size());
+    parallelFor(sources.size(), nThreads, [&](long begin, long end) {
+        for (long i = begin; i < end; i++) FlatKDTree::toVector(*sources[i], &xyz[3 * i]);
+    });
+    return makeGroups(sources, groupNearest(xyz, visitBegin, FlatKDTree::chord2(d_lim), nThreads));
+}
+
+SourceGroupTree::Ptr lsst::meas::mosaic::fofSource(SourceGroup const &sourceSet, SourceGroupTree::Ptr rootMat,
+                                                   lsst::afw::geom::Angle d_lim, int nThreads) {
+    SourceSet sources;
+    std::vector<long> visitBegin;
+    selectUnmatched(sourceSet, rootMat, nThreads, sources, visitBegin);
+    std::vector<double> ra(sources.size());
+    std::vector<double> dec(sources.size());
+    for (size_t i = 0; i < sources.size(); i++) {
+        ra[i] = sources[i]->getRa().asRadians();
+        dec[i] = sources[i]->getDec().asRadians();
+    }
+    return makeGroups(sources, groupFof(ra, dec, d_lim.asRadians(), nThreads));
+}
+
+ArrayMatch lsst::meas::mosaic::matchArrays(ndarray::Array<double const, 1> const &ra,
+                                           ndarray::Array<double const, 1> const &dec,
+                                           ndarray::Array<std::int64_t const, 1> const &visit,
+                                           ndarray::Array<double const, 1> const &refRa,
+                                           ndarray::Array<double const, 1> const &refDec,
+                                           lsst::afw::geom::Angle d_lim, std::string const &mode,
+                                           int nThreads) {
+    long const n = ra.getSize<0>();
+    if (dec.getSize<0>() != n || visit.getSize<0>() != n) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                          (boost::format("Size mismatch between ra (%d), dec (%d) and visit (%d)") % n %
+                           dec.getSize<0>() % visit.getSize<0>()).str());
+    }
+    if (refRa.getSize<0>() != refDec.getSize<0>()) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                          (boost::format("Size mismatch between refRa (%d) and refDec (%d)") %
+                           refRa.getSize<0>() % refDec.getSize<0>()).str());
+    }
+    if (mode != "nearest" && mode != "fof") {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                          (boost::format("Unknown mode: %s") % mode).str());
+    }
+    double const maxChord2 = FlatKDTree::chord2(d_lim);
+
+    // Detections within d_lim of a reference join the group of the nearest one
+    std::vector<int> ref(n, -1);
+    if (refRa.getSize<0>() > 0) {
+        FlatKDTree refTree(refRa, refDec);
+        parallelFor(n, nThreads, [&](long begin, long end) {
+            for (long i = begin; i < end; i++) {
+                double v[3];
+                FlatKDTree::toVector(ra[i] * D2R, dec[i] * D2R, v);
+                ref[i] = refTree.findNearest(v, maxChord2);
+            }
+        });
+    }
+
+    // The others are grouped in order of visit, and of input within a visit
+    std::vector<long> order;
+    for (long i = 0; i < n; i++) {
+        if (ref[i] < 0) order.push_back(i);
+    }
+    std::stable_sort(order.begin(), order.end(),
+                     [&visit](long i, long j) { return visit[i] < visit[j]; });
+    std::vector<int> group;
+    if (mode == "fof") {
+        std::vector<double> raRad(order.size());
+        std::vector<double> decRad(order.size());
+        for (size_t k = 0; k < order.size(); k++) {
+            raRad[k] = ra[order[k]] * D2R;
+            decRad[k] = dec[order[k]] * D2R;
+        }
+        group = groupFof(raRad, decRad, d_lim.asRadians(), nThreads);
+    } else {
+        std::vector<double> xyz(3 * order.size());
+        std::vector<long> visitBegin;
+        for (size_t k = 0; k < order.size(); k++) {
+            FlatKDTree::toVector(ra[order[k]] * D2R, dec[order[k]] * D2R, &xyz[3 * k]);
+            if (k == 0 || visit[order[k]] != visit[order[k - 1]]) visitBegin.push_back(k);
+        }
+        group = groupNearest(xyz, visitBegin, maxChord2, nThreads);
+    }
+
+    // Number the reference groups first, in order of reference
+    std::vector<int> refGroup(refRa.getSize<0>(), -1);
+    std::vector<int> groupRef;
+    for (long i = 0; i < n; i++) {
+        if (ref[i] >= 0) refGroup[ref[i]] = 0;
+    }
+    for (size_t k = 0; k < refGroup.size(); k++) {
+        if (refGroup[k] == 0) {
+            refGroup[k] = groupRef.size();
+            groupRef.push_back(k);
+        }
+    }
+    int const nRefGroup = groupRef.size();
+    int nGroup = nRefGroup;
+    for (size_t k = 0; k < group.size(); k++) nGroup = std::max(nGroup, nRefGroup + group[k] + 1);
+
+    ArrayMatch result;
+    result.groupId = ndarray::allocate(ndarray::makeVector(n));
+    result.members = ndarray::allocate(ndarray::makeVector(n));
+    result.offsets = ndarray::allocate(ndarray::makeVector(nGroup + 1));
+    result.refIndex = ndarray::allocate(ndarray::makeVector(nGroup));
+    for (long i = 0; i < n; i++) {
+        if (ref[i] >= 0) result.groupId[i] = refGroup[ref[i]];
+    }
+    for (size_t k = 0; k < order.size(); k++) {
+        result.groupId[order[k]] = nRefGroup + group[k];
+    }
+    std::vector<int> offsets(nGroup + 1, 0);
+    for (long i = 0; i < n; i++) offsets[result.groupId[i] + 1]++;
+    for (int k = 0; k < nGroup; k++) offsets[k + 1] += offsets[k];
+    for (int k = 0; k <= nGroup; k++) result.offsets[k] = offsets[k];
+    for (int k = 0; k < nGroup; k++) result.refIndex[k] = k < nRefGroup ? groupRef[k] : -1;
+    for (long i = 0; i < n; i++) result.members[offsets[result.groupId[i]]++] = i;
+    return result;
+}
+
+SourceGroupBuilder::SourceGroupBuilder(lsst::afw::geom::Angle d_lim, std::string const &mode, int nThreads)
+        : _d_lim(d_lim), _maxChord2(FlatKDTree::chord2(d_lim)), _fof(mode == "fof"), _nThreads(nThreads) {
+    if (mode != "nearest" && mode != "fof") {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                          (boost::format("Unknown mode: %s") % mode).str());
+    }
+}
+
+void SourceGroupBuilder::addVisit(SourceSet const &sources, SourceMatchSet const &matches) {
+    // Matched detections have the exposure of the visit, so the matches of
+    // other visits are not needed to find them.
+    SourceSet detections;
+    detections.reserve(matches.size());
+    for (size_t i = 0; i < matches.size(); i++) detections.push_back(matches[i].second);
+    SourceGroupTree matched(SourceGroup(1, detections), true);
+
+    size_t const nOld = _sources.size();
+    for (size_t i = 0; i < sources.size(); i++) {
+        if (!matched.contains(*sources[i])) _sources.push_back(sources[i]);
+    }
+    _matchList.push_back(matches);
+    if (_fof) return;
+
+    long const n = _sources.size() - nOld;
+    std::vector<double> xyz(3 * n);
+    for (long i = 0; i < n; i++) FlatKDTree::toVector(*_sources[nOld + i], &xyz[3 * i]);
+    _group.resize(_sources.size());
+    groupVisit(_first, _forest, xyz.data(), n, _maxChord2, _nThreads, _group.data() + nOld);
+}
+
+SourceGroupTree::Ptr SourceGroupBuilder::getMatchTree() { return kdtreeMat(_matchList); }
+
+SourceGroupTree::Ptr SourceGroupBuilder::getSourceTree() const {
+    if (!_fof) return makeGroups(_sources, _group);
+
+    std::vector<double> ra(_sources.size());
+    std::vector<double> dec(_sources.size());
+    for (size_t i = 0; i < _sources.size(); i++) {
+        ra[i] = _sources[i]->getRa().asRadians();
+        dec[i] = _sources[i]->getDec().asRadians();
+    }
+    return makeGroups(_sources, groupFof(ra, dec, _d_lim.asRadians(), _nThreads));
+}
+
+namespace {
+// The columns are shared by SourceArrays and SourceGroupArrays
+template <typename Arrays>
+void allocateColumns(Arrays &arrays, long n) {
+    arrays.id = ndarray::allocate(ndarray::makeVector(n));
+    arrays.chip = ndarray::allocate(ndarray::makeVector(n));
+    arrays.exp = ndarray::allocate(ndarray::makeVector(n));
+    arrays.ra = ndarray::allocate(ndarray::makeVector(n));
+    arrays.dec = ndarray::allocate(ndarray::makeVector(n));
+    arrays.x = ndarray::allocate(ndarray::makeVector(n));
+    arrays.xErr = ndarray::allocate(ndarray::makeVector(n));
+    arrays.y = ndarray::allocate(ndarray::makeVector(n));
+    arrays.yErr = ndarray::allocate(ndarray::makeVector(n));
+    arrays.flux = ndarray::allocate(ndarray::makeVector(n));
+    arrays.fluxErr = ndarray::allocate(ndarray::makeVector(n));
+    arrays.astromBad = ndarray::allocate(ndarray::makeVector(n));
+}
+
+template <typename Arrays>
+long getNumRows(Arrays const &arrays) {
+    long const n = arrays.id.template getSize<0>();
+    long const sizes[] = {arrays.chip.template getSize<0>(),    arrays.exp.template getSize<0>(),
+                          arrays.ra.template getSize<0>(),      arrays.dec.template getSize<0>(),
+                          arrays.x.template getSize<0>(),       arrays.xErr.template getSize<0>(),
+                          arrays.y.template getSize<0>(),       arrays.yErr.template getSize<0>(),
+                          arrays.flux.template getSize<0>(),    arrays.fluxErr.template getSize<0>(),
+                          arrays.astromBad.template getSize<0>()};
+    for (long size : sizes) {
+        if (size != n) {
+            throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                              (boost::format("Columns have different lengths (%d and %d)") % n % size).str());
+        }
+    }
+    return n;
+}
+
+template <typename Arrays>
+void setRow(Arrays &arrays, long k, Source const &s) {
+    arrays.id[k] = s.getId();
+    arrays.chip[k] = s.getChip();
+    arrays.exp[k] = s.getExp();
+    arrays.ra[k] = s.getRa().asDegrees();
+    arrays.dec[k] = s.getDec().asDegrees();
+    arrays.x[k] = s.getX();
+    arrays.xErr[k] = s.getXErr();
+    arrays.y[k] = s.getY();
+    arrays.yErr[k] = s.getYErr();
+    arrays.flux[k] = s.getFlux();
+    arrays.fluxErr[k] = s.getFluxErr();
+    arrays.astromBad[k] = s.getAstromBad();
+}
+
+template <typename From, typename To>
+void copyRow(From const &from, long i, To &to, long k) {
+    to.id[k] = from.id[i];
+    to.chip[k] = from.chip[i];
+    to.exp[k] = from.exp[i];
+    to.ra[k] = from.ra[i];
+    to.dec[k] = from.dec[i];
+    to.x[k] = from.x[i];
+    to.xErr[k] = from.xErr[i];
+    to.y[k] = from.y[i];
+    to.yErr[k] = from.yErr[i];
+    to.flux[k] = from.flux[i];
+    to.fluxErr[k] = from.fluxErr[i];
+    to.astromBad[k] = from.astromBad[i];
+}
+
+template <typename Arrays>
+PTR(Source) makeSource(Arrays const &arrays, long k) {
+    return std::make_shared<Source>(arrays.id[k], arrays.chip[k], arrays.exp[k], arrays.ra[k], arrays.dec[k],
+                                    arrays.x[k], arrays.xErr[k], arrays.y[k], arrays.yErr[k], arrays.flux[k],
+                                    arrays.fluxErr[k], arrays.astromBad[k]);
+}
+
+// What identifies a detection, as SourceGroupTree::SourceKey
+struct RowKey {
+    std::int64_t id;
+    int chip;
+    int exp;
+    bool operator==(RowKey const &other) const {
+        return id == other.id && chip == other.chip && exp == other.exp;
+    }
+};
+
+struct RowKeyHash {
+    size_t operator()(RowKey const &key) const {
+        size_t h = std::hash<std::int64_t>()(key.id);
+        h ^= std::hash<int>()(key.chip) + 0x9e3779b97f4a7c15ULL + (h << 6) + (h >> 2);
+        h ^= std::hash<int>()(key.exp) + 0x9e3779b97f4a7c15ULL + (h << 6) + (h >> 2);
+        return h;
+    }
+};
+}  // namespace
+
+SourceArrays lsst::meas::mosaic::sourceSetToArrays(SourceSet const &ss) {
+    SourceArrays arrays;
+    allocateColumns(arrays, ss.size());
+    for (size_t k = 0; k < ss.size(); k++) setRow(arrays, k, *ss[k]);
+    return arrays;
+}
+
+SourceSet lsst::meas::mosaic::sourceSetFromArrays(SourceArrays const &arrays) {
+    long const n = getNumRows(arrays);
+    SourceSet ss;
+    ss.reserve(n);
+    for (long k = 0; k < n; k++) ss.push_back(makeSource(arrays, k));
+    return ss;
+}
+
+SourceGroupArrays lsst::meas::mosaic::mergeMatArrays(SourceArrays const &ref, SourceArrays const &src) {
+    long const n = getNumRows(src);
+    if (getNumRows(ref) != n) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                          (boost::format("Size mismatch between ref (%d) and src (%d)") % getNumRows(ref) % n)
+                                  .str());
+    }
+
+    // Matches to the same reference object (identical coordinates) form one
+    // group, with the reference object first, as in kdtreeMat.
+    std::unordered_map<std::pair<double, double>, int, SkyKeyHash> index;
+    std::vector<long> groupRef;
+    std::vector<int> group(n);
+    for (long i = 0; i < n; i++) {
+        std::pair<double, double> key(ref.ra[i], ref.dec[i]);
+        auto it = index.find(key);
+        if (it == index.end()) {
+            group[i] = index[key] = groupRef.size();
+            groupRef.push_back(i);
+        } else {
+            group[i] = it->second;
+        }
+    }
+
+    int const nGroup = groupRef.size();
+    std::vector<long> offsets(nGroup + 1, 0);
+    for (long i = 0; i < n; i++) offsets[group[i] + 1]++;
+    for (int k = 0; k < nGroup; k++) offsets[k + 1] += offsets[k] + 1;
+
+    SourceGroupArrays arrays;
+    arrays.offsets = ndarray::allocate(ndarray::makeVector(nGroup + 1));
+    allocateColumns(arrays, n + nGroup);
+    std::vector<long> next(nGroup);
+    for (int k = 0; k < nGroup; k++) {
+        arrays.offsets[k] = offsets[k];
+        copyRow(ref, groupRef[k], arrays, offsets[k]);
+        next[k] = offsets[k] + 1;
+    }
+    arrays.offsets[nGroup] = offsets[nGroup];
+    for (long i = 0; i < n; i++) copyRow(src, i, arrays, next[group[i]]++);
+    return arrays;
+}
+
+SourceGroupArrays lsst::meas::mosaic::mergeSourceArrays(SourceArrays const &sources,
+                                                        SourceGroupArrays const &allMat,
+                                                        lsst::afw::geom::Angle d_lim, std::string const &mode,
+                                                        unsigned int minNumMatch, int nThreads) {
+    if (mode != "nearest" && mode != "fof") {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                          (boost::format("Unknown mode: %s") % mode).str());
+    }
+    long const n = getNumRows(sources);
+
+    std::unordered_set<RowKey, RowKeyHash> matched;
+    long const nMat = getNumRows(allMat);
+    for (long k = 0; k < nMat; k++) matched.insert(RowKey{allMat.id[k], allMat.chip[k], allMat.exp[k]});
+
+    // The unmatched sources, in order, and where each visit starts
+    std::vector<long> rows;
+    std::vector<long> visitBegin;
+    for (long i = 0; i < n; i++) {
+        if (i == 0 || sources.exp[i] != sources.exp[i - 1]) visitBegin.push_back(rows.size());
+        if (matched.find(RowKey{sources.id[i], sources.chip[i], sources.exp[i]}) == matched.end()) {
+            rows.push_back(i);
+        }
+    }
+
+    std::vector<int> group;
+    if (mode == "fof") {
+        std::vector<double> ra(rows.size());
+        std::vector<double> dec(rows.size());
+        for (size_t k = 0; k < rows.size(); k++) {
+            ra[k] = sources.ra[rows[k]] * D2R;
+            dec[k] = sources.dec[rows[k]] * D2R;
+        }
+        group = groupFof(ra, dec, d_lim.asRadians(), nThreads);
+    } else {
+        std::vector<double> xyz(3 * rows.size());
+        parallelFor(rows.size(), nThreads, [&](long begin, long end) {
+            for (long k = begin; k < end; k++) {
+                FlatKDTree::toVector(sources.ra[rows[k]] * D2R, sources.dec[rows[k]] * D2R, &xyz[3 * k]);
+            }
+        });
+        group = groupNearest(xyz, visitBegin, FlatKDTree::chord2(d_lim), nThreads);
+    }
+
+    // Members of each group, in order, as makeGroups
+    int nGroup = 0;
+    for (size_t k = 0; k < group.size(); k++) nGroup = std::max(nGroup, group[k] + 1);
+    std::vector<long> memberBegin(nGroup + 1, 0);
+    for (size_t k = 0; k < group.size(); k++) memberBegin[group[k] + 1]++;
+    for (int g = 0; g < nGroup; g++) memberBegin[g + 1] += memberBegin[g];
+    std::vector<long> members(rows.size());
+    std::vector<long> next(memberBegin.begin(), memberBegin.end() - 1);
+    for (size_t k = 0; k < group.size(); k++) members[next[group[k]]++] = rows[k];
+
+    // Groups of at least minNumMatch, led by their mean position, as mergeSource
+    std::vector<int> kept;
+    long nRow = 0;
+    for (int g = 0; g < nGroup; g++) {
+        long size = memberBegin[g + 1] - memberBegin[g];
+        if (size >= static_cast<long>(minNumMatch)) {
+            kept.push_back(g);
+            nRow += size + 1;
+        }
+    }
+    SourceGroupArrays arrays;
+    arrays.offsets = ndarray::allocate(ndarray::makeVector(kept.size() + 1));
+    allocateColumns(arrays, nRow);
+    long k = 0;
+    for (size_t i = 0; i < kept.size(); i++) {
+        long const begin = memberBegin[kept[i]];
+        long const end = memberBegin[kept[i] + 1];
+        double c[3] = {0.0, 0.0, 0.0};
+        double sm = 0.0;
+        for (long m = begin; m < end; m++) {
+            double v[3];
+            FlatKDTree::toVector(sources.ra[members[m]] * D2R, sources.dec[members[m]] * D2R, v);
+            c[0] += v[0];
+            c[1] += v[1];
+            c[2] += v[2];
+            sm += sources.flux[members[m]];
+        }
+        double ra = atan2(c[1], c[0]);
+        if (ra < 0.0) ra += 2.0 * M_PI;
+        double dec = atan2(c[2], sqrt(c[0] * c[0] + c[1] * c[1]));
+
+        arrays.offsets[i] = k;
+        setRow(arrays, k++,
+               Source(lsst::afw::geom::SpherePoint(ra, dec, lsst::afw::geom::radians), sm / (end - begin)));
+        for (long m = begin; m < end; m++) copyRow(sources, members[m], arrays, k++);
+    }
+    arrays.offsets[kept.size()] = k;
+    return arrays;
+}
+
+SourceGroupArrays lsst::meas::mosaic::sourceGroupToArrays(SourceGroup const &sg) {
+    long n = 0;
+    for (size_t i = 0; i < sg.size(); i++) n += sg[i].size();
+
+    SourceGroupArrays arrays;
+    arrays.offsets = ndarray::allocate(ndarray::makeVector(sg.size() + 1));
+    allocateColumns(arrays, n);
+
+    long k = 0;
+    for (size_t i = 0; i < sg.size(); i++) {
+        arrays.offsets[i] = k;
+        for (size_t j = 0; j < sg[i].size(); j++, k++) setRow(arrays, k, *sg[i][j]);
+    }
+    arrays.offsets[sg.size()] = k;
+
+    return arrays;
+}
+
+SourceGroup lsst::meas::mosaic::sourceGroupFromArrays(SourceGroupArrays const &arrays) {
+    int const nGroup = arrays.offsets.getSize<0>() - 1;
+    SourceGroup sg(std::max(nGroup, 0));
+    for (int i = 0; i < nGroup; i++) {
+        sg[i].reserve(arrays.offsets[i + 1] - arrays.offsets[i]);
+        for (long k = arrays.offsets[i]; k < arrays.offsets[i + 1]; k++) {
+            sg[i].push_back(makeSource(arrays, k));
+        }
+    }
+    return sg;
+}
+
+SourceGroup lsst::meas::mosaic::selectSourceGroups(SourceGroup const &sg,
+                                                   ndarray::Array<bool const, 1> const &keep) {
+    if (keep.getSize<0>() != sg.size()) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                          (boost::format("Size mismatch between groups (%d) and keep (%d)") % sg.size() %
+                           keep.getSize<0>()).str());
+    }
+    SourceGroup selected;
+    for (size_t i = 0; i < sg.size(); i++) {
+        if (keep[i]) selected.push_back(sg[i]);
+    }
+    return selected;
+}
+
+ndarray::Array<bool, 1, 1> lsst::meas::mosaic::getGroupsInBox(SourceGroupArrays const &arrays,
+                                                              lsst::afw::geom::SkyWcs const &wcs,
+                                                              lsst::afw::geom::Box2D const &bbox) {
+    int const nGroup = arrays.offsets.getSize<0>() - 1;
+    std::vector<lsst::afw::geom::SpherePoint> sky;
+    sky.reserve(nGroup);
+    for (int i = 0; i < nGroup; i++) {
+        long k = arrays.offsets[i];
+        sky.push_back(lsst::afw::geom::SpherePoint(arrays.ra[k], arrays.dec[k], lsst::afw::geom::degrees));
+    }
+    std::vector<lsst::afw::geom::Point2D> pixels = wcs.skyToPixel(sky);
+
+    ndarray::Array<bool, 1, 1> inside = ndarray::allocate(ndarray::makeVector(nGroup));
+    for (int i = 0; i < nGroup; i++) inside[i] = bbox.contains(pixels[i]);
+    return inside;
 }
 
 double calXi(double a, double d, double A, double D) {
@@ -1434,23 +2430,13 @@ Eigen::VectorXd solveLinApprox_Star(std::vector<Obs::Ptr> &o, std::vector<Obs::P
             num[s[i]->istar] += 1;
         }
     }
-    std::vector<int> v_istar;
-    for (int i = 0; i < nstar; i++) {
-        if (num[i] >= 2) {
-            v_istar.push_back(i);
-        }
-    }
+    int nstar2;
+    std::vector<int> starIndex = indexStars(num, nstar, &nstar2);
     delete[] num;
-    int nstar2 = v_istar.size();
     std::cout << "nstar: " << nstar2 << std::endl;
 
     for (int i = 0; i < nSobs; i++) {
-        std::vector<int>::iterator it = std::find(v_istar.begin(), v_istar.end(), s[i]->istar);
-        if (it != v_istar.end()) {
-            s[i]->jstar = it - v_istar.begin();
-        } else {
-            s[i]->jstar = -1;
-        }
+        s[i]->jstar = starIndex[s[i]->istar];
     }
 
     long size, size0, np = 0;
@@ -1993,160 +2979,335 @@ double calcChi2_Star(std::vector<Obs::Ptr> &o, std::vector<Obs::Ptr> &s, CoeffSe
     return chi2;
 }
 
-int lsst::meas::mosaic::flagSuspect(SourceGroup &allMat, SourceGroup &allSource, WcsDic &wcsDic) {
+namespace {
+// The detection of a group in a visit, and its magnitude when the list was made
+struct VisitMember {
+    int group;
+    double mag;
+    Source *source;
+};
+
+// Magnitude differences of one pair of visits, and the sources they flag
+struct SuspectPair {
+    int j_ref;
+    int j_targ;
+    int ngood;
+    int nbad;
+    double med;
+    double SIQR;
+};
+
+void flagSuspectPair(std::vector<VisitMember> const &refs, std::vector<VisitMember> const &targs,
+                     SuspectPair &pair) {
+    // Sources in groups with both visits, from the lists ordered by group.
+    // Fluxes only change to -9999, so the saved magnitude of a source with
+    // positive flux is still current.
+    std::vector<Source *> ref;
+    std::vector<Source *> targ;
+    std::vector<double> dm;
+    for (size_t k = 0, l = 0; k < refs.size() && l < targs.size();) {
+        if (refs[k].group < targs[l].group) {
+            k++;
+        } else if (targs[l].group < refs[k].group) {
+            l++;
+        } else {
+            if (refs[k].source->getFlux() > 0.0 && targs[l].source->getFlux() > 0.0) {
+                ref.push_back(refs[k].source);
+                targ.push_back(targs[l].source);
+                dm.push_back(targs[l].mag - refs[k].mag);
+            }
+            k++;
+            l++;
+        }
+    }
+    pair.ngood = pair.nbad = 0;
+    if (dm.size() < 10) {
+        pair.ngood = -1;
+        return;
+    }
+
+    // The elements of the sorted dm at n/10, n/2 and 9n/10
+    std::vector<double> sorted(dm);
+    size_t const n = sorted.size();
+    std::nth_element(sorted.begin(), sorted.begin() + n / 2, sorted.end());
+    std::nth_element(sorted.begin(), sorted.begin() + n / 10, sorted.begin() + n / 2);
+    std::nth_element(sorted.begin() + n / 2 + 1, sorted.begin() + n * 9 / 10, sorted.end());
+    pair.med = sorted[n / 2];
+    pair.SIQR = 0.5 * (sorted[n * 9 / 10] - sorted[n / 10]);
+
+    for (size_t k = 0; k < dm.size(); k++) {
+        if (fabs(dm[k] - pair.med) > 3.0 * pair.SIQR) {
+            ref[k]->setFlux(-9999);
+            targ[k]->setFlux(-9999);
+            pair.nbad += 1;
+        } else {
+            pair.ngood += 1;
+        }
+    }
+}
+}  // namespace
+
+int lsst::meas::mosaic::flagSuspect(SourceGroup &allMat, SourceGroup &allSource, WcsDic &wcsDic, int nThreads) {
     std::vector<int> visits;
+    std::map<int, int> visitIndex;
     for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++) {
+        visitIndex[it->first] = visits.size();
         visits.push_back(it->first);
     }
-
-    for (size_t j = 0; j < visits.size() - 1; j++) {
-        int visit_ref = visits[j];
-        for (size_t i = j + 1; i < visits.size(); i++) {
-            int visit_targ = visits[i];
-            std::vector<PTR(Source)> refs;
-            std::vector<PTR(Source)> targs;
-            std::vector<double> mref;
-            std::vector<double> mtarg;
-            for (size_t l = 0; l < allMat.size(); l++) {
-                std::vector<PTR(Source)> mm = allMat[l];
-                int j_ref = -1;
-                int j_targ = -1;
-                for (size_t k = 1; k < mm.size(); k++) {
-                    if (mm[k]->getExp() == visit_ref) {
-                        j_ref = k;
-                    } else if (mm[k]->getExp() == visit_targ) {
-                        j_targ = k;
-                    }
-                }
-                if (j_ref != -1 && j_targ != -1 && mm[j_ref]->getFlux() > 0.0 &&
-                    mm[j_targ]->getFlux() > 0.0) {
-                    refs.push_back(mm[j_ref]);
-                    targs.push_back(mm[j_targ]);
-                    mref.push_back(-2.5 * log10(mm[j_ref]->getFlux()));
-                    mtarg.push_back(-2.5 * log10(mm[j_targ]->getFlux()));
+    int const nVisit = visits.size();
+
+    // The last detection of each group in each visit, by visit and in order
+    // of group, and the number of groups shared by each pair of visits
+    std::vector<std::vector<VisitMember> > members(nVisit);
+    std::vector<int> overlap(nVisit * nVisit, 0);
+    std::vector<int> inGroup;
+    int g = 0;
+    for (SourceGroup const *all : {&allMat, &allSource}) {
+        for (size_t l = 0; l < all->size(); l++, g++) {
+            SourceSet const &ss = (*all)[l];
+            inGroup.clear();
+            for (size_t k = 1; k < ss.size(); k++) {
+                std::map<int, int>::const_iterator it = visitIndex.find(ss[k]->getExp());
+                if (it == visitIndex.end()) continue;
+                std::vector<VisitMember> &list = members[it->second];
+                if (list.empty() || list.back().group != g) {
+                    list.push_back(VisitMember());
+                    inGroup.push_back(it->second);
                 }
+                double flux = ss[k]->getFlux();
+                VisitMember member = {g, flux > 0.0 ? -2.5 * log10(flux) : 0.0, ss[k].get()};
+                list.back() = member;
             }
-            for (size_t l = 0; l < allSource.size(); l++) {
-                std::vector<PTR(Source)> ss = allSource[l];
-                int j_ref = -1;
-                int j_targ = -1;
-                for (size_t k = 1; k < ss.size(); k++) {
-                    if (ss[k]->getExp() == visit_ref) {
-                        j_ref = k;
-                    } else if (ss[k]->getExp() == visit_targ) {
-                        j_targ = k;
-                    }
-                }
-                if (j_ref != -1 && j_targ != -1 && ss[j_ref]->getFlux() > 0.0 &&
-                    ss[j_targ]->getFlux() > 0.0) {
-                    refs.push_back(ss[j_ref]);
-                    targs.push_back(ss[j_targ]);
-                    mref.push_back(-2.5 * log10(ss[j_ref]->getFlux()));
-                    mtarg.push_back(-2.5 * log10(ss[j_targ]->getFlux()));
+            for (size_t k = 0; k < inGroup.size(); k++) {
+                for (size_t m = 0; m < inGroup.size(); m++) {
+                    if (inGroup[k] < inGroup[m]) overlap[inGroup[k] * nVisit + inGroup[m]]++;
                 }
             }
+        }
+    }
 
-            if (mref.size() < 10) {
-                printf("%d %d\n", visit_ref, visit_targ);
-                continue;
-            }
-
-            std::vector<double> dm;
-            for (size_t k = 0; k < mref.size(); k++) {
-                dm.push_back(mtarg[k] - mref[k]);
+    // The pairs are done in order, and a source flagged by one pair is not
+    // used by the later ones.  As a pair only flags the sources of its two
+    // visits, it only depends on the earlier pairs sharing a visit: pairs are
+    // put in levels after those, and the pairs of a level run in parallel.
+    std::vector<SuspectPair> pairs;
+    std::vector<std::vector<int> > levels;
+    std::vector<int> lastLevel(nVisit, -1);
+    for (int j = 0; j < nVisit; j++) {
+        for (int i = j + 1; i < nVisit; i++) {
+            SuspectPair pair = {j, i, -1, 0, 0.0, 0.0};
+            pairs.push_back(pair);
+            if (overlap[j * nVisit + i] < 10) continue;
+            int level = std::max(lastLevel[j], lastLevel[i]) + 1;
+            lastLevel[j] = lastLevel[i] = level;
+            if (level == static_cast<int>(levels.size())) levels.push_back(std::vector<int>());
+            levels[level].push_back(pairs.size() - 1);
+        }
+    }
+    for (size_t level = 0; level < levels.size(); level++) {
+        std::vector<int> const &todo = levels[level];
+        parallelFor(todo.size(), nThreads, [&](long begin, long end) {
+            for (long k = begin; k < end; k++) {
+                SuspectPair &pair = pairs[todo[k]];
+                flagSuspectPair(members[pair.j_ref], members[pair.j_targ], pair);
             }
-            std::sort(dm.begin(), dm.end());
-            double med = dm[dm.size() / 2];
-            double Q1 = dm[dm.size() / 10];
-            double Q3 = dm[dm.size() * 9 / 10];
-            double SIQR = 0.5 * (Q3 - Q1);
+        });
+    }
 
-            int ngood = 0;
-            int nbad = 0;
-            for (size_t k = 0; k < mref.size(); k++) {
-                if (fabs(mtarg[k] - mref[k] - med) > 3.0 * SIQR) {
-                    refs[k]->setFlux(-9999);
-                    targs[k]->setFlux(-9999);
-                    nbad += 1;
-                } else {
-                    ngood += 1;
-                }
-            }
-            printf("%d %d %6.3f %5.3f %5d %5d\n", visit_ref, visit_targ, med, SIQR, ngood, nbad);
+    for (size_t k = 0; k < pairs.size(); k++) {
+        int visit_ref = visits[pairs[k].j_ref];
+        int visit_targ = visits[pairs[k].j_targ];
+        if (pairs[k].ngood < 0) {
+            printf("%d %d\n", visit_ref, visit_targ);
+        } else {
+            printf("%d %d %6.3f %5.3f %5d %5d\n", visit_ref, visit_targ, pairs[k].med, pairs[k].SIQR,
+                   pairs[k].ngood, pairs[k].nbad);
         }
     }
 
     return 0;
 }
 
-ObsVec lsst::meas::mosaic::obsVecFromSourceGroup(SourceGroup const &all, WcsDic &wcsDic, CcdSet &ccdSet) {
-    std::vector<Obs::Ptr> obsVec;
-    for (size_t i = 0; i < all.size(); i++) {
-        SourceSet ss = all[i];
-        double ra = ss[0]->getRa().asRadians();
-        double dec = ss[0]->getDec().asRadians();
-        double mag_cat;
-        double err_cat;
-        if (ss[0]->getFlux() > 0.0 && ss[0]->getFluxErr() > 0.0) {
-            mag_cat = -2.5 * log10(ss[0]->getFlux());
-            err_cat = 2.5 / M_LN10 * ss[0]->getFluxErr() / ss[0]->getFlux();
-        } else {
-            mag_cat = -9999;
-            err_cat = -9999;
-        }
-        // std::cout << ra << " " << dec << std::endl;
-        // std::cout << mag0 << std::endl;
-        for (size_t j = 1; j < ss.size(); j++) {
-            long id = ss[j]->getId();
-            int iexp = ss[j]->getExp();
-            int ichip = ss[j]->getChip();
-            double x = ss[j]->getX();
-            double y = ss[j]->getY();
-            Obs::Ptr o = Obs::Ptr(new Obs(id, ra, dec, x, y, ichip, iexp));
-
-            int jexp = 0;
-            for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++) {
-                if (it->first == iexp) break;
-                jexp++;
-            }
-            o->jexp = jexp;
-
-            int jchip = 0;
-            for (CcdSet::iterator it = ccdSet.begin(); it != ccdSet.end(); it++) {
-                if (it->first == ichip) break;
-                jchip++;
-            }
-            o->jchip = jchip;
-
-            o->mag_cat = mag_cat;
-            o->err_cat = err_cat;
-            o->mag0 = mag_cat;
-            lsst::afw::geom::PointD crval =
-                wcsDic[iexp]->getSkyOrigin().getPosition(lsst::afw::geom::radians);
-            o->setXiEta(crval[0], crval[1]);
-            o->setUV(ccdSet[ichip]);
-            o->xerr = ss[j]->getXErr();
-            o->yerr = ss[j]->getYErr();
-            if (std::isnan(o->xerr) || std::isnan(o->yerr)) o->good = false;
-            // printf("%d %e %e\n", o->good, o->xerr, o->yerr);
-            o->istar = i;
-            if (ss[0]->getAstromBad() || ss[j]->getAstromBad()) {
-                o->good = false;
-            }
-            if (ss[j]->getFlux() > 0.0 && ss[j]->getFluxErr() > 0.0 && ss[j]->getFlux() < 1.0E+10) {
-                o->mag = -2.5 * log10(ss[j]->getFlux());
-                o->err = 2.5 / M_LN10 * ss[j]->getFluxErr() / ss[j]->getFlux();
+namespace {
+double getElapsed(std::chrono::steady_clock::time_point start) {
+    return std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+}
+
+// What Obs::setXiEta needs from an exposure, and Obs::setUV from a CCD,
+// looked up once rather than for every Obs
+struct ExpFrame {
+    int jexp;
+    double ra_c;
+    double dec_c;
+};
+
+struct CcdFrame {
+    int jchip;
+    double cosYaw;
+    double sinYaw;
+    lsst::afw::geom::Point2D centerDet;
+    lsst::afw::geom::Point2D centerFp;
+};
+
+// Obs::setUV with x0 = y0 = 0, from the saved frame
+void setUV(Obs &o, CcdFrame const &frame) {
+    o.u0 = o.x * frame.cosYaw - o.y * frame.sinYaw;
+    o.v0 = o.x * frame.sinYaw + o.y * frame.cosYaw;
+    o.u = frame.centerFp.getX() + (frame.cosYaw * o.x - frame.sinYaw * o.y - frame.centerDet.getX());
+    o.v = frame.centerFp.getY() + (frame.sinYaw * o.x + frame.cosYaw * o.y - frame.centerDet.getY());
+}
+
+// The members of a SourceGroup, for makeObsVec
+class SourceGroupRows {
+public:
+    explicit SourceGroupRows(SourceGroup const &sg) : _sg(sg) {}
+    size_t getNumGroups() const { return _sg.size(); }
+    size_t getGroupSize(size_t i) const { return _sg[i].size(); }
+    Source const &get(size_t i, size_t j) const { return *_sg[i][j]; }
+
+private:
+    SourceGroup const &_sg;
+};
+
+// A row of SourceGroupArrays, with the accessors of Source used by makeObsVec
+class ArrayRow {
+public:
+    ArrayRow(SourceGroupArrays const &arrays, long k) : _arrays(arrays), _k(k) {}
+    Source::IdType getId() const { return _arrays.id[_k]; }
+    Source::ChipType getChip() const { return _arrays.chip[_k]; }
+    Source::ExpType getExp() const { return _arrays.exp[_k]; }
+    lsst::afw::geom::Angle getRa() const {
+        return lsst::afw::geom::Angle(_arrays.ra[_k], lsst::afw::geom::degrees);
+    }
+    lsst::afw::geom::Angle getDec() const {
+        return lsst::afw::geom::Angle(_arrays.dec[_k], lsst::afw::geom::degrees);
+    }
+    double getX() const { return _arrays.x[_k]; }
+    double getY() const { return _arrays.y[_k]; }
+    double getXErr() const { return _arrays.xErr[_k]; }
+    double getYErr() const { return _arrays.yErr[_k]; }
+    double getFlux() const { return _arrays.flux[_k]; }
+    double getFluxErr() const { return _arrays.fluxErr[_k]; }
+    bool getAstromBad() const { return _arrays.astromBad[_k]; }
+
+private:
+    SourceGroupArrays const &_arrays;
+    long _k;
+};
+
+// The members of SourceGroupArrays, for makeObsVec
+class SourceGroupArrayRows {
+public:
+    explicit SourceGroupArrayRows(SourceGroupArrays const &arrays) : _arrays(arrays) {}
+    size_t getNumGroups() const { return std::max<long>(_arrays.offsets.getSize<0>(), 1) - 1; }
+    size_t getGroupSize(size_t i) const { return _arrays.offsets[i + 1] - _arrays.offsets[i]; }
+    ArrayRow get(size_t i, size_t j) const { return ArrayRow(_arrays, _arrays.offsets[i] + j); }
+
+private:
+    SourceGroupArrays const &_arrays;
+};
+
+template <typename Rows>
+ObsVec makeObsVec(Rows const &all, WcsDic &wcsDic, CcdSet &ccdSet, int nThreads, ObsVecTiming *timing) {
+    std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+
+    std::map<int, ExpFrame> expFrames;
+    for (WcsDic::iterator it = wcsDic.begin(); it != wcsDic.end(); it++) {
+        lsst::afw::geom::PointD crval = it->second->getSkyOrigin().getPosition(lsst::afw::geom::radians);
+        ExpFrame frame = {static_cast<int>(expFrames.size()), crval[0], crval[1]};
+        expFrames[it->first] = frame;
+    }
+    std::map<int, CcdFrame> ccdFrames;
+    for (CcdSet::iterator it = ccdSet.begin(); it != ccdSet.end(); it++) {
+        double yaw = getYaw(it->second);
+        CcdFrame frame = {static_cast<int>(ccdFrames.size()), std::cos(yaw), std::sin(yaw),
+                          getCenterInDetectorPixels(it->second), getCenterInFpPixels(it->second)};
+        ccdFrames[it->first] = frame;
+    }
+
+    // Where the Obs of each group start
+    size_t const nGroup = all.getNumGroups();
+    std::vector<long> begin(nGroup + 1, 0);
+    for (size_t i = 0; i < nGroup; i++) {
+        begin[i + 1] = begin[i] + std::max<long>(all.getGroupSize(i), 1) - 1;
+    }
+    double prepare = getElapsed(start);
+
+    std::vector<Obs::Ptr> obsVec(begin.back());
+    parallelFor(nGroup, nThreads, [&](long groupBegin, long groupEnd) {
+        for (long i = groupBegin; i < groupEnd; i++) {
+            auto const &s0 = all.get(i, 0);
+            double ra = s0.getRa().asRadians();
+            double dec = s0.getDec().asRadians();
+            double mag_cat;
+            double err_cat;
+            if (s0.getFlux() > 0.0 && s0.getFluxErr() > 0.0) {
+                mag_cat = -2.5 * log10(s0.getFlux());
+                err_cat = 2.5 / M_LN10 * s0.getFluxErr() / s0.getFlux();
             } else {
-                o->mag = -9999;
-                o->err = -9999;
-                o->good = false;
+                mag_cat = -9999;
+                err_cat = -9999;
+            }
+            for (size_t j = 1; j < all.getGroupSize(i); j++) {
+                auto const &s = all.get(i, j);
+                int iexp = s.getExp();
+                int ichip = s.getChip();
+                std::map<int, ExpFrame>::const_iterator expFrame = expFrames.find(iexp);
+                std::map<int, CcdFrame>::const_iterator ccdFrame = ccdFrames.find(ichip);
+                if (expFrame == expFrames.end() || ccdFrame == ccdFrames.end()) {
+                    throw LSST_EXCEPT(lsst::pex::exceptions::NotFoundError,
+                                      (boost::format("No WCS for exposure %d or no CCD %d") % iexp % ichip)
+                                              .str());
+                }
+                Obs::Ptr o = std::make_shared<Obs>(s.getId(), ra, dec, s.getX(), s.getY(), ichip, iexp);
+                o->jexp = expFrame->second.jexp;
+                o->jchip = ccdFrame->second.jchip;
+
+                o->mag_cat = mag_cat;
+                o->err_cat = err_cat;
+                o->mag0 = mag_cat;
+                o->setXiEta(expFrame->second.ra_c, expFrame->second.dec_c);
+                setUV(*o, ccdFrame->second);
+                o->xerr = s.getXErr();
+                o->yerr = s.getYErr();
+                if (std::isnan(o->xerr) || std::isnan(o->yerr)) o->good = false;
+                o->istar = i;
+                if (s0.getAstromBad() || s.getAstromBad()) {
+                    o->good = false;
+                }
+                if (s.getFlux() > 0.0 && s.getFluxErr() > 0.0 && s.getFlux() < 1.0E+10) {
+                    o->mag = -2.5 * log10(s.getFlux());
+                    o->err = 2.5 / M_LN10 * s.getFluxErr() / s.getFlux();
+                } else {
+                    o->mag = -9999;
+                    o->err = -9999;
+                    o->good = false;
+                }
+                obsVec[begin[i] + j - 1] = o;
             }
-            obsVec.push_back(o);
         }
+    });
+
+    if (timing) {
+        timing->prepare = prepare;
+        timing->total = getElapsed(start);
+        timing->build = timing->total - prepare;
     }
 
     return obsVec;
 }
+}  // namespace
+
+ObsVec lsst::meas::mosaic::obsVecFromSourceGroup(SourceGroup const &all, WcsDic &wcsDic, CcdSet &ccdSet,
+                                                 int nThreads, ObsVecTiming *timing) {
+    return makeObsVec(SourceGroupRows(all), wcsDic, ccdSet, nThreads, timing);
+}
+
+ObsVec lsst::meas::mosaic::obsVecFromSourceGroup(SourceGroupArrays const &all, WcsDic &wcsDic, CcdSet &ccdSet,
+                                                 int nThreads, ObsVecTiming *timing) {
+    getNumRows(all);  // throws if the columns differ in length
+    return makeObsVec(SourceGroupArrayRows(all), wcsDic, ccdSet, nThreads, timing);
+}
 
 Eigen::VectorXd solveSIP_P(Poly::Ptr p, std::vector<Obs::Ptr> &obsVec) {
     int ncoeff = p->ncoeff;
@@ -2855,6 +4016,17 @@ int fact(int n) {
 
 int binomial(int n, int k) { return (fact(n) / (fact(n - k) * fact(k))); }
 
+// The index of each star among those with num[i] >= 2, in order of i, or -1
+std::vector<int> indexStars(int const *num, int n, int *nstar) {
+    std::vector<int> index(n, -1);
+    int k = 0;
+    for (int i = 0; i < n; i++) {
+        if (num[i] >= 2) index[i] = k++;
+    }
+    *nstar = k;
+    return index;
+}
+
 Coeff::Ptr lsst::meas::mosaic::convertCoeff(Coeff::Ptr &coeff, PTR(lsst::afw::cameraGeom::Detector) & ccd) {
     Poly::Ptr p = Poly::Ptr(new Poly(coeff->p->order));
     Coeff::Ptr newC = Coeff::Ptr(new Coeff(p));
@@ -3055,45 +4227,10 @@ std::shared_ptr<lsst::afw::image::Image<float>> lsst::meas::mosaic::getJImg(
 
 std::shared_ptr<lsst::afw::image::Image<float>> lsst::meas::mosaic::getJImg(
     std::shared_ptr<lsst::afw::geom::SkyWcs> &wcs, int width, int height) {
-
     std::shared_ptr<lsst::afw::image::Image<float>> img(new lsst::afw::image::Image<float>(width, height));
+    if (width <= 0 || height <= 0) return img;
 
-    Eigen::VectorXd vals(width);
-
-    int interpLength = 100;
-
-    for (int y = 0; y != height; y++) {
-        for (int x = 0; x < width + interpLength; x += interpLength) {
-            int interval = interpLength;
-            int xend = x + interval;
-            int stop = interval;
-            if (xend >= width) {
-                xend = width - 1;
-                interval = xend - x;
-                stop = interval + 1;
-            }
-
-            double u = x;
-            double v = y;
-            double val0 = calculateJacobian(*wcs, lsst::afw::geom::Point2D(u, v));
-            u = xend;
-            v = y;
-            double val1 = calculateJacobian(*wcs, lsst::afw::geom::Point2D(u, v));
-
-            for (int i = 0; i < stop; i++) {
-                vals(x + i) = val0 + (val1 - val0) / interval * i;
-            }
-        }
-
-        lsst::afw::image::Image<float>::x_iterator begin = img->row_begin(y);
-        lsst::afw::image::Image<float>::x_iterator end = img->row_end(y);
-
-        for (lsst::afw::image::Image<float>::x_iterator ptr = begin; ptr != end; ptr++) {
-            int x = ptr - begin;
-
-            *ptr = vals(x);
-        }
-    }
+    fitJacobian(*wcs, img->getBBox())->fillImage(*img);
 
     return img;
 }
@@ -3143,3 +4280,64 @@ ndarray::Array<double, 1> lsst::meas::mosaic::calculateJacobian(lsst::afw::geom:
     }
     return lsst::meas::mosaic::calculateJacobian(wcs, points);
 }
+
+double lsst::meas::mosaic::calculateJacobian(Coeff::Ptr &coeff, lsst::afw::geom::Point2D const &point) {
+    double const u = point.getX() + coeff->x0;
+    double const v = point.getY() + coeff->y0;
+    // The gnomonic projection maps unit area of the tangent plane at (xi, eta)
+    // to a solid angle of (1 + xi^2 + eta^2)^-3/2
+    double const xi = coeff->xi(u, v) * D2R;
+    double const eta = coeff->eta(u, v) * D2R;
+    double const r2 = 1.0 + xi * xi + eta * eta;
+    double const scale = coeff->pixelScale();
+    return coeff->detJ(u, v) / (r2 * std::sqrt(r2)) / (scale * scale);
+}
+
+ndarray::Array<double, 1> lsst::meas::mosaic::calculateJacobian(Coeff::Ptr &coeff,
+                                                                ndarray::Array<double const, 1> const &x,
+                                                                ndarray::Array<double const, 1> const &y) {
+    auto const num = x.getShape()[0];
+    if (y.getShape()[0] != num) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::LengthError,
+                          str(boost::format("Size mismatch: %d vs %d") % x.getShape()[0] % y.getShape()[0]));
+    }
+    ndarray::Array<double, 1> target = ndarray::allocate(ndarray::makeVector(num));
+    for (std::size_t i = 0; i < num; i++) {
+        target[i] = lsst::meas::mosaic::calculateJacobian(coeff, lsst::afw::geom::Point2D(x[i], y[i]));
+    }
+    return target;
+}
+
+std::shared_ptr<lsst::afw::math::ChebyshevBoundedField> lsst::meas::mosaic::fitJacobian(
+    lsst::afw::geom::SkyWcs const &wcs, lsst::afw::geom::Box2I const &bbox, int order, int step) {
+    if (bbox.isEmpty() || order < 0 || step <= 0) {
+        throw LSST_EXCEPT(lsst::pex::exceptions::InvalidParameterError,
+                          str(boost::format("Cannot fit order %d every %d pixels over %dx%d pixels") % order %
+                              step % bbox.getWidth() % bbox.getHeight()));
+    }
+    // At least order + 2 samples along each axis, evenly spread from edge to edge
+    int const nx = std::max((bbox.getWidth() - 1) / step + 2, order + 2);
+    int const ny = std::max((bbox.getHeight() - 1) / step + 2, order + 2);
+    std::vector<lsst::afw::geom::Point2D> points;
+    points.reserve(nx * ny);
+    for (int j = 0; j < ny; j++) {
+        double const y = bbox.getMinY() + double(bbox.getHeight() - 1) * j / (ny - 1);
+        for (int i = 0; i < nx; i++) {
+            double const x = bbox.getMinX() + double(bbox.getWidth() - 1) * i / (nx - 1);
+            points.push_back(lsst::afw::geom::Point2D(x, y));
+        }
+    }
+    ndarray::Array<double, 1> x = ndarray::allocate(ndarray::makeVector(nx * ny));
+    ndarray::Array<double, 1> y = ndarray::allocate(ndarray::makeVector(nx * ny));
+    for (int k = 0; k < nx * ny; k++) {
+        x[k] = points[k].getX();
+        y[k] = points[k].getY();
+    }
+    ndarray::Array<double, 1> z = lsst::meas::mosaic::calculateJacobian(wcs, points);
+
+    lsst::afw::math::ChebyshevBoundedFieldControl ctrl;
+    ctrl.orderX = std::min(order, bbox.getWidth() - 1);
+    ctrl.orderY = std::min(order, bbox.getHeight() - 1);
+    ctrl.triangular = true;
+    return lsst::afw::math::ChebyshevBoundedField::fit(bbox, x, y, z, ctrl);
+}
@@ -0,0 +1,56 @@
+#ifndef MEAS_MOSAIC_parallel_h_INCLUDED
+#define MEAS_MOSAIC_parallel_h_INCLUDED
+
+#include <algorithm>
+#include <exception>
+#include <thread>
+#include <vector>
+
+namespace lsst { namespace meas { namespace mosaic {
+
+/*  Number of threads to use for a request of nThreads; 0 means one per
+    hardware thread.
+*/
+inline int getNumThreads(int nThreads) {
+    if (nThreads > 0) return nThreads;
+    int n = std::thread::hardware_concurrency();
+    return n > 0 ? n : 1;
+}
+
+/*  Call f(begin, end) on nThreads contiguous chunks of [0, n), each on its
+    own thread, and wait for them.  With a single chunk f runs on the calling
+    thread.  Chunk boundaries depend only on n and nThreads, and an exception
+    thrown by any chunk is rethrown here.
+*/
+template <typename F>
+void parallelFor(long n, int nThreads, F f) {
+    nThreads = static_cast<int>(std::min<long>(getNumThreads(nThreads), std::max(1L, n)));
+    if (nThreads <= 1) {
+        f(0L, n);
+        return;
+    }
+
+    std::vector<std::thread> threads;
+    std::vector<std::exception_ptr> errors(nThreads);
+    for (int t = 0; t < nThreads; t++) {
+        long begin = n * t / nThreads;
+        long end = n * (t + 1) / nThreads;
+        threads.push_back(std::thread([&f, &errors, t, begin, end]() {
+            try {
+                f(begin, end);
+            } catch (...) {
+                errors[t] = std::current_exception();
+            }
+        }));
+    }
+    for (size_t t = 0; t < threads.size(); t++) {
+        threads[t].join();
+    }
+    for (size_t t = 0; t < errors.size(); t++) {
+        if (errors[t]) std::rethrow_exception(errors[t]);
+    }
+}
+
+}}} // namespace lsst::meas::mosaic
+
+#endif // !MEAS_MOSAIC_parallel_h_INCLUDED
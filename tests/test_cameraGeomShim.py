@@ -23,6 +23,7 @@ import unittest
 
 import lsst.afw.geom as afwGeom
 import lsst.meas.mosaic as measMosaic
+import lsst.pex.exceptions as pexExceptions
 import lsst.utils.tests as utilsTests
 
 try:
@@ -100,6 +101,45 @@ class ShimCameraGeomTestCase(utilsTests.TestCase):
                 self.assertAlmostEqual(measMosaic.detPxToFpPxRot(ccd, point).getX(), pt.getX(), 5)
                 self.assertAlmostEqual(measMosaic.detPxToFpPxRot(ccd, point).getY(), pt.getY(), 5)
 
+    def testObsVecFromSourceGroup(self):
+        ccdSet = {ccd.getId(): ccd for ccd in self.ccds}
+        wcsDic = {visit: afwGeom.makeSkyWcs(afwGeom.Point2D(0.0, 0.0),
+                                            afwGeom.SpherePoint(150.0 + 0.01*visit, 2.0, afwGeom.degrees),
+                                            afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+                  for visit in (10, 20, 30)}
+        allSource = []
+        for i in range(50):
+            ra, dec = 150.0 + 1.0E-3*i, 2.0
+            group = [measMosaic.Source(afwGeom.SpherePoint(ra, dec, afwGeom.degrees), 1.0)]
+            for visit in wcsDic:
+                ccd = self.ccds[(i + visit) % len(self.ccds)]
+                group.append(measMosaic.Source(i, ccd.getId(), visit, ra, dec, 10.0*i, 0.01, 20.0*i, 0.01,
+                                               100.0, 1.0, False))
+            allSource.append(group)
+
+        obsVec = measMosaic.obsVecFromSourceGroup(allSource, wcsDic, ccdSet)
+        self.assertEqual(len(obsVec), 50*len(wcsDic))
+        visits = sorted(wcsDic)
+        chips = sorted(ccdSet)
+        for o in obsVec:
+            ccd = ccdSet[o.ichip]
+            uv = measMosaic.detPxToFpPxRot(ccd, afwGeom.Point2D(o.x, o.y))
+            self.assertEqual(o.u, uv.getX())
+            self.assertEqual(o.v, uv.getY())
+            self.assertEqual(o.jexp, visits.index(o.iexp))
+            self.assertEqual(o.jchip, chips.index(o.ichip))
+
+        timing = measMosaic.ObsVecTiming()
+        threaded = measMosaic.obsVecFromSourceGroup(allSource, wcsDic, ccdSet, nThreads=3, timing=timing)
+        self.assertGreaterEqual(timing.total, timing.prepare)
+        self.assertEqual([(o.id, o.iexp, o.u, o.v, o.xi, o.eta) for o in threaded],
+                         [(o.id, o.iexp, o.u, o.v, o.xi, o.eta) for o in obsVec])
+
+        del ccdSet[self.ccds[0].getId()]
+        with self.assertRaises(pexExceptions.NotFoundError):
+            measMosaic.obsVecFromSourceGroup(allSource, wcsDic, ccdSet)
+
+
 if __name__ == "__main__":
     """Run the tests"""
     unittest.main()
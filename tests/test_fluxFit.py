@@ -0,0 +1,177 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+
+import multiprocessing.pool
+import unittest
+import numpy as np
+
+import lsst.meas.mosaic as measMosaic
+import lsst.utils.tests
+
+
+def makeObs(nExp, nChip, nMatch, nSource, outlierFraction=0.03, errRange=(0.01, 0.03),
+            uniformNoise=False):
+    """Observations of nMatch catalog stars and nSource other stars
+
+    Each star is seen from one to six times, at random focal plane
+    positions of random exposures and chips, with a quadratic flux
+    correction, and a fraction of the observations are outliers.  The
+    errors are drawn from errRange, and the noise is Gaussian, or uniform
+    within the errors if uniformNoise.
+    """
+    rng = np.random.RandomState(12345)
+    zpExp = rng.uniform(-0.3, 0.3, size=nExp)
+    zpChip = rng.uniform(-0.05, 0.05, size=nChip)
+    matchVec = []
+    sourceVec = []
+    for obsVec, nStar in ((matchVec, nMatch), (sourceVec, nSource)):
+        for istar in range(nStar):
+            mag = rng.uniform(17.0, 23.0)
+            for i in range(rng.randint(1, 7)):
+                jexp = rng.randint(nExp)
+                jchip = rng.randint(nChip)
+                obs = measMosaic.Obs(len(obsVec), 0.0, 0.0, jchip, 100 + jexp)
+                obs.jexp = jexp
+                obs.jchip = jchip
+                obs.istar = istar
+                obs.jstar = istar if obsVec is matchVec else -1
+                obs.u, obs.v = rng.uniform(-0.9, 0.9, size=2)
+                obs.err = rng.uniform(*errRange)
+                noise = rng.uniform(-obs.err, obs.err) if uniformNoise else rng.normal(0.0, obs.err)
+                obs.mag = mag + zpExp[jexp] + zpChip[jchip] - 0.05*obs.u**2 + 0.03*obs.u*obs.v + noise
+                if rng.uniform() < outlierFraction:
+                    obs.mag += rng.uniform(-0.5, 0.5)
+                if obsVec is matchVec:
+                    obs.mag_cat = mag + (rng.uniform(-0.02, 0.02) if uniformNoise else rng.normal(0.0, 0.02))
+                else:
+                    obs.mag_cat = -9999
+                obs.err_cat = 0.02
+                obs.good = True
+                obsVec.append(obs)
+    return matchVec, sourceVec
+
+
+class FluxFitTestCase(lsst.utils.tests.TestCase):
+
+    def runFluxFit(self, absolute, common, solveCcd, maxChurn=0.0, iteration=None, nSource=400, nExp=8,
+                   nChip=4, **kwargs):
+        matchVec, sourceVec = makeObs(nExp, nChip, 100, nSource, **kwargs)
+        # fluxFit uses only the keys of wcsDic and ccdSet
+        wcsDic = {100 + i: None for i in range(nExp)}
+        ccdSet = {i: None for i in range(nChip)}
+        ffpSet = {visit: measMosaic.FluxFitParams(5, absolute, True) for visit in wcsDic}
+        return measMosaic.fluxFit(absolute, common, matchVec, len(matchVec), sourceVec, len(sourceVec),
+                                  wcsDic, ccdSet, {}, {}, ffpSet, solveCcd, maxChurn=maxChurn,
+                                  iteration=iteration)
+
+    def assertSameFit(self, rebuilt, updated):
+        for vec0, vec1 in zip(rebuilt[:2], updated[:2]):
+            self.assertEqual([obs.good for obs in vec0], [obs.good for obs in vec1])
+            mag0 = np.array([obs.mag0 for obs in vec0 if obs.good and obs.jstar != -1])
+            mag1 = np.array([obs.mag0 for obs in vec1 if obs.good and obs.jstar != -1])
+            self.assertFloatsAlmostEqual(mag0, mag1, atol=1E-8, rtol=0)
+        fexp0, fchip0, ffpSet0 = rebuilt[4:]
+        fexp1, fchip1, ffpSet1 = updated[4:]
+        for visit in fexp0:
+            self.assertFloatsAlmostEqual(fexp0[visit], fexp1[visit], rtol=1E-6)
+            coeff0 = [ffpSet0[visit].getCoeff(i) for i in range(ffpSet0[visit].ncoeff)]
+            coeff1 = [ffpSet1[visit].getCoeff(i) for i in range(ffpSet1[visit].ncoeff)]
+            self.assertFloatsAlmostEqual(np.array(coeff0), np.array(coeff1), atol=1E-8, rtol=0)
+        for ccd in fchip0:
+            self.assertFloatsAlmostEqual(fchip0[ccd], fchip1[ccd], rtol=1E-6)
+
+    def testMaxChurn(self):
+        """Updating the factorized equations for the rejected observations gives the rebuilt solution"""
+        for absolute in (False, True):
+            for common in (False, True):
+                for solveCcd in (False, True):
+                    rebuilt = self.runFluxFit(absolute, common, solveCcd, 0.0)
+                    iteration = measMosaic.FluxFitIteration()
+                    updated = self.runFluxFit(absolute, common, solveCcd, 1.0, iteration=iteration)
+                    self.assertGreater(iteration.nUpdate, 0)
+                    self.assertSameFit(rebuilt, updated)
+
+    def testMaxChurnLowRank(self):
+        """A few rejected observations in a large reduced system update the kept factorization"""
+        # A flux correction per exposure gives some six hundred global unknowns,
+        # and uniform noise within the errors leaves only the outliers to reject
+        obsArgs = dict(nSource=1000, nExp=32, outlierFraction=0.003, errRange=(0.015, 0.025),
+                       uniformNoise=True)
+        for absolute in (False, True):
+            rebuilt = self.runFluxFit(absolute, False, True, 0.0, **obsArgs)
+            iteration = measMosaic.FluxFitIteration()
+            updated = self.runFluxFit(absolute, False, True, 1.0, iteration=iteration, **obsArgs)
+            self.assertGreater(iteration.nUpdate, 0)
+            self.assertEqual(iteration.nLowRank, iteration.nUpdate)
+            self.assertSameFit(rebuilt, updated)
+
+    def testConvergence(self):
+        """Without outliers the first solution rejects nothing and is the last"""
+        # Uniform noise within narrow errors, so that an absolute fit of the
+        # catalog stars alone cannot reject anything
+        obsArgs = dict(outlierFraction=0.0, nSource=0, errRange=(0.015, 0.025), uniformNoise=True)
+        for common in (False, True):
+            iteration = measMosaic.FluxFitIteration()
+            self.assertEqual(iteration.maxIter, 3)
+            converged = self.runFluxFit(True, common, True, iteration=iteration, **obsArgs)
+            self.assertEqual(iteration.nIter, 1)
+            self.assertEqual(iteration.reason, "rejection")
+            self.assertTrue(all(obs.good for obs in converged[0]))
+
+            # The same as running all three, never stopping for rejection
+            iteration = measMosaic.FluxFitIteration()
+            iteration.maxReject = -1
+            full = self.runFluxFit(True, common, True, iteration=iteration, **obsArgs)
+            self.assertEqual(iteration.nIter, 3)
+            self.assertEqual(iteration.reason, "maxIter")
+            for visit in converged[4]:
+                self.assertEqual(converged[4][visit], full[4][visit])
+
+    def testMaxIter(self):
+        """With outliers every solution but the last rejects some"""
+        iteration = measMosaic.FluxFitIteration()
+        iteration.maxIter = 2
+        matchVec, sourceVec = self.runFluxFit(False, True, True, iteration=iteration)[:2]
+        self.assertEqual(iteration.nIter, 2)
+        self.assertEqual(iteration.reason, "maxIter")
+        self.assertFalse(all(obs.good for obs in matchVec + sourceVec))
+
+    def testThreads(self):
+        """Fits of different observations in several threads give the results of running them in turn"""
+        args = [(False, True, True), (True, False, False), (False, False, True)]
+        pool = multiprocessing.pool.ThreadPool(processes=len(args))
+        threaded = pool.map(lambda a: self.runFluxFit(*a), args)
+        pool.close()
+        pool.join()
+        for a, result in zip(args, threaded):
+            serial = self.runFluxFit(*a)
+            self.assertEqual([obs.mag0 for obs in result[0]], [obs.mag0 for obs in serial[0]])
+            self.assertEqual(result[4], serial[4])
+            self.assertEqual(result[5], serial[5])
+
+
+if __name__ == "__main__":
+    """Run the tests"""
+    unittest.main()
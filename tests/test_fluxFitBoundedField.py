@@ -23,6 +23,7 @@
 from __future__ import absolute_import, division, print_function
 
 import os
+import time
 import unittest
 import numpy as np
 
@@ -299,6 +300,154 @@ class FluxFitBoundedFieldTestCase(lsst.utils.tests.TestCase):
         rtol = 1E-6 if nQuarter == 0 else 1E-4
         self.assertImagesAlmostEqual(image1, results2.exposure.image, rtol=rtol)
 
+    def testEvalArray(self):
+        """Test that evaluating FluxFitParams on arrays, with and without
+        threads, gives the values of the scalar eval.
+        """
+        ffp = self.ffp[self.ccds[0]]
+        N_POINTS = 200000
+        x = np.random.uniform(low=self.bbox.getMinX(), high=self.bbox.getMaxX(), size=N_POINTS)
+        y = np.random.uniform(low=self.bbox.getMinY(), high=self.bbox.getMaxY(), size=N_POINTS)
+        expected = np.array([ffp.eval(xx, yy) for xx, yy in zip(x[:1000], y[:1000])])
+        z1 = ffp.eval(x, y)
+        z2 = ffp.eval(x, y, nThreads=4)
+        self.assertFloatsEqual(z1[:1000], expected)
+        self.assertFloatsEqual(z1, z2)
+
+    def testFCorImg(self):
+        """Test that the interpolated getFCorImg, with and without threads,
+        stays close to the exact flux correction on every pixel.
+        """
+        for nQuarter, ccd in sorted(self.ccds.items()):
+            ffp = self.ffp[ccd]
+            if nQuarter%2:
+                width, height = self.bbox.getHeight(), self.bbox.getWidth()
+            else:
+                width, height = self.bbox.getWidth(), self.bbox.getHeight()
+            x, y = np.meshgrid(np.arange(width, dtype=float), np.arange(height, dtype=float))
+            expected = 10**(-0.4*ffp.eval(x.ravel(), y.ravel()).reshape(height, width))
+            t0 = time.time()
+            image1 = lsst.meas.mosaic.getFCorImg(ffp, width, height)
+            t1 = time.time()
+            image2 = lsst.meas.mosaic.getFCorImg(ffp, width, height, nThreads=4)
+            t2 = time.time()
+            print("getFCorImg %dx%d: %.1f images/s, %.1f images/s with 4 threads" %
+                  (width, height, 1.0/max(t1 - t0, 1E-6), 1.0/max(t2 - t1, 1E-6)))
+            self.assertFloatsAlmostEqual(image1.array, expected, rtol=5E-5)
+            self.assertFloatsEqual(image1.array, image2.array)
+
+    def testImageMethods(self):
+        """Test that the image methods of FluxFitBoundedField agree with
+        evaluate, and with the BoundedField versions when interpolating, and
+        time both.
+        """
+        bf, ffp, wcs = self.makeBoundedField(0)
+        # With unit steps every pixel is a node
+        bbox = lsst.afw.geom.Box2I(lsst.afw.geom.Point2I(100, 200), lsst.afw.geom.Extent2I(200, 64))
+        x, y = np.meshgrid(np.arange(bbox.getMinX(), bbox.getMaxX() + 1, dtype=float),
+                           np.arange(bbox.getMinY(), bbox.getMaxY() + 1, dtype=float))
+        expected = bf.evaluate(x.ravel(), y.ravel()).reshape(x.shape)
+        self.assertFloatsEqual(expected[0, :3],
+                               [bf.evaluate(lsst.afw.geom.Point2D(xx, y[0, 0])) for xx in x[0, :3]])
+        image = lsst.afw.image.ImageD(bbox)
+        bf.fillImage(image, overlapOnly=True)
+        self.assertFloatsEqual(image.array, expected)
+        image.array[:, :] = 2.0
+        bf.multiplyImage(image, overlapOnly=True)
+        self.assertFloatsAlmostEqual(image.array, 2.0*expected, rtol=1E-15)
+        bf.divideImage(image, overlapOnly=True)
+        self.assertFloatsAlmostEqual(image.array, 2.0, rtol=1E-15)
+        image.array[:, :] = 0.0
+        bf.addToImage(image, scaleBy=0.5, overlapOnly=True)
+        self.assertFloatsAlmostEqual(image.array, 0.5*expected, rtol=1E-15)
+
+        image1 = lsst.afw.image.ImageF(self.bbox)
+        image2 = lsst.afw.image.ImageF(self.bbox)
+        t0 = time.time()
+        lsst.afw.math.BoundedField.fillImage(bf, image1, xStep=100, yStep=16)
+        t1 = time.time()
+        bf.fillImage(image2, xStep=100, yStep=16)
+        t2 = time.time()
+        print("fillImage with xStep=100, yStep=16: %.3f s for BoundedField, %.3f s for FluxFitBoundedField" %
+              (t1 - t0, t2 - t1))
+        self.assertImagesAlmostEqual(image1, image2, rtol=1E-6)
+
+    def testCoeffJacobian(self):
+        """Test that the Jacobian from the derivatives of a Coeff is that of
+        the Wcs made from it, to the precision of Wcs.getPixelScale.
+        """
+        poly = lsst.meas.mosaic.Poly(3)
+        coeff = lsst.meas.mosaic.Coeff(poly)
+        scale = 0.168/3600.0  # degrees per pixel
+        distortion = 8E-11  # radial, per pixel^2
+        for (i, j), a, b in (((1, 0), scale, -1E-3*scale),
+                             ((0, 1), 1E-3*scale, scale),
+                             ((3, 0), distortion*scale, 0.0),
+                             ((1, 2), distortion*scale, 0.0),
+                             ((2, 1), 0.0, distortion*scale),
+                             ((0, 3), 0.0, distortion*scale)):
+            coeff.set_a(poly.getIndex(i, j), a)
+            coeff.set_b(poly.getIndex(i, j), b)
+        coeff.A = 1.2
+        coeff.D = 0.3
+        coeff.x0 = 5000.0
+        coeff.y0 = -3000.0
+        wcs = lsst.meas.mosaic.wcsFromCoeff(coeff)
+        N_POINTS = 1000
+        x = np.random.uniform(low=self.bbox.getMinX(), high=self.bbox.getMaxX(), size=N_POINTS)
+        y = np.random.uniform(low=self.bbox.getMinY(), high=self.bbox.getMaxY(), size=N_POINTS)
+        expected = lsst.meas.mosaic.calculateJacobian(wcs, x, y)
+        z = lsst.meas.mosaic.calculateJacobian(coeff, x, y)
+        self.assertFloatsAlmostEqual(z, expected, rtol=1E-5)
+        self.assertEqual(lsst.meas.mosaic.calculateJacobian(coeff, lsst.afw.geom.Point2D(x[0], y[0])), z[0])
+
+    def testFitJacobian(self):
+        """Test that the Chebyshev surface fitted to the Jacobian of the
+        jointcal Wcs of each CCD reproduces the Jacobian over the CCD.
+        """
+        N_POINTS = 100000
+        x = np.random.uniform(low=self.bbox.getMinX(), high=self.bbox.getMaxX(), size=N_POINTS)
+        y = np.random.uniform(low=self.bbox.getMinY(), high=self.bbox.getMaxY(), size=N_POINTS)
+        for ccd, wcs in sorted(self.wcs.items()):
+            expected = lsst.meas.mosaic.calculateJacobian(wcs, x, y)
+            z = lsst.meas.mosaic.fitJacobian(wcs, self.bbox).evaluate(x, y)
+            self.assertFloatsAlmostEqual(z, expected, rtol=1E-6)
+
+    def testPersistedJacobian(self):
+        """Test that a FluxFitBoundedField carrying a fitted Jacobian persists
+        it and evaluates close to one using the Wcs, and time both; and that
+        one without uses the exact Jacobian of the Wcs, as files written
+        before the Jacobian was persisted did.
+        """
+        N_POINTS = 100000
+        x = np.random.uniform(low=self.bbox.getMinX(), high=self.bbox.getMaxX(), size=N_POINTS)
+        y = np.random.uniform(low=self.bbox.getMinY(), high=self.bbox.getMaxY(), size=N_POINTS)
+        for nQuarter, ccd in sorted(self.ccds.items()):
+            # Files written before the Jacobian was persisted still read
+            self.assertIsNone(self.photoCalib[ccd].computeScaledCalibration().getJacobian())
+            bf0 = self.makeBoundedField(nQuarter, wcs=False)[0]
+            bf1, ffp, wcs = self.makeBoundedField(nQuarter)
+            bf2 = lsst.meas.mosaic.FluxFitBoundedField(self.bbox, ffp=ffp, wcs=wcs, nQuarter=nQuarter,
+                                                       jacobian=lsst.meas.mosaic.fitJacobian(wcs, self.bbox))
+            t0 = time.time()
+            z1 = bf1.evaluate(x, y)
+            t1 = time.time()
+            z2 = bf2.evaluate(x, y)
+            t2 = time.time()
+            print("ccd %d at %d points: %.3f s with the Wcs, %.3f s with the persisted Jacobian" %
+                  (ccd, N_POINTS, t1 - t0, t2 - t1))
+            self.assertIsNone(bf1.getJacobian())
+            self.assertFloatsAlmostEqual(z1, bf0.evaluate(x, y)*lsst.meas.mosaic.calculateJacobian(wcs, x, y),
+                                         rtol=1E-15)
+            self.assertFloatsAlmostEqual(z2, z1, rtol=1E-6)
+            self.assertFloatsAlmostEqual((bf2*2.0).evaluate(x, y), 2.0*z2, rtol=1E-15)
+            with lsst.utils.tests.getTempFilePath(".fits") as tempFile:
+                bf2.writeFits(tempFile)
+                bf3 = lsst.afw.math.BoundedField.readFits(tempFile)
+            self.assertEqual(bf2, bf3)
+            self.assertIsNotNone(bf3.getJacobian())
+            self.assertFloatsEqual(bf3.evaluate(x, y), z2)
+
     def testNQuarter0(self):
         self.checkFillImage(0, ffp=True, wcs=False)
         self.checkFillImage(0, ffp=False, wcs=True)
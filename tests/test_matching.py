@@ -0,0 +1,548 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+import pickle
+import time
+import unittest
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+import lsst.meas.mosaic as measMosaic
+import lsst.meas.mosaic.utils as mosaicUtils
+import lsst.utils.tests
+
+
+def toVector(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)]).T
+
+
+def makeVisits(ra, dec, nVisit, scatter, flux=1000.0):
+    """Detections of the objects at ra, dec (degrees) in nVisit visits
+
+    Positions are perturbed by up to scatter arcsec in each coordinate.
+    """
+    sourceSet = []
+    for visit in range(nVisit):
+        dra = np.random.uniform(-scatter, scatter, size=len(ra))/3600.0
+        ddec = np.random.uniform(-scatter, scatter, size=len(ra))/3600.0
+        sourceSet.append([measMosaic.Source(i, 0, visit, (r + dr) % 360.0, d + dd, 100.0, 0.01, 200.0, 0.01,
+                                            flux, 10.0, False)
+                          for i, (r, d, dr, dd) in enumerate(zip(ra, dec, dra, ddec))])
+    return sourceSet
+
+
+def makeMatchCatalogs(wcs, ra, dec, scatter):
+    """Catalogs of reference objects at ra, dec (degrees) and of their detections in a CCD with wcs
+
+    Detections are perturbed by up to scatter pixels in each coordinate.
+    """
+    refSchema = afwTable.SimpleTable.makeMinimalSchema()
+    refFluxKey = refSchema.addField("flux", type=float, doc="reference flux")
+    refCat = afwTable.SimpleCatalog(refSchema)
+    schema = afwTable.SourceTable.makeMinimalSchema()
+    centroidKey = afwTable.Point2DKey.addFields(schema, "centroid", "centroid", "pixel")
+    xErrKey = schema.addField("centroid_xErr", type=float, doc="centroid x error", units="pixel")
+    yErrKey = schema.addField("centroid_yErr", type=float, doc="centroid y error", units="pixel")
+    schema.addField("centroid_flag", type="Flag", doc="centroid failed")
+    fluxKey = schema.addField("calibFlux_instFlux", type=float, doc="calib flux", units="count")
+    fluxErrKey = schema.addField("calibFlux_instFluxErr", type=float, doc="calib flux error", units="count")
+    fluxFlagKey = schema.addField("calibFlux_flag", type="Flag", doc="calib flux failed")
+    table = afwTable.SourceTable.make(schema)
+    table.defineCentroid("centroid")
+    table.defineCalibFlux("calibFlux")
+    srcCat = afwTable.SourceCatalog(table)
+    refCat.reserve(len(ra))
+    srcCat.reserve(len(ra))
+    for i, (r, d) in enumerate(zip(ra, dec)):
+        ref = refCat.addNew()
+        ref.setId(i + 1)
+        ref.setCoord(afwGeom.SpherePoint(r, d, afwGeom.degrees))
+        ref.set(refFluxKey, np.random.uniform(1E-6, 1E-4))
+        src = srcCat.addNew()
+        src.setId(1000000 + i)
+        point = wcs.skyToPixel(ref.getCoord()) + afwGeom.Extent2D(*np.random.uniform(-scatter, scatter, 2))
+        src.set(centroidKey, point)
+        src.setCoord(wcs.pixelToSky(point))
+        src.set(xErrKey, 0.01)
+        src.set(yErrKey, 0.02)
+        src.set(fluxKey, np.random.uniform(100.0, 10000.0))
+        src.set(fluxErrKey, 10.0)
+        src.set(fluxFlagKey, i % 50 == 0)
+    return refCat, srcCat
+
+
+class MatchingTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        np.random.seed(12345)
+
+    def checkNearest(self, ra, dec, qra, qdec, radius):
+        tree = measMosaic.FlatKDTree(ra, dec)
+        self.assertEqual(len(tree), len(ra))
+        points = toVector(ra, dec)
+        limit = (2.0*np.sin(0.5*radius.asRadians()))**2
+        for r, d in zip(qra, qdec):
+            chord2 = np.sum((points - toVector(r, d))**2, axis=1)
+            expected = np.argmin(chord2) if chord2.min() < limit else -1
+            sky = afwGeom.SpherePoint(r, d, afwGeom.degrees)
+            self.assertEqual(tree.findNearest(sky, radius), expected)
+            self.assertEqual(sorted(tree.findWithin(sky, radius)), list(np.where(chord2 < limit)[0]))
+
+    def testFlatKDTreeWrap(self):
+        n = 5000
+        ra = (359.5 + np.random.uniform(0.0, 1.0, size=n)) % 360.0
+        dec = np.random.uniform(-0.5, 0.5, size=n)
+        qra = (359.5 + np.random.uniform(0.0, 1.0, size=200)) % 360.0
+        qdec = np.random.uniform(-0.5, 0.5, size=200)
+        self.checkNearest(ra, dec, qra, qdec, afwGeom.Angle(60.0, afwGeom.arcseconds))
+
+    def testFlatKDTreePole(self):
+        n = 5000
+        ra = np.random.uniform(0.0, 360.0, size=n)
+        dec = np.random.uniform(89.5, 90.0, size=n)
+        qra = np.random.uniform(0.0, 360.0, size=200)
+        qdec = np.random.uniform(89.5, 90.0, size=200)
+        self.checkNearest(ra, dec, qra, qdec, afwGeom.Angle(60.0, afwGeom.arcseconds))
+
+    def testKdtreeSourceWrap(self):
+        """Detections of the same objects straddling RA=0 merge into one group each"""
+        n = 200
+        nVisit = 4
+        ra = (359.95 + np.arange(n)*0.1/n) % 360.0
+        dec = np.zeros(n)
+        sourceSet = makeVisits(ra, dec, nVisit, 0.1)
+        ref = measMosaic.Source(afwGeom.SpherePoint(10.0, 10.0, afwGeom.degrees), 1.0)
+        det = measMosaic.Source(0, 0, 0, 10.0, 10.0, 1.0, 0.01, 1.0, 0.01, 1.0, 0.1, False)
+        rootMat = measMosaic.kdtreeMat([[(ref, det)]])
+        rootSource = measMosaic.kdtreeSource(sourceSet, rootMat, {}, afwGeom.Angle(1.0, afwGeom.arcseconds))
+        allSource = rootSource.mergeSource(2)
+        self.assertEqual(len(allSource), n)
+        for ss in allSource:
+            self.assertEqual(len(ss), nVisit + 1)
+            self.assertEqual(len(set(s.getId() for s in ss[1:])), 1)
+            self.assertLess(ss[0].getSky().separation(ss[1].getSky()).asArcseconds(), 0.3)
+
+    def testFofSource(self):
+        """Friends-of-friends groups are the connected components and do not depend on visit order"""
+        n = 300
+        nVisit = 3
+        ra = (359.9 + np.random.uniform(0.0, 0.2, size=n)) % 360.0
+        dec = np.random.uniform(89.8, 90.0, size=n)
+        sourceSet = makeVisits(ra, dec, nVisit, 0.5)
+        ref = measMosaic.Source(afwGeom.SpherePoint(10.0, 10.0, afwGeom.degrees), 1.0)
+        det = measMosaic.Source(0, 0, 0, 10.0, 10.0, 1.0, 0.01, 1.0, 0.01, 1.0, 0.1, False)
+        rootMat = measMosaic.kdtreeMat([[(ref, det)]])
+        radius = afwGeom.Angle(20.0, afwGeom.arcseconds)
+
+        sources = [s for ss in sourceSet for s in ss]
+        points = toVector(np.array([s.getRa().asDegrees() for s in sources]),
+                          np.array([s.getDec().asDegrees() for s in sources]))
+        limit = (2.0*np.sin(0.5*radius.asRadians()))**2
+        label = np.arange(len(sources))
+        for i in range(len(sources)):
+            neighbours = np.where(np.sum((points - points[i])**2, axis=1) < limit)[0]
+            old = np.unique(label[neighbours])
+            label[np.isin(label, old)] = old.min()
+        expected = set(frozenset((sources[i].getExp(), sources[i].getId()) for i in np.where(label == k)[0])
+                       for k in np.unique(label))
+
+        for ordered in (sourceSet, sourceSet[::-1]):
+            groups = measMosaic.fofSource(ordered, rootMat, radius).mergeSource(1)
+            self.assertEqual(set(frozenset((s.getExp(), s.getId()) for s in ss[1:]) for ss in groups),
+                             expected)
+
+    def testFofScaling(self):
+        """Friends-of-friends gives the groups of the nearest grouping at growing numbers of sources"""
+        nVisit = 4
+        radius = afwGeom.Angle(2.0, afwGeom.arcseconds)
+        empty = measMosaic.SourceArrays.concatenate([])
+        allMat = measMosaic.mergeMatArrays(empty, empty)
+        for nObj in (1000, 10000, 100000):
+            # Isolated objects on a grid of 10 arcsec across RA=0, detected
+            # within 0.5 arcsec in each visit
+            side = int(np.ceil(np.sqrt(nObj)))
+            index = np.arange(nObj)
+            ra = ((index % side - side//2)*10.0/3600.0) % 360.0
+            dec = (index//side - side//2)*10.0/3600.0
+            n = nObj*nVisit
+            sources = measMosaic.SourceArrays.fromColumns(
+                id=np.tile(index, nVisit), chip=np.zeros(n), exp=np.repeat(np.arange(nVisit), nObj),
+                ra=(np.tile(ra, nVisit) + np.random.uniform(-0.5, 0.5, size=n)/3600.0) % 360.0,
+                dec=np.tile(dec, nVisit) + np.random.uniform(-0.5, 0.5, size=n)/3600.0,
+                x=np.zeros(n), xErr=np.full(n, 0.01), y=np.zeros(n), yErr=np.full(n, 0.01),
+                flux=np.ones(n), fluxErr=np.full(n, 0.1), astromBad=np.zeros(n, dtype=bool))
+
+            groups = {}
+            for mode in ("nearest", "fof"):
+                allSource = measMosaic.mergeSourceArrays(sources, allMat, radius, mode, 2)
+                self.assertEqual(len(allSource), nObj)
+                np.testing.assert_array_equal(mosaicUtils.getNumObs(allSource), nVisit)
+                groups[mode] = set(frozenset(allSource.id[i + 1:j].tolist())
+                                   for i, j in zip(allSource.offsets[:-1], allSource.offsets[1:]))
+            self.assertEqual(groups["fof"], groups["nearest"])
+            self.assertTrue(all(len(ids) == 1 for ids in groups["fof"]))
+
+    def testMatchThreads(self):
+        """Grouping gives the same groups, in the same order, for any number of threads"""
+        n = 2000
+        ra = np.random.uniform(150.0, 150.2, size=n)
+        dec = np.random.uniform(2.0, 2.2, size=n)
+        sourceSet = makeVisits(ra, dec, 4, 1.0)
+        ref = measMosaic.Source(afwGeom.SpherePoint(10.0, 10.0, afwGeom.degrees), 1.0)
+        det = measMosaic.Source(0, 0, 0, 10.0, 10.0, 1.0, 0.01, 1.0, 0.01, 1.0, 0.1, False)
+        rootMat = measMosaic.kdtreeMat([[(ref, det)]])
+        radius = afwGeom.Angle(3.0, afwGeom.arcseconds)
+
+        def getIds(root):
+            return [[(s.getExp(), s.getId()) for s in ss] for ss in root.groups]
+
+        for merge in (lambda nThreads: measMosaic.kdtreeSource(sourceSet, rootMat, {}, radius, nThreads),
+                      lambda nThreads: measMosaic.fofSource(sourceSet, rootMat, radius, nThreads)):
+            expected = getIds(merge(1))
+            for nThreads in (3, 0):
+                self.assertEqual(getIds(merge(nThreads)), expected)
+
+    def testMatchArrays(self):
+        """matchArrays gives the groups of kdtreeSource and fofSource, and matches references"""
+        n = 500
+        nVisit = 3
+        # Objects 5 arcsec apart on a grid straddling RA=0
+        ra = (359.99 + (np.arange(n) % 25)*5.0/3600.0) % 360.0
+        dec = (np.arange(n) // 25)*5.0/3600.0
+        sourceSet = makeVisits(ra, dec, nVisit, 1.0)
+        ref = measMosaic.Source(afwGeom.SpherePoint(10.0, 10.0, afwGeom.degrees), 1.0)
+        det = measMosaic.Source(0, 0, 0, 10.0, 10.0, 1.0, 0.01, 1.0, 0.01, 1.0, 0.1, False)
+        rootMat = measMosaic.kdtreeMat([[(ref, det)]])
+        radius = afwGeom.Angle(2.0, afwGeom.arcseconds)
+
+        # Visits are given out of order, to be sorted by matchArrays
+        sources = [s for ss in sourceSet[::-1] for s in ss]
+        index = dict(((s.getExp(), s.getId()), i) for i, s in enumerate(sources))
+        detRa = np.array([s.getRa().asDegrees() for s in sources])
+        detDec = np.array([s.getDec().asDegrees() for s in sources])
+        visit = np.array([s.getExp() for s in sources], dtype=np.int64)
+        noRef = np.zeros(0)
+
+        for mode, merge in (("nearest", lambda: measMosaic.kdtreeSource(sourceSet, rootMat, {}, radius)),
+                            ("fof", lambda: measMosaic.fofSource(sourceSet, rootMat, radius))):
+            match = measMosaic.matchArrays(detRa, detDec, visit, noRef, noRef, radius, mode)
+            expected = [sorted(index[(s.getExp(), s.getId())] for s in ss) for ss in merge().groups]
+            self.assertEqual(len(match.offsets), len(expected) + 1)
+            for k, members in enumerate(expected):
+                self.assertEqual(list(match.members[match.offsets[k]:match.offsets[k + 1]]), members)
+                self.assertTrue(np.all(match.groupId[members] == k))
+            self.assertTrue(np.all(match.refIndex == -1))
+
+        # References for every other object take their detections first
+        refRa = ra[::2].copy()
+        refDec = dec[::2].copy()
+        match = measMosaic.matchArrays(detRa, detDec, visit, refRa, refDec, radius, nThreads=2)
+        nRef = len(refRa)
+        np.testing.assert_array_equal(match.refIndex[:nRef], np.arange(nRef))
+        self.assertTrue(np.all(match.refIndex[nRef:] == -1))
+        for k in range(nRef):
+            members = match.members[match.offsets[k]:match.offsets[k + 1]]
+            self.assertEqual(set(sources[i].getId() for i in members), set([2*k]))
+            self.assertEqual(len(members), nVisit)
+
+    def testKdtreeMat(self):
+        nVisit = 3
+        refs = [measMosaic.Source(afwGeom.SpherePoint(150.0 + 1E-3*i, 2.0, afwGeom.degrees), 1.0)
+                for i in range(20)]
+        matchList = []
+        for visit in range(nVisit):
+            matches = []
+            for i, ref in enumerate(refs):
+                det = measMosaic.Source(i, 0, visit, ref.getRa().asDegrees(), ref.getDec().asDegrees(),
+                                        1.0, 0.01, 1.0, 0.01, 1.0, 0.1, False)
+                matches.append((ref, det))
+            matchList.append(matches)
+        rootMat = measMosaic.kdtreeMat(matchList)
+        allMat = rootMat.mergeMat()
+        self.assertEqual(len(allMat), len(refs))
+        for mm in allMat:
+            self.assertEqual(len(mm), nVisit + 1)
+            self.assertEqual(sorted(m.getExp() for m in mm[1:]), list(range(nVisit)))
+        self.assertTrue(rootMat.findSource(matchList[1][5][1]))
+        self.assertTrue(rootMat.contains(matchList[1][5][1]))
+        # Same position, but another detection: a positional match, not a member
+        other = measMosaic.Source(1000, 0, 1, refs[5].getRa().asDegrees(), refs[5].getDec().asDegrees(),
+                                  1.0, 0.01, 1.0, 0.01, 1.0, 0.1, False)
+        self.assertTrue(rootMat.findSource(other))
+        self.assertFalse(rootMat.contains(other))
+        self.assertFalse(rootMat.findSource(measMosaic.Source(0, 0, 0, 151.0, 2.0, 1.0, 0.01, 1.0, 0.01,
+                                                              1.0, 0.1, False)))
+
+    def testSourceGroupBuilder(self):
+        """Adding visits one at a time gives the groups of kdtreeMat with kdtreeSource or fofSource"""
+        n = 300
+        nVisit = 4
+        ra = np.random.uniform(150.0, 150.1, size=n)
+        dec = np.random.uniform(2.0, 2.1, size=n)
+        sourceSet = makeVisits(ra, dec, nVisit, 1.0)
+        matchList = []
+        for sources in sourceSet:
+            # Every fifth detection is matched to a reference at the true position
+            matchList.append([(measMosaic.Source(afwGeom.SpherePoint(ra[i], dec[i], afwGeom.degrees), 1.0),
+                               sources[i]) for i in range(0, n, 5)])
+        radius = afwGeom.Angle(2.0, afwGeom.arcseconds)
+
+        def getIds(groups):
+            return [[(s.getExp(), s.getId()) for s in ss[1:]] for ss in groups]
+
+        rootMat = measMosaic.kdtreeMat(matchList)
+        for mode, merge in (("nearest", lambda: measMosaic.kdtreeSource(sourceSet, rootMat, {}, radius)),
+                            ("fof", lambda: measMosaic.fofSource(sourceSet, rootMat, radius))):
+            builder = measMosaic.SourceGroupBuilder(radius, mode)
+            for sources, matches in zip(sourceSet, matchList):
+                builder.addVisit(sources, matches)
+            self.assertEqual(builder.getNumVisits(), nVisit)
+            self.assertEqual(getIds(builder.getMatchTree().mergeMat()), getIds(rootMat.mergeMat()))
+            self.assertEqual(getIds(builder.getSourceTree().mergeSource(2)), getIds(merge().mergeSource(2)))
+
+    def testSourceGroupBuilderNoMatches(self):
+        """A visit without matches adds all of its sources"""
+        # On a grid, so that only the detections of the same object are within radius
+        ra, dec = np.meshgrid(150.0 + 0.01*np.arange(10), 2.0 + 0.01*np.arange(10))
+        ra, dec = ra.ravel(), dec.ravel()
+        n = len(ra)
+        sourceSet = makeVisits(ra, dec, 2, 0.5)
+        matchList = [[(measMosaic.Source(afwGeom.SpherePoint(ra[i], dec[i], afwGeom.degrees), 1.0),
+                       sourceSet[0][i]) for i in range(0, n, 5)], []]
+        radius = afwGeom.Angle(2.0, afwGeom.arcseconds)
+        for mode in ("nearest", "fof"):
+            builder = measMosaic.SourceGroupBuilder(radius, mode)
+            builder.addVisit(sourceSet[1], [])
+            builder.addVisit(sourceSet[0], matchList[0])
+            self.assertEqual(builder.getNumVisits(), 2)
+            self.assertEqual(len(builder.getMatchTree().mergeMat()), n//5)
+            # Each unmatched object is detected in both visits
+            allSource = builder.getSourceTree().mergeSource(2)
+            self.assertEqual(len(allSource), n - n//5)
+            self.assertTrue(all(len(ss) == 3 for ss in allSource))
+        tree = measMosaic.SourceGroupTree([[], sourceSet[0][:1]], True)
+        self.assertEqual(tree.count(), 1)
+        self.assertTrue(tree.contains(sourceSet[0][0]))
+
+    def testFlagSuspect(self):
+        """Detections far from the median magnitude difference of a pair of visits are flagged"""
+        nVisit = 5
+        n = 200
+        wcs = afwGeom.makeSkyWcs(afwGeom.Point2D(0.0, 0.0),
+                                 afwGeom.SpherePoint(150.0, 2.0, afwGeom.degrees),
+                                 afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        wcsDic = dict((visit, wcs) for visit in range(nVisit))
+
+        def makeGroups():
+            rng = np.random.RandomState(1)
+            groups = []
+            for i in range(n):
+                ref = measMosaic.Source(afwGeom.SpherePoint(150.0, 2.0, afwGeom.degrees), 1.0)
+                # Uniform errors never exceed 3 SIQR
+                mag = 20.0 + rng.uniform(-0.01, 0.01, size=nVisit) + 0.1*np.arange(nVisit)
+                # A wrong match in visit 3
+                if i == 7:
+                    mag[3] += 1.0
+                groups.append([ref] + [measMosaic.Source(i, 0, visit, 150.0, 2.0, 1.0, 0.01, 1.0, 0.01,
+                                                         10**(-0.4*mag[visit]), 1.0, False)
+                                       for visit in range(nVisit)])
+            return groups
+
+        allMat = makeGroups()
+        measMosaic.flagSuspect(allMat, [], wcsDic)
+        # Flagged by the first pair with visit 3, and then no longer used
+        self.assertEqual([s.getFlux() < 0 for s in allMat[7][1:]], [True, False, False, True, False])
+        self.assertTrue(all(s.getFlux() > 0 for i, ss in enumerate(allMat) if i != 7 for s in ss[1:]))
+
+        allMatThreads = makeGroups()
+        measMosaic.flagSuspect(allMatThreads, [], wcsDic, nThreads=3)
+        self.assertEqual([s.getFlux() for ss in allMatThreads for s in ss],
+                         [s.getFlux() for ss in allMat for s in ss])
+
+    def testSourceGroupArrays(self):
+        """SourceGroups convert to columns and back, and can be clipped to a box"""
+        nVisit = 3
+        ra = np.array([149.99, 150.0, 150.01, 150.02])
+        dec = np.array([2.0, 2.0, 2.0, 2.0])
+        sourceSet = makeVisits(ra, dec, nVisit, 0.1)
+        allSource = [[measMosaic.Source(afwGeom.SpherePoint(r, d, afwGeom.degrees), 1.0)] +
+                     [sources[i] for sources in sourceSet[:i % nVisit + 1]]
+                     for i, (r, d) in enumerate(zip(ra, dec))]
+        allSource[2][1].setFlux(-9999)
+
+        arrays = measMosaic.sourceGroupToArrays(allSource)
+        np.testing.assert_array_equal(arrays.offsets, [0, 2, 5, 9, 11])
+        np.testing.assert_array_equal(np.diff(arrays.offsets) - 1, [len(ss) - 1 for ss in allSource])
+        self.assertEqual(arrays.exp[arrays.offsets[2] + 1], 0)
+        self.assertEqual(arrays.flux[arrays.offsets[2] + 1], -9999)
+
+        copy = measMosaic.sourceGroupFromArrays(arrays)
+        self.assertEqual([len(ss) for ss in copy], [len(ss) for ss in allSource])
+        for ss, cc in zip(allSource, copy):
+            for s, c in zip(ss, cc):
+                self.assertEqual((c.getId(), c.getChip(), c.getExp()), (s.getId(), s.getChip(), s.getExp()))
+                self.assertFloatsAlmostEqual(c.getRa().asDegrees(), s.getRa().asDegrees(), rtol=1E-15)
+                self.assertEqual(c.getFlux(), s.getFlux())
+
+        # A box around the two middle objects, 0.01 deg (180 pixels) apart
+        wcs = afwGeom.makeSkyWcs(afwGeom.Point2D(0.0, 0.0),
+                                 afwGeom.SpherePoint(150.005, 2.0, afwGeom.degrees),
+                                 afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+        bbox = afwGeom.Box2D(afwGeom.Point2D(-150.0, -10.0), afwGeom.Point2D(150.0, 10.0))
+        inside = measMosaic.getGroupsInBox(arrays, wcs, bbox)
+        np.testing.assert_array_equal(inside, [False, True, True, False])
+        clipped = measMosaic.selectSourceGroups(allSource, inside)
+        self.assertEqual([len(ss) for ss in clipped], [3, 4])
+        # The same Sources, not copies
+        clipped[0][1].setFlux(123.0)
+        self.assertEqual(allSource[1][1].getFlux(), 123.0)
+
+    def testSourceArrays(self):
+        """Matching and pickling SourceArrays gives the groups and values of Sources"""
+        n = 300
+        nVisit = 4
+        ra = np.random.uniform(150.0, 150.1, size=n)
+        dec = np.random.uniform(2.0, 2.1, size=n)
+        sourceSet = makeVisits(ra, dec, nVisit, 1.0)
+        refs = [measMosaic.Source(afwGeom.SpherePoint(ra[i], dec[i], afwGeom.degrees), 1.0)
+                for i in range(0, n, 5)]
+        matchList = [list(zip(refs, sources[::5])) for sources in sourceSet]
+        radius = afwGeom.Angle(2.0, afwGeom.arcseconds)
+
+        sources = measMosaic.sourceSetToArrays([s for ss in sourceSet for s in ss])
+        self.assertEqual(len(sources), n*nVisit)
+        copy = pickle.loads(pickle.dumps(sources, pickle.HIGHEST_PROTOCOL))
+        for name, values in sources.getColumns().items():
+            np.testing.assert_array_equal(getattr(copy, name), values)
+        fromColumns = measMosaic.SourceArrays.fromColumns(**sources.getColumns())
+        self.assertEqual([s.getId() for s in measMosaic.sourceSetFromArrays(fromColumns)],
+                         [s.getId() for ss in sourceSet for s in ss])
+
+        def getIds(arrays):
+            return [list(zip(arrays.exp[i + 1:j], arrays.id[i + 1:j]))
+                    for i, j in zip(arrays.offsets[:-1], arrays.offsets[1:])]
+
+        rootMat = measMosaic.kdtreeMat(matchList)
+        allMat = measMosaic.mergeMatArrays(measMosaic.sourceSetToArrays(refs*nVisit),
+                                           measMosaic.sourceSetToArrays([m[1] for ml in matchList for m in ml]))
+        self.assertEqual(getIds(allMat), getIds(measMosaic.sourceGroupToArrays(rootMat.mergeMat())))
+        for mode, merge in (("nearest", lambda: measMosaic.kdtreeSource(sourceSet, rootMat, {}, radius)),
+                            ("fof", lambda: measMosaic.fofSource(sourceSet, rootMat, radius))):
+            allSource = measMosaic.mergeSourceArrays(sources, allMat, radius, mode, 2)
+            expected = measMosaic.sourceGroupToArrays(merge().mergeSource(2))
+            self.assertEqual(getIds(allSource), getIds(expected))
+            self.assertFloatsAlmostEqual(allSource.ra, expected.ra, rtol=1E-12)
+
+        copy = pickle.loads(pickle.dumps(allMat, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(len(copy), len(allMat))
+        self.assertEqual(getIds(copy), getIds(allMat))
+
+    def testMatchesToArrays(self):
+        """Matching columns of catalogs gives the groups of matching Sources made from their records"""
+        n = 2000
+        nVisit = 4
+        nCcd = 2
+        ra = np.random.uniform(150.0, 150.1, size=n)
+        dec = np.random.uniform(2.0, 2.1, size=n)
+        catalogs = []
+        wcsDic = {}
+        for visit in range(nVisit):
+            crval = afwGeom.SpherePoint(150.05 + 0.001*visit, 2.05, afwGeom.degrees)
+            wcsDic[visit] = afwGeom.makeSkyWcs(afwGeom.Point2D(0.0, 0.0), crval,
+                                               afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds))
+            for ccd in range(nCcd):
+                select = slice(ccd*n//nCcd, (ccd + 1)*n//nCcd)
+                catalogs.append((visit, ccd, makeMatchCatalogs(wcsDic[visit], ra[select], dec[select], 0.5)))
+
+        t0 = time.time()
+        matchList = [[] for visit in range(nVisit)]
+        for visit, ccd, (refCat, srcCat) in catalogs:
+            for ref, src in zip(refCat, srcCat):
+                match = (measMosaic.Source(ref, wcsDic[visit]), measMosaic.Source(src))
+                match[1].setExp(visit)
+                match[1].setChip(ccd)
+                matchList[visit].append(match)
+        expected = measMosaic.sourceGroupToArrays(measMosaic.kdtreeMat(matchList).mergeMat())
+        t1 = time.time()
+        arrays = [mosaicUtils.matchesToArrays(refCat, srcCat, wcsDic[visit], visit, ccd)
+                  for visit, ccd, (refCat, srcCat) in catalogs]
+        allMat = measMosaic.mergeMatArrays(measMosaic.SourceArrays.concatenate([ref for ref, src in arrays]),
+                                           measMosaic.SourceArrays.concatenate([src for ref, src in arrays]))
+        t2 = time.time()
+        print("Matches of %d visits: %.3f s with Sources, %.3f s with columns" %
+              (nVisit, t1 - t0, t2 - t1))
+
+        self.assertEqual(len(allMat), n)
+        self.assertEqual(mosaicUtils.getNumObs(allMat).sum(), n*nVisit)
+        for name in ("offsets", "id", "chip", "exp", "astromBad"):
+            np.testing.assert_array_equal(getattr(allMat, name), getattr(expected, name))
+        for name in ("ra", "dec", "x", "xErr", "y", "yErr", "flux", "fluxErr"):
+            self.assertFloatsAlmostEqual(getattr(allMat, name), getattr(expected, name), rtol=1E-12,
+                                         ignoreNaNs=True)
+
+        # A CCD or a visit without matches
+        refCat, srcCat = makeMatchCatalogs(wcsDic[0], ra[:0], dec[:0], 0.5)
+        ref, src = mosaicUtils.matchesToArrays(refCat, srcCat, wcsDic[0], 0, 0)
+        self.assertEqual((len(ref), len(src)), (0, 0))
+        empty = measMosaic.SourceArrays.concatenate([])
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(len(measMosaic.mergeMatArrays(empty, empty)), 0)
+
+    def testDegenerateKDTree(self):
+        """Merging and destroying a KDTree that is a chain of a million nodes"""
+        n = 1000000
+        source = measMosaic.Source(0, 0, 0, 10.0, 1.0, 1.0, 0.01, 1.0, 0.01, 1.0, 0.1, False)
+        root = measMosaic.KDTree(source, 0)
+        node = root
+        for depth in range(1, n):
+            node.right = measMosaic.KDTree(source, depth)
+            node = node.right
+        del node
+        self.assertEqual(root.count(), n)
+        self.assertEqual(len(root.mergeMat()), n)
+        allSource = root.mergeSource(1)
+        self.assertEqual(len(allSource), n)
+        self.assertEqual(len(allSource[-1]), 2)
+        del root
+
+    def testFlatKDTreeLarge(self):
+        """A tree of a million points finds what a brute-force search does"""
+        n = 1000000
+        ra = np.random.uniform(149.0, 151.0, size=n)
+        dec = np.random.uniform(1.0, 3.0, size=n)
+        # Half near points of the tree, half anywhere
+        nQuery = 100
+        qra = np.concatenate([ra[:nQuery] + np.random.uniform(-1.0, 1.0, size=nQuery)/3600.0,
+                              np.random.uniform(149.0, 151.0, size=nQuery)])
+        qdec = np.concatenate([dec[:nQuery] + np.random.uniform(-1.0, 1.0, size=nQuery)/3600.0,
+                               np.random.uniform(1.0, 3.0, size=nQuery)])
+        self.checkNearest(ra, dec, qra, qdec, afwGeom.Angle(2.0, afwGeom.arcseconds))
+
+
+if __name__ == "__main__":
+    """Run the tests"""
+    unittest.main()
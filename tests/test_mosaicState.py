@@ -0,0 +1,201 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+from __future__ import absolute_import, division, print_function
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import lsst.meas.mosaic
+from lsst.meas.mosaic.mosaicTask import MosaicState, MosaicTask
+import lsst.utils.tests
+
+
+class MockDataRef(object):
+
+    def __init__(self, **dataId):
+        self.dataId = dataId
+
+
+def makeSources(visit, ccd, n, version=0):
+    rng = np.random.RandomState(10000*version + 100*visit + ccd)
+    ra = rng.uniform(10.0, 11.0, size=n)
+    dec = rng.uniform(-1.0, 1.0, size=n)
+    return [lsst.meas.mosaic.Source(i, ccd, visit, ra[i], dec[i], 100.0, 0.01, 200.0, 0.01,
+                                    1000.0, 10.0, False) for i in range(n)]
+
+
+class MockConfig(object):
+    incrementalStateFile = "mosaicState.pickle"
+
+
+class MockLog(object):
+
+    def info(self, msg):
+        pass
+
+    def warn(self, msg):
+        pass
+
+
+class MockTask(object):
+    """Stand-in for MosaicTask, which reads catalogs made on the fly
+
+    versions holds the number of times the catalogs of each dataId were
+    regenerated, and failures the dataIds that cannot be read.
+    """
+
+    def __init__(self, outputDir):
+        self.outputDir = outputDir
+        self.config = MockConfig()
+        self.log = MockLog()
+        self.versions = dict()
+        self.failures = list()
+        self.numRead = 0
+
+    def getKey(self, dataRef):
+        return (dataRef.dataId["visit"], dataRef.dataId["ccd"])
+
+    def getReaderConfig(self, ct):
+        return {"cellSize": "512"}
+
+    def getCatalogSignature(self, dataRef):
+        return self.versions.get(self.getKey(dataRef), 0)
+
+    def readCatalogByVisit(self, dataRefList, ct=None, numCoresForReadSource=1, readTimeout=9999,
+                           verbose=False):
+        ssVisit = dict()
+        mlVisit = dict()
+        dataRefListUsed = list()
+        for dataRef in dataRefList:
+            self.numRead += 1
+            if self.getKey(dataRef) in self.failures:
+                continue
+            visit, ccd = self.getKey(dataRef)
+            ssVisit.setdefault(visit, list()).extend(makeSources(visit, ccd, 5,
+                                                                 self.versions.get((visit, ccd), 0)))
+            mlVisit.setdefault(visit, list())
+            dataRefListUsed.append(dataRef)
+        return ssVisit, mlVisit, dataRefListUsed
+
+    def readCatalogIncremental(self, dataRefList, tract):
+        return MosaicTask.readCatalogIncremental(self, dataRefList, tract)
+
+    def readCatalog(self, dataRefList):
+        return MosaicTask.readCatalog(self, dataRefList)
+
+
+class MosaicStateTestCase(lsst.utils.tests.TestCase):
+
+    def setUp(self):
+        np.random.seed(1)
+        self.readerConfig = {"cellSize": "512"}
+
+    def read(self, dataRefList):
+        """Stand-in for MosaicTask.readCatalogByVisit"""
+        ssVisit = dict()
+        mlVisit = dict()
+        for dataRef in dataRefList:
+            visit, ccd = dataRef.dataId["visit"], dataRef.dataId["ccd"]
+            ssVisit.setdefault(visit, list()).extend(makeSources(visit, ccd, 5))
+            mlVisit.setdefault(visit, list())
+        return ssVisit, mlVisit, list(dataRefList)
+
+    def testIncremental(self):
+        dataRefList = [MockDataRef(visit=visit, ccd=ccd) for visit in (10, 12) for ccd in (0, 1)]
+        signatures = [0]*len(dataRefList)
+        state = MosaicState(8766, self.readerConfig)
+        self.assertEqual(state.getVisitsToRead(dataRefList, signatures), set([10, 12]))
+        state.update(dataRefList, signatures, *self.read(dataRefList))
+
+        with lsst.utils.tests.getTempFilePath(".pickle") as tempFile:
+            state.write(tempFile)
+            state = MosaicState.read(tempFile)
+        self.assertTrue(state.isCompatible(8766, self.readerConfig))
+        self.assertFalse(state.isCompatible(8767, self.readerConfig))
+        self.assertEqual(len(state.sources[10]), 10)
+        self.assertEqual(state.sources[12][7].getExp(), 12)
+
+        # A new visit, plus a new CCD of an old one, must be read; visit 10 is dropped.
+        dataRefList = [MockDataRef(visit=12, ccd=ccd) for ccd in (0, 1, 2)]
+        dataRefList += [MockDataRef(visit=14, ccd=ccd) for ccd in (0, 1)]
+        signatures = [0]*len(dataRefList)
+        state.select(set([12, 14]))
+        visitsToRead = state.getVisitsToRead(dataRefList, signatures)
+        self.assertEqual(visitsToRead, set([12, 14]))
+        dataRefListToRead = [dataRef for dataRef in dataRefList if dataRef.dataId["visit"] in visitsToRead]
+        state.update(dataRefListToRead, signatures, *self.read(dataRefListToRead))
+        self.assertEqual(sorted(state.sources.keys()), [12, 14])
+        self.assertEqual(len(state.sources[12]), 15)
+        self.assertEqual(len(state.dataIds[14]), 2)
+        self.assertEqual(state.getVisitsToRead(dataRefList, signatures), set())
+
+        # A changed signature, or none at all, forces a read.
+        signatures[3] = 1
+        self.assertEqual(state.getVisitsToRead(dataRefList, signatures), set([14]))
+        signatures[3] = 0
+        signatures[0] = None
+        self.assertEqual(state.getVisitsToRead(dataRefList, signatures), set([12]))
+
+    def assertCatalogsEqual(self, catalogs1, catalogs2):
+        sourceSet1, matchList1, dataRefListUsed1 = catalogs1
+        sourceSet2, matchList2, dataRefListUsed2 = catalogs2
+        self.assertEqual([[(s.getId(), s.getExp(), s.getChip(), s.getRa().asDegrees()) for s in ss]
+                          for ss in sourceSet1],
+                         [[(s.getId(), s.getExp(), s.getChip(), s.getRa().asDegrees()) for s in ss]
+                          for ss in sourceSet2])
+        self.assertEqual(matchList1, matchList2)
+        self.assertEqual(dataRefListUsed1, dataRefListUsed2)
+
+    def testIncrementalEqualsFull(self):
+        """Test that readCatalogIncremental gives what a full readCatalog does"""
+        outputDir = tempfile.mkdtemp()
+        try:
+            task = MockTask(outputDir)
+            dataRefList = [MockDataRef(visit=visit, ccd=ccd) for visit in (14, 10, 12) for ccd in (0, 1)]
+            task.failures.append((12, 1))
+            self.assertCatalogsEqual(task.readCatalogIncremental(dataRefList, 8766),
+                                     task.readCatalog(dataRefList))
+
+            # The failed CCD is retried, a catalog is regenerated, and visits are added and dropped.
+            del task.failures[:]
+            task.versions[(10, 0)] = 1
+            dataRefList = dataRefList[2:] + [MockDataRef(visit=16, ccd=ccd) for ccd in (0, 1)]
+            task.numRead = 0
+            catalogs = task.readCatalogIncremental(dataRefList, 8766)
+            self.assertEqual(task.numRead, 6)
+            self.assertCatalogsEqual(catalogs, task.readCatalog(dataRefList))
+
+            # Nothing changed: nothing is read.
+            task.numRead = 0
+            catalogs = task.readCatalogIncremental(dataRefList, 8766)
+            self.assertEqual(task.numRead, 0)
+            self.assertCatalogsEqual(catalogs, task.readCatalog(dataRefList))
+        finally:
+            shutil.rmtree(outputDir)
+
+
+if __name__ == "__main__":
+    """Run the tests"""
+    unittest.main()